@@ -1,52 +1,605 @@
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, Response, g, has_request_context, jsonify, render_template, request
+from flask.json.provider import DefaultJSONProvider
 import psycopg2
 from psycopg2 import pool
+import psycopg2.extensions
+from psycopg2.extras import Json
 import bcrypt
-from datetime import datetime
+import base64
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+from decimal import Decimal, ROUND_HALF_UP
+import hashlib
+import heapq
+import io
+import json
+import numpy as np
 import os
+import queue
+import re
+import select
+import socket
+import threading
+import time
+import traceback
+from types import MappingProxyType
+import uuid
+from werkzeug.http import is_resource_modified
 from dotenv import load_dotenv
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+try:
+    import orjson
+except ImportError:  # opcional: sin orjson se usa json de la librería estándar
+    orjson = None
 app = Flask(__name__)
 
 
 # Cargar variables de entorno
 load_dotenv()
 
+# Segundos máximos para abrir una conexión: sin esto, con la base caída
+# (o inalcanzable) un connect espera el timeout TCP del sistema operativo
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', 5))
+
 DB_CONFIG = {
     'host': os.getenv('DB_HOST'),
     'port': int(os.getenv('DB_PORT', 5432)),  # valor por defecto si no existe
     'database': os.getenv('DB_NAME'),
     'user': os.getenv('DB_USER'),
-    'password': os.getenv('DB_PASSWORD')
+    'password': os.getenv('DB_PASSWORD'),
+    'connect_timeout': DB_CONNECT_TIMEOUT
 }
 
+# Dónde viven los datos: postgres (producción) o memory (benchmarks, ver
+# benchmark_app.py)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'postgres')
+
+# ============================================================================
+# TRAZAS POR REQUEST (SERVER-TIMING)
+# ============================================================================
+#
+# Cada request junta "spans": cada consulta SQL (nombre, duración y filas),
+# commits, bcrypt y armado del JSON. Con SERVER_TIMING_ENABLED=1 se
+# devuelven en el header Server-Timing y, con SQL_TRACE_DEBUG=1 y el header
+# de request X-Debug-Trace: 1, como "_trace" dentro de la respuesta JSON.
+# Ambos exponen nombres de tablas y consultas a cualquier cliente: activarlos
+# solo en entornos de prueba o detrás de un proxy que quite el header.
+
+SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', '0') == '1'
+SQL_TRACE_DEBUG = os.getenv('SQL_TRACE_DEBUG', '0') == '1'
+# Consultas individuales que se listan en Server-Timing (el resto se suma)
+SERVER_TIMING_MAX_QUERIES = 20
+
+# Contadores activos de max_round_trips()
+round_trip_watchers = []
+
+
+def record_span(kind, name, duration_ms, rows=None):
+    """Agregar un span a la traza del request actual (si hay)"""
+    if not has_request_context():
+        return
+    trace = g.get('trace')
+    if trace is None:
+        return
+    trace['spans'].append({
+        'kind': kind,
+        'name': name,
+        'duration_ms': round(duration_ms, 3),
+        'rows': rows
+    })
+
+
+def statement_name(query):
+    """Nombre corto de una sentencia: 'select therapy_sessions', 'insert therapy_answers'..."""
+    sql_text = ' '.join(str(query).split()).lower()
+    match = re.search(r'\b(insert into|update|delete from)\s+(\w+)', sql_text)
+    if match:
+        return f"{match.group(1).split()[0]} {match.group(2)}"
+    match = re.search(r'\bfrom\s+(\w+)', sql_text)
+    if match:
+        return f"select {match.group(1)}"
+    return sql_text.split(' ', 1)[0]
+
+
+class TracingCursor(psycopg2.extensions.cursor):
+    """Cursor que registra duración y filas de cada execute"""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_span('sql', statement_name(query), (time.perf_counter() - start) * 1000, self.rowcount)
+
+
+class TracingConnection(psycopg2.extensions.connection):
+    """Conexión que usa TracingCursor y registra commits/rollbacks"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = TracingCursor
+
+    def commit(self):
+        # Sin transacción abierta psycopg2 no va a la base
+        if self.status == psycopg2.extensions.STATUS_READY:
+            return super().commit()
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            record_span('sql', 'commit', (time.perf_counter() - start) * 1000)
+
+    def rollback(self):
+        if self.status == psycopg2.extensions.STATUS_READY:
+            return super().rollback()
+        start = time.perf_counter()
+        try:
+            return super().rollback()
+        finally:
+            record_span('sql', 'rollback', (time.perf_counter() - start) * 1000)
+
+
+def json_default(value):
+    """Tipos que devuelve psycopg2 y que JSON no conoce"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError(f"{type(value).__name__} no es serializable a JSON")
+
+
+# datetime sale en ISO 8601 igual que con isoformat(); Decimal como número
+ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS) if orjson else 0
+
+
+class TracingJSONProvider(DefaultJSONProvider):
+    """
+    Provider JSON de Flask que mide cuánto tarda armar cada respuesta
+
+    Serializa con orjson si está instalado y si no con json, en ambos casos
+    compacto y aceptando datetime / Decimal sin convertirlos a mano.
+    """
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.dumps(obj, default=json_default, option=ORJSON_OPTIONS).decode('utf-8')
+        kwargs.setdefault('default', json_default)
+        kwargs.setdefault('ensure_ascii', False)
+        kwargs.setdefault('sort_keys', True)
+        kwargs.setdefault('separators', (',', ':'))
+        return json.dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            obj = self._prepare_response_obj(args, kwargs)
+            if orjson is not None:
+                body = orjson.dumps(obj, default=json_default, option=ORJSON_OPTIONS)
+            else:
+                body = self.dumps(obj)
+            return self._app.response_class(body, mimetype=self.mimetype)
+        finally:
+            record_span('json', 'json', (time.perf_counter() - start) * 1000)
+
+
+app.json = TracingJSONProvider(app)
+
+
+@app.before_request
+def start_trace():
+    """Abrir la traza del request"""
+    g.trace = {'started_at': time.perf_counter(), 'spans': []}
+
+
+def count_round_trips(spans):
+    """Idas a la base de un request: una por sentencia, commit o rollback"""
+    return sum(1 for span in spans if span['kind'] == 'sql')
+
+
+@app.after_request
+def add_server_timing(response):
+    """Emitir la traza como Server-Timing (y _trace en modo debug)"""
+    trace = g.get('trace')
+    if trace is None:
+        return response
+
+    spans = trace['spans']
+    total_ms = (time.perf_counter() - trace['started_at']) * 1000
+    round_trips = count_round_trips(spans)
+
+    for watcher in round_trip_watchers:
+        watcher['requests'].append((f"{request.method} {request.path}", round_trips))
+
+    if SERVER_TIMING_ENABLED:
+        sql_spans = [span for span in spans if span['kind'] == 'sql']
+        metrics = []
+        for kind in ('bcrypt', 'json', 'numpy'):
+            kind_ms = sum(span['duration_ms'] for span in spans if span['kind'] == kind)
+            if kind_ms:
+                metrics.append(f"{kind};dur={kind_ms:.2f}")
+        if sql_spans:
+            sql_ms = sum(span['duration_ms'] for span in sql_spans)
+            metrics.append(f'db;desc="{round_trips} round trips";dur={sql_ms:.2f}')
+        for number, span in enumerate(sql_spans[:SERVER_TIMING_MAX_QUERIES], start=1):
+            rows = '' if span['rows'] is None or span['rows'] < 0 else f" ({span['rows']} rows)"
+            metrics.append(f'sql-{number};desc="{span["name"]}{rows}";dur={span["duration_ms"]:.2f}')
+        metrics.append(f"total;dur={total_ms:.2f}")
+        response.headers['Server-Timing'] = ', '.join(metrics)
+
+    if SQL_TRACE_DEBUG and request.headers.get('X-Debug-Trace') == '1' and response.is_json:
+        body = response.get_json(silent=True)
+        if isinstance(body, dict):
+            body['_trace'] = {
+                'total_ms': round(total_ms, 3),
+                'round_trips': round_trips,
+                'spans': spans
+            }
+            response.set_data(json.dumps(body, default=str))
+
+    return response
+
+
+@contextmanager
+def max_round_trips(limit):
+    """
+    Helper de tests: falla si algún request del bloque va a la base más
+    de `limit` veces
+
+        with max_round_trips(3):
+            client.get('/therapy/user/1/resume')
+    """
+    watcher = {'limit': limit, 'requests': []}
+    round_trip_watchers.append(watcher)
+    try:
+        yield watcher
+    finally:
+        round_trip_watchers.remove(watcher)
+
+    over_limit = [(route, count) for route, count in watcher['requests'] if count > limit]
+    if over_limit:
+        details = ', '.join(f"{route}: {count}" for route, count in over_limit)
+        raise AssertionError(f"Más de {limit} idas a la base por request ({details})")
+
+
 # Pool de conexiones para mejor rendimiento
+#
+# El pool es de cada proceso: se crea con la primera conexión que pide el
+# proceso y no al importar el módulo. Con gunicorn --preload (o cualquier
+# servidor que haga fork después de importar la app) el proceso padre no
+# abre sockets que los workers puedan heredar. Si igual los hubiera, el
+# hook de fork (ver reset_after_fork) los descarta en cada hijo.
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+
 connection_pool = None
+# PID del proceso dueño de connection_pool
+connection_pool_pid = None
+connection_pool_lock = threading.Lock()
+# Conexiones heredadas del padre que este proceso nunca debe usar ni cerrar
+inherited_connections = []
 
 def init_db_pool():
-    """Inicializar el pool de conexiones"""
-    global connection_pool
+    """Inicializar el pool de conexiones de este proceso"""
+    global connection_pool, connection_pool_pid
     try:
-        print("[DEBUG] Iniciando pool de conexiones...")
-        connection_pool = psycopg2.pool.SimpleConnectionPool(
-            1,  # Mínimo de conexiones
-            10,  # Máximo de conexiones
+        print(f"[DEBUG] Iniciando pool de conexiones (pid {os.getpid()})...")
+        # Threaded: un worker de gunicorn atiende varios requests en hilos
+        connection_pool = psycopg2.pool.ThreadedConnectionPool(
+            DB_POOL_MIN,  # Mínimo de conexiones
+            DB_POOL_MAX,  # Máximo de conexiones
+            connection_factory=TracingConnection,
             **DB_CONFIG
         )
+        connection_pool_pid = os.getpid()
         print("[DEBUG] ✅ Pool de conexiones creado exitosamente")
         return True
     except Exception as e:
         print(f"[ERROR] ❌ Error al crear pool de conexiones: {e}")
         return False
 
-# 🔥 ESTO ES LO IMPORTANTE: Inicializar el pool al cargar el módulo
-if connection_pool is None:
-    init_db_pool()
-    
-def get_db_connection():
-    """Obtener una conexión del pool"""
+
+def discard_inherited_pools():
+    """
+    Olvidar los pools heredados del proceso padre
+
+    Las conexiones no se cierran: cerrarlas le enviaría a Postgres el
+    mensaje de terminación por un socket que el padre sigue usando. Se
+    guardan en inherited_connections para que el GC tampoco las cierre.
+    """
+    global connection_pool, connection_pool_pid
+    for inherited_pool in [connection_pool, *shard_pools.values()]:
+        if inherited_pool is not None:
+            inherited_connections.extend(inherited_pool._pool)
+            inherited_connections.extend(inherited_pool._used.values())
+    connection_pool = None
+    connection_pool_pid = None
+    shard_pools.clear()
+    connection_checkouts.clear()
+
+
+def get_connection_pool():
+    """Pool principal de este proceso (se crea la primera vez que se usa)"""
+    if connection_pool is None or connection_pool_pid != os.getpid():
+        with connection_pool_lock:
+            if connection_pool is not None and connection_pool_pid != os.getpid():
+                discard_inherited_pools()
+            if connection_pool is None:
+                init_db_pool()
+    return connection_pool
+
+# ============================================================================
+# SHARDING DE DATOS DE TERAPIA POR usr_index
+# ============================================================================
+#
+# usr_mstr vive siempre en la base principal (DB_CONFIG). Las tablas
+# therapy_sessions / therapy_answers se reparten entre shards según el mapa
+# JSON indicado en DB_SHARD_MAP:
+#
+#   {
+#     "session_id_stride": 16,
+#     "shards": {"0": {"host": ..., "database": ...}, "1": {...}},
+#     "users": {"42": 1},
+#     "placement": [0, 1],
+#     "frozen_users": [],
+#     "legacy_session_id_max": 0
+#   }
+#
+# "users" es el directorio de usuarios: quien aparece ahí vive en ese shard.
+# Solo los usuarios que no están en el directorio se ubican por módulo,
+# usr_index % len(placement) sobre "placement" (por defecto todos los
+# shards). Antes de agregar un shard shard_tool.py add-shard fija a todos
+# los usuarios existentes en el directorio, así el módulo nuevo solo ubica
+# a los usuarios que todavía no tienen datos.
+#
+# La secuencia de session_id de cada shard avanza de session_id_stride en
+# session_id_stride empezando en su número de shard, así session_id %
+# session_id_stride identifica el shard sin consultas globales (ver
+# shard_tool.py init-sequences). El stride no cambia al agregar shards: los
+# session_id son únicos entre todos los shards y una sesión movida conserva
+# su id. shard_tool.py solo mueve usuarios sin sesión activa, así que no
+# registra sus sesiones: quedan cerradas y se leen por usuario. "sessions"
+# queda para fijar a mano sesiones puntuales. Los ids <=
+# legacy_session_id_max son anteriores al sharding y viven en el shard 0.
+#
+# "frozen_users" bloquea la creación de sesiones de los usuarios que
+# shard_tool.py está moviendo. Sin DB_SHARD_MAP hay un único shard 0 que
+# usa el pool principal.
+
+DB_SHARD_MAP = os.getenv('DB_SHARD_MAP')
+SHARD_MAP_RELOAD_SECONDS = float(os.getenv('SHARD_MAP_RELOAD_SECONDS', 5))
+
+shard_map = None
+shard_map_mtime = None
+shard_map_checked_at = None
+shard_pools = {}
+shard_lock = threading.Lock()
+
+
+def read_shard_map(path):
+    """Leer y validar el mapa de shards desde un archivo JSON"""
+    with open(path, encoding='utf-8') as f:
+        raw = json.load(f)
+
+    shards = {
+        int(shard): {'connect_timeout': DB_CONNECT_TIMEOUT, **config}
+        for shard, config in raw['shards'].items()
+    }
+    if sorted(shards) != list(range(len(shards))):
+        raise ValueError('Los shards deben numerarse 0..N-1')
+
+    stride = int(raw.get('session_id_stride', len(shards)))
+    if stride < len(shards):
+        raise ValueError('session_id_stride debe ser >= número de shards')
+
+    users = {int(usr): int(shard) for usr, shard in raw.get('users', {}).items()}
+    for usr_index, shard in users.items():
+        if shard not in shards:
+            raise ValueError(f'Usuario {usr_index} asignado a shard inexistente {shard}')
+
+    sessions = {int(session_id): int(shard) for session_id, shard in raw.get('sessions', {}).items()}
+    for session_id, shard in sessions.items():
+        if shard not in shards:
+            raise ValueError(f'Sesión {session_id} asignada a shard inexistente {shard}')
+
+    placement = [int(shard) for shard in raw.get('placement', sorted(shards))]
+    if not placement or any(shard not in shards for shard in placement):
+        raise ValueError('placement debe listar shards existentes')
+
+    return {
+        'session_id_stride': stride,
+        'shards': shards,
+        'users': users,
+        'sessions': sessions,
+        'placement': placement,
+        'frozen_users': frozenset(int(usr) for usr in raw.get('frozen_users', [])),
+        'legacy_session_id_max': int(raw.get('legacy_session_id_max', 0))
+    }
+
+
+def get_shard_map():
+    """
+    Obtener el mapa de shards vigente
+
+    El archivo se vuelve a leer cuando cambia su mtime (revisado como mucho
+    cada SHARD_MAP_RELOAD_SECONDS), así shard_tool.py puede mover usuarios
+    sin reiniciar la aplicación.
+    """
+    global shard_map, shard_map_mtime, shard_map_checked_at
+
+    if not DB_SHARD_MAP:
+        if shard_map is None:
+            shard_map = {
+                'session_id_stride': 1,
+                'shards': {0: DB_CONFIG},
+                'users': {},
+                'sessions': {},
+                'placement': [0],
+                'frozen_users': frozenset(),
+                'legacy_session_id_max': 0
+            }
+        return shard_map
+
+    now = time.monotonic()
+    if shard_map is not None and now - shard_map_checked_at < SHARD_MAP_RELOAD_SECONDS:
+        return shard_map
+
+    with shard_lock:
+        if shard_map is not None and now - shard_map_checked_at < SHARD_MAP_RELOAD_SECONDS:
+            return shard_map
+        shard_map_checked_at = now
+        try:
+            mtime = os.path.getmtime(DB_SHARD_MAP)
+            if mtime != shard_map_mtime:
+                shard_map = read_shard_map(DB_SHARD_MAP)
+                shard_map_mtime = mtime
+                print(f"[DEBUG] 🗺️ Mapa de shards cargado: {len(shard_map['shards'])} shards, "
+                      f"{len(shard_map['users'])} usuarios en el directorio, "
+                      f"{len(shard_map['frozen_users'])} bloqueados")
+        except Exception as e:
+            if shard_map is None:
+                raise
+            print(f"[ERROR] ❌ Error al recargar mapa de shards, se mantiene el anterior: {e}")
+        return shard_map
+
+
+def user_shard(current_map, usr_index):
+    """Shard de un usuario según un mapa: el directorio o, si no está, el módulo"""
+    usr_index = int(usr_index)
+    placement = current_map['placement']
+    return current_map['users'].get(usr_index, placement[usr_index % len(placement)])
+
+
+def session_shard(current_map, session_id):
+    """Shard de una sesión según un mapa: movida, anterior al sharding o por su id"""
+    session_id = int(session_id)
+    if session_id in current_map['sessions']:
+        return current_map['sessions'][session_id]
+    if session_id <= current_map['legacy_session_id_max']:
+        return 0
+    return session_id % current_map['session_id_stride']
+
+
+def shard_for_user(usr_index):
+    """Shard donde viven las sesiones de un usuario"""
+    return user_shard(get_shard_map(), usr_index)
+
+
+def shard_for_session(session_id):
+    """Shard de una sesión, codificado en su propio session_id"""
+    return session_shard(get_shard_map(), session_id)
+
+
+def user_writes_blocked(usr_index):
+    """El usuario se está moviendo de shard (ver shard_tool.py)"""
+    return int(usr_index) in get_shard_map()['frozen_users']
+
+
+def get_shard_pool(shard):
+    """Pool de conexiones de un shard (se crea la primera vez que se usa)"""
+    if not DB_SHARD_MAP:
+        return get_connection_pool()
+
+    config = get_shard_map()['shards'][shard]
+    if config == DB_CONFIG:
+        # El shard es la base principal: compartir el pool
+        return get_connection_pool()
+
+    shard_pool = shard_pools.get(shard)
+    if shard_pool is not None:
+        return shard_pool
+
+    with shard_lock:
+        if shard not in shard_pools:
+            print(f"[DEBUG] Iniciando pool del shard {shard}...")
+            shard_pools[shard] = psycopg2.pool.ThreadedConnectionPool(
+                DB_POOL_MIN,  # Mínimo de conexiones
+                DB_POOL_MAX,  # Máximo de conexiones
+                connection_factory=TracingConnection,
+                **config
+            )
+            print(f"[DEBUG] ✅ Pool del shard {shard} creado")
+        return shard_pools[shard]
+
+# Segundos que una conexión puede estar prestada antes de considerarse fuga
+DB_CONN_LEAK_SECONDS = float(os.getenv('DB_CONN_LEAK_SECONDS', 30))
+
+# Conexiones prestadas: id(conn) -> quién la pidió, cuándo y desde dónde
+connection_checkouts = {}
+checkouts_lock = threading.Lock()
+# Préstamos que superaron DB_CONN_LEAK_SECONDS desde que arrancó el proceso
+leaked_connections_total = 0
+
+
+def _register_checkout(conn, conn_pool):
+    """Registrar quién tomó la conexión para poder rastrear fugas"""
+    if has_request_context():
+        route = f"{request.method} {request.path}"
+    else:
+        route = '<fuera de request>'
+
+    checkout = {
+        'conn': conn,
+        'pool': conn_pool,
+        'route': route,
+        'stack': ''.join(traceback.format_stack(limit=10)[:-2]),
+        'acquired_at': time.monotonic()
+    }
+    with checkouts_lock:
+        connection_checkouts[id(conn)] = checkout
+
+    # Asociar la conexión al request para devolverla en el teardown
+    if has_request_context():
+        g.setdefault('db_checkouts', []).append(checkout)
+
+
+def report_leaked_connections():
+    """
+    Loguear las conexiones prestadas por más de DB_CONN_LEAK_SECONDS
+
+    Solo se reporta (una vez por préstamo) la ruta y el stack que la tomó:
+    la conexión puede seguir en uso por un request lento en otro hilo y
+    psycopg2 no permite cerrarla desde acá sin riesgo. Las que tomó un
+    request se devuelven al pool cuando ese request termina (ver
+    release_request_connections); las demás cuentan para
+    READY_MAX_LEAKED_CONNECTIONS en /readyz.
+    """
+    global leaked_connections_total
+
+    now = time.monotonic()
+    with checkouts_lock:
+        leaked = [
+            checkout for checkout in connection_checkouts.values()
+            if now - checkout['acquired_at'] > DB_CONN_LEAK_SECONDS
+        ]
+        new_leaks = [checkout for checkout in leaked if not checkout.get('reported')]
+        for checkout in new_leaks:
+            checkout['reported'] = True
+        leaked_connections_total += len(new_leaks)
+
+    for checkout in new_leaks:
+        held_seconds = now - checkout['acquired_at']
+        print(f"[ERROR] ❌ Conexión retenida {held_seconds:.1f}s por {checkout['route']}")
+        print(f"[ERROR] Stack de quien la tomó:\n{checkout['stack']}")
+
+    return len(leaked)
+
+
+def get_db_connection(shard=None):
+    """
+    Obtener una conexión del pool
+
+    Sin shard se usa la base principal (usr_mstr); con shard, el pool del
+    shard que guarda las tablas de terapia.
+    """
     try:
+        report_leaked_connections()
+        conn_pool = get_connection_pool() if shard is None else get_shard_pool(shard)
         print("[DEBUG] Obteniendo conexión del pool...")
-        conn = connection_pool.getconn()
+        conn = conn_pool.getconn()
+        _register_checkout(conn, conn_pool)
         print("[DEBUG] ✅ Conexión obtenida")
         return conn
     except Exception as e:
@@ -57,13 +610,216 @@ def get_db_connection():
 def release_db_connection(conn):
     """Liberar conexión al pool"""
     try:
+        with checkouts_lock:
+            checkout = connection_checkouts.pop(id(conn), None)
+        if checkout is None:
+            # Ya liberada (por el handler o en el teardown): no devolverla dos veces
+            print("[DEBUG] Conexión ya liberada, nada que hacer")
+            return
         print("[DEBUG] Liberando conexión al pool...")
-        connection_pool.putconn(conn)
+        checkout['pool'].putconn(conn)
         print("[DEBUG] ✅ Conexión liberada")
     except Exception as e:
         print(f"[ERROR] ❌ Error al liberar conexión: {e}")
 
 
+@app.teardown_request
+def release_request_connections(exc):
+    """Devolver al pool las conexiones que el request no liberó"""
+    for checkout in g.pop('db_checkouts', []):
+        conn = checkout['conn']
+        with checkouts_lock:
+            # La conexión pudo liberarse y pasar a otro request: solo
+            # devolverla si este checkout sigue siendo el vigente
+            still_held = connection_checkouts.get(id(conn)) is checkout
+        if still_held:
+            print(f"[ERROR] ⚠️ Conexión no liberada por {checkout['route']}, liberándola en teardown")
+            release_db_connection(conn)
+
+
+# ============================================================================
+# COSTO DE BCRYPT
+# ============================================================================
+#
+# El costo se elige al arrancar midiendo un hash de prueba: el mayor que
+# cabe en BCRYPT_TARGET_MS, entre BCRYPT_MIN_ROUNDS y BCRYPT_MAX_ROUNDS.
+# Con gunicorn (preload_app) se mide una vez en el maestro y todos los
+# workers usan el mismo costo. BCRYPT_ROUNDS lo fija para toda la flota;
+# en ese caso igual se mide y se avisa si en esta máquina es muy lento.
+#
+# Los hashes con un costo menor se suben en segundo plano después de un
+# login correcto; los de costo mayor se dejan como están. Así, si dos
+# máquinas calibran distinto, un login en la más lenta no baja lo que
+# subió la más rápida.
+
+# Latencia objetivo (ms) de un hash bcrypt en esta máquina (0 = no medir)
+BCRYPT_TARGET_MS = float(os.getenv('BCRYPT_TARGET_MS', 250))
+# Límites del costo que la calibración puede elegir
+BCRYPT_MIN_ROUNDS = int(os.getenv('BCRYPT_MIN_ROUNDS', 10))
+BCRYPT_MAX_ROUNDS = int(os.getenv('BCRYPT_MAX_ROUNDS', 14))
+# Costo de referencia con el que se mide el hardware
+BCRYPT_PROBE_ROUNDS = 8
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS')) if os.getenv('BCRYPT_ROUNDS') else None
+
+for name, rounds in (('BCRYPT_ROUNDS', BCRYPT_ROUNDS), ('BCRYPT_MIN_ROUNDS', BCRYPT_MIN_ROUNDS),
+                     ('BCRYPT_MAX_ROUNDS', BCRYPT_MAX_ROUNDS)):
+    if rounds is not None and not 4 <= rounds <= 31:
+        raise ValueError(f"{name} debe estar entre 4 y 31 (recibido {rounds})")
+if BCRYPT_MIN_ROUNDS > BCRYPT_MAX_ROUNDS:
+    raise ValueError("BCRYPT_MIN_ROUNDS no puede ser mayor que BCRYPT_MAX_ROUNDS")
+
+
+def measure_bcrypt_ms():
+    """Milisegundos de un hash con BCRYPT_PROBE_ROUNDS (el mejor de tres)"""
+    samples = []
+    for _ in range(3):
+        start = time.perf_counter()
+        bcrypt.hashpw(b'calibration', bcrypt.gensalt(rounds=BCRYPT_PROBE_ROUNDS))
+        samples.append((time.perf_counter() - start) * 1000)
+    return min(samples)
+
+
+def estimate_bcrypt_ms(probe_ms, rounds):
+    """Cada ronda adicional duplica el tiempo del hash de prueba"""
+    return probe_ms * 2 ** (rounds - BCRYPT_PROBE_ROUNDS)
+
+
+def rounds_for_target(probe_ms, target_ms, min_rounds=4, max_rounds=31):
+    """Mayor costo cuyo hash estimado no pasa de target_ms (acotado)"""
+    rounds = min_rounds
+    while rounds < max_rounds and estimate_bcrypt_ms(probe_ms, rounds + 1) <= target_ms:
+        rounds += 1
+    return rounds
+
+
+def calibrate_bcrypt_rounds():
+    """
+    Costo de bcrypt para este proceso
+
+    Sin BCRYPT_ROUNDS se calibra contra BCRYPT_TARGET_MS. Con BCRYPT_ROUNDS
+    se respeta, pero si en esta máquina tarda más que el objetivo se avisa
+    con el costo que sí cabría.
+    """
+    if BCRYPT_TARGET_MS <= 0:
+        rounds = BCRYPT_ROUNDS or BCRYPT_MIN_ROUNDS
+        print(f"[DEBUG] 🔧 bcrypt rounds: {rounds} (sin calibrar)")
+        return rounds
+
+    probe_ms = measure_bcrypt_ms()
+
+    if BCRYPT_ROUNDS is None:
+        rounds = rounds_for_target(probe_ms, BCRYPT_TARGET_MS, BCRYPT_MIN_ROUNDS, BCRYPT_MAX_ROUNDS)
+        print(f"[DEBUG] 🔧 bcrypt calibrado: {rounds} rounds "
+              f"(~{estimate_bcrypt_ms(probe_ms, rounds):.0f} ms, objetivo {BCRYPT_TARGET_MS:.0f} ms)")
+        return rounds
+
+    estimated_ms = estimate_bcrypt_ms(probe_ms, BCRYPT_ROUNDS)
+    if estimated_ms > BCRYPT_TARGET_MS:
+        print(f"[ERROR] ⚠️ BCRYPT_ROUNDS={BCRYPT_ROUNDS} tarda ~{estimated_ms:.0f} ms en esta máquina "
+              f"(objetivo {BCRYPT_TARGET_MS:.0f} ms); el costo que cabe es "
+              f"{rounds_for_target(probe_ms, BCRYPT_TARGET_MS)}")
+    else:
+        print(f"[DEBUG] 🔧 bcrypt rounds fijado por entorno: {BCRYPT_ROUNDS} (~{estimated_ms:.0f} ms)")
+    return BCRYPT_ROUNDS
+
+
+bcrypt_rounds = calibrate_bcrypt_rounds()
+
+# Operaciones bcrypt en curso (se reporta como backlog en /readyz)
+bcrypt_in_flight = 0
+bcrypt_lock = threading.Lock()
+
+# usr_index con un rehash en curso: a lo sumo uno por usuario
+rehash_pending = set()
+rehash_lock = threading.Lock()
+
+
+def _track_bcrypt(delta):
+    """Actualizar el contador de operaciones bcrypt en curso"""
+    global bcrypt_in_flight
+    with bcrypt_lock:
+        bcrypt_in_flight += delta
+
+
+def hash_password(password):
+    """Hashear una contraseña con el costo configurado"""
+    _track_bcrypt(1)
+    start = time.perf_counter()
+    try:
+        return bcrypt.hashpw(
+            password.encode('utf-8'),
+            bcrypt.gensalt(rounds=bcrypt_rounds)
+        ).decode('utf-8')
+    finally:
+        _track_bcrypt(-1)
+        record_span('bcrypt', 'hashpw', (time.perf_counter() - start) * 1000)
+
+
+def verify_password(password, hashed_password):
+    """Comparar una contraseña contra su hash bcrypt"""
+    _track_bcrypt(1)
+    start = time.perf_counter()
+    try:
+        return bcrypt.checkpw(
+            password.encode('utf-8'),
+            hashed_password.encode('utf-8')
+        )
+    finally:
+        _track_bcrypt(-1)
+        record_span('bcrypt', 'checkpw', (time.perf_counter() - start) * 1000)
+
+
+def get_hash_rounds(hashed_password):
+    """Extraer el costo de un hash bcrypt ($2b$12$...)"""
+    try:
+        return int(hashed_password.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def _rehash_password(usr_index, password, hashed_password):
+    """Subir el costo del hash de un usuario (corre en un hilo aparte)"""
+    try:
+        new_hash = hash_password(password)
+        # Solo actualizar si nadie cambió el hash mientras tanto
+        if storage.update_password_hash(usr_index, new_hash, hashed_password):
+            print(f"[DEBUG] ✅ Contraseña rehasheada para usuario ID: {usr_index}")
+
+    except Exception as e:
+        print(f"[ERROR] ❌ Error al rehashear contraseña: {e}")
+
+    finally:
+        with rehash_lock:
+            rehash_pending.discard(usr_index)
+
+
+def rehash_password_if_needed(usr_index, password, hashed_password):
+    """
+    Programar el rehash si el costo del hash es menor que el vigente
+
+    Se llama después de un login correcto, que es el único momento en que
+    tenemos la contraseña en claro. El segundo bcrypt corre fuera del
+    request para no sumar su latencia al login; un fallo ahí no rompe nada.
+    """
+    current_rounds = get_hash_rounds(hashed_password)
+    if current_rounds is not None and current_rounds >= bcrypt_rounds:
+        return False
+
+    with rehash_lock:
+        if usr_index in rehash_pending:
+            return False
+        rehash_pending.add(usr_index)
+
+    print(f"[DEBUG] 🔁 Rehasheando contraseña en segundo plano ({current_rounds} -> {bcrypt_rounds} rounds)")
+    threading.Thread(
+        target=_rehash_password,
+        args=(usr_index, password, hashed_password),
+        name=f'rehash-{usr_index}',
+        daemon=True
+    ).start()
+    return True
+
+
 @app.route('/register_user', methods=['POST'])
 def register_user():
     """Endpoint para registrar un nuevo usuario"""
@@ -94,60 +850,21 @@ def register_user():
         
         # Hash de la contraseña
         print("[DEBUG] Hasheando contraseña...")
-        hashed_password = bcrypt.hashpw(
-            usr_password.encode('utf-8'), 
-            bcrypt.gensalt()
-        ).decode('utf-8')
+        hashed_password = hash_password(usr_password)
         print("[DEBUG] ✅ Contraseña hasheada")
         
-        # Obtener conexión
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({
-                'success': False,
-                'message': 'Error de conexión a la base de datos'
-            }), 500
-        
-        cursor = conn.cursor()
-        
-        # Verificar si el email ya existe
-        print("[DEBUG] Verificando si el email existe...")
-        cursor.execute(
-            "SELECT usr_email FROM usr_mstr WHERE usr_email = %s",
-            (usr_email,)
-        )
-        existing_user = cursor.fetchone()
+        # Verificar el email e insertar el usuario
+        print("[DEBUG] Insertando usuario en la base de datos...")
+        usr_index = storage.create_user(usr_name, usr_email, hashed_password)
         
-        if existing_user:
+        if usr_index is None:
             print("[ERROR] ❌ Email ya registrado")
-            cursor.close()
-            release_db_connection(conn)
             return jsonify({
                 'success': False,
                 'message': 'El email ya está registrado'
             }), 409
         
-        print("[DEBUG] ✅ Email disponible")
-        
-        # Insertar nuevo usuario
-        print("[DEBUG] Insertando usuario en la base de datos...")
-        cursor.execute(
-            """
-            INSERT INTO usr_mstr (usr_name, usr_email, usr_password)
-            VALUES (%s, %s, %s)
-            RETURNING usr_index
-            """,
-            (usr_name, usr_email, hashed_password)
-        )
-        
-        usr_index = cursor.fetchone()[0]
-        conn.commit()
         print(f"[DEBUG] ✅ Usuario insertado con ID: {usr_index}")
-        
-        # Cerrar cursor y liberar conexión
-        cursor.close()
-        release_db_connection(conn)
-        
         print("[DEBUG] 🎉 Registro completado exitosamente")
         print("="*50 + "\n")
         
@@ -161,11 +878,14 @@ def register_user():
             }
         }), 201
         
-    except psycopg2.IntegrityError as e:
+    except StorageUnavailableError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+        
+    except DuplicateEmailError as e:
         print(f"[ERROR] ❌ Error de integridad: {e}")
-        if conn:
-            conn.rollback()
-            release_db_connection(conn)
         return jsonify({
             'success': False,
             'message': 'Error: El email ya está registrado'
@@ -173,9 +893,6 @@ def register_user():
         
     except Exception as e:
         print(f"[ERROR] ❌ Error inesperado: {e}")
-        if conn:
-            conn.rollback()
-            release_db_connection(conn)
         return jsonify({
             'success': False,
             'message': f'Error interno del servidor: {str(e)}'
@@ -208,32 +925,9 @@ def login_user():
         print(f"[DEBUG] Email: {usr_email}")
         print(f"[DEBUG] Password length: {len(usr_password)}")
         
-        # Obtener conexión
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({
-                'success': False,
-                'message': 'Error de conexión a la base de datos'
-            }), 500
-        
-        cursor = conn.cursor()
-        
         # Buscar usuario por email
         print("[DEBUG] Buscando usuario en la base de datos...")
-        cursor.execute(
-            """
-            SELECT usr_index, usr_name, usr_email, usr_password 
-            FROM usr_mstr 
-            WHERE usr_email = %s
-            """,
-            (usr_email,)
-        )
-        
-        user = cursor.fetchone()
-        
-        # Cerrar cursor y liberar conexión
-        cursor.close()
-        release_db_connection(conn)
+        user = storage.find_user_by_email(usr_email)
         
         # Verificar si el usuario existe
         if not user:
@@ -245,14 +939,11 @@ def login_user():
         
         print("[DEBUG] ✅ Usuario encontrado")
         
-        usr_index, usr_name, usr_email_db, hashed_password = user
+        usr_index, usr_name, usr_email_db, hashed_password, _ = user
         
         # Verificar contraseña
         print("[DEBUG] Verificando contraseña...")
-        password_match = bcrypt.checkpw(
-            usr_password.encode('utf-8'),
-            hashed_password.encode('utf-8')
-        )
+        password_match = verify_password(usr_password, hashed_password)
         
         if not password_match:
             print("[ERROR] ❌ Contraseña incorrecta")
@@ -262,6 +953,10 @@ def login_user():
             }), 401
         
         print("[DEBUG] ✅ Contraseña correcta")
+        
+        # Subir el costo del hash si quedó por debajo del configurado
+        rehash_password_if_needed(usr_index, usr_password, hashed_password)
+        
         print(f"[DEBUG] 🎉 Login exitoso para usuario ID: {usr_index}")
         print("="*50 + "\n")
         
@@ -275,10 +970,14 @@ def login_user():
             }
         }), 200
         
+    except StorageUnavailableError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+        
     except Exception as e:
         print(f"[ERROR] ❌ Error inesperado: {e}")
-        if 'conn' in locals() and conn:
-            release_db_connection(conn)
         return jsonify({
             'success': False,
             'message': f'Error interno del servidor: {str(e)}'
@@ -286,745 +985,3395 @@ def login_user():
 
 
 # ============================================================================
-# ENDPOINTS PARA GESTIÓN DE SESIONES DE TERAPIA
+# CACHÉ DE SESIONES ACTIVAS
 # ============================================================================
+#
+# Cada proceso guarda el estado de las sesiones activas que toca (status,
+# tipo, categoría, contadores, índice) para no consultar therapy_sessions
+# en cada respuesta o poll. Las escrituras publican un NOTIFY en
+# SESSION_EVENTS_CHANNEL dentro de la misma sentencia SQL; un hilo por
+# shard escucha el canal e invalida lo que cambiaron otros procesos.
 
-from flask import Flask, request, jsonify
-from datetime import datetime
-import json
+SESSION_CACHE_ENABLED = os.getenv('SESSION_CACHE_ENABLED', '1') == '1'
+SESSION_CACHE_MAX = int(os.getenv('SESSION_CACHE_MAX', 1000))
+SESSION_CACHE_TTL_SECONDS = float(os.getenv('SESSION_CACHE_TTL_SECONDS', 60))
+SESSION_EVENTS_CHANNEL = 'therapy_session_events'
 
-# ============================================================================
-# ENDPOINTS PARA GESTIÓN DE SESIONES DE TERAPIA
-# ============================================================================
+def new_process_id():
+    """Identificador de este proceso en los NOTIFY (cambia después de un fork)"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
 
 
-@app.route('/therapy/user/<int:usr_index>/resume', methods=['GET'])
-def get_user_therapy_resume(usr_index):
+# Identifica a este proceso en los NOTIFY para ignorar los propios
+PROCESS_ID = new_process_id()
+
+SESSION_STATE_FIELDS = (
+    'session_id', 'usr_index', 'session_status', 'therapy_type', 'therapy_category',
+    'started_at', 'total_questions', 'correct_answers', 'current_question_index'
+)
+
+# session_id -> estado de la sesión (orden LRU)
+session_cache = OrderedDict()
+# usr_index -> session_id de su sesión activa más reciente, solo cuando
+# se sabe con certeza (al iniciarla o tras consultarla en la base)
+active_session_by_user = {}
+session_cache_lock = threading.Lock()
+
+# shard -> hilo escuchando NOTIFY / si está conectado ahora mismo
+session_listeners = {}
+session_listener_ready = {}
+
+
+def session_notify_sql(event, extra_fields=()):
     """
-    Obtiene el estado actual de las terapias del usuario para reanudar
-    
-    Retorna:
-    - Sesión activa si existe
-    - Última palabra/pregunta que estaba practicando
-    - Progreso general del usuario
-    - Siguiente ejercicio recomendado
-    
-    Este endpoint se llama cuando el usuario inicia la skill
+    Fragmento SQL que publica un evento de sesión
+
+    Se agrega al SELECT final de cada escritura (start / answer / end) para
+    que el aviso salga en la misma ida a la base y solo si hay COMMIT.
+    Espera las columnas de therapy_sessions y la versión del usuario
+    (user_version_cte) en la fila de origen. Lleva un %s para el origen y
+    uno más por cada campo de extra_fields.
     """
-    print("\n" + "="*50)
-    print(f"[DEBUG] 🔄 Consultando estado de terapias para usuario {usr_index}")
-    print(f"[DEBUG] Timestamp: {datetime.now()}")
-    
-    try:
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({
-                'success': False,
-                'message': 'Error de conexión a la base de datos'
-            }), 500
-        
-        cursor = conn.cursor()
-        
-        # 1. Buscar sesión activa
+    extras = ''.join(f",\n            '{field}', %s" for field in extra_fields)
+    return f"""
+        pg_notify('{SESSION_EVENTS_CHANNEL}', json_build_object(
+            'origin', %s,
+            'event', '{event}',
+            'session_id', session_id,
+            'usr_index', usr_index,
+            'session_status', session_status,
+            'therapy_type', therapy_type,
+            'therapy_category', therapy_category,
+            'total_questions', total_questions,
+            'correct_answers', correct_answers,
+            'current_question_index', current_question_index,
+            'user_version', version{extras}
+        )::text)
+    """
+
+
+def cache_session(session, is_latest_active=False):
+    """
+    Guardar el estado de una sesión
+
+    is_latest_active indica que es la sesión activa más reciente del
+    usuario (recién creada o recién leída de la base).
+    """
+    if not SESSION_CACHE_ENABLED:
+        return
+
+    entry = dict(session)
+    entry['expires_at'] = time.monotonic() + SESSION_CACHE_TTL_SECONDS
+    with session_cache_lock:
+        session_cache[entry['session_id']] = entry
+        session_cache.move_to_end(entry['session_id'])
+        if is_latest_active:
+            active_session_by_user[entry['usr_index']] = entry['session_id']
+        while len(session_cache) > SESSION_CACHE_MAX:
+            evicted_id, evicted = session_cache.popitem(last=False)
+            if active_session_by_user.get(evicted['usr_index']) == evicted_id:
+                del active_session_by_user[evicted['usr_index']]
+
+
+def get_cached_session(session_id):
+    """Estado cacheado de una sesión, o None si no está o venció"""
+    if not SESSION_CACHE_ENABLED or not session_listener_ready.get(shard_for_session(session_id)):
+        # Sin listener no nos enteramos de cambios de otros procesos
+        return None
+
+    with session_cache_lock:
+        entry = session_cache.get(session_id)
+        if entry is None:
+            return None
+        if entry['expires_at'] < time.monotonic():
+            _evict_session_locked(session_id)
+            return None
+        session_cache.move_to_end(session_id)
+        return dict(entry)
+
+
+def get_cached_active_session(usr_index):
+    """Sesión activa más reciente del usuario si se conoce con certeza"""
+    with session_cache_lock:
+        session_id = active_session_by_user.get(usr_index)
+    if session_id is None:
+        return None
+
+    entry = get_cached_session(session_id)
+    if entry is None or entry['session_status'] != 'active':
+        return None
+    return entry
+
+
+def update_cached_session(session_id, **changes):
+    """Actualizar campos de una sesión cacheada (si está)"""
+    with session_cache_lock:
+        entry = session_cache.get(session_id)
+        if entry is not None:
+            entry.update(changes)
+
+
+def _evict_session_locked(session_id=None, usr_index=None):
+    """Invalidar una sesión y/o el índice del usuario (con el lock tomado)"""
+    if session_id is not None:
+        entry = session_cache.pop(session_id, None)
+        if entry is not None and active_session_by_user.get(entry['usr_index']) == session_id:
+            del active_session_by_user[entry['usr_index']]
+    if usr_index is not None:
+        active_session_by_user.pop(usr_index, None)
+
+
+def evict_session(session_id=None, usr_index=None):
+    """Invalidar una sesión y/o la sesión activa conocida de un usuario"""
+    with session_cache_lock:
+        _evict_session_locked(session_id, usr_index)
+
+
+def inactive_session_response(session):
+    """Respuesta de error si la sesión no existe o no está activa"""
+    if not session:
+        return jsonify({
+            'success': False,
+            'message': 'Sesión no encontrada'
+        }), 404
+
+    if session['session_status'] != 'active':
+        return jsonify({
+            'success': False,
+            'message': f"La sesión está {session['session_status']}, no se pueden agregar respuestas"
+        }), 400
+
+    return None
+
+
+def handle_session_event(payload):
+    """Procesar un NOTIFY (propio o de otro proceso)"""
+    remember_user_version(payload.get('usr_index'), payload.get('user_version'))
+    publish_session_event(payload)
+    if payload.get('origin') == PROCESS_ID:
+        return
+    evict_session(payload.get('session_id'), payload.get('usr_index'))
+
+
+def _listen_session_events(shard):
+    """Hilo que escucha los eventos de sesión de un shard"""
+    config = get_shard_map()['shards'][shard]
+    retry_seconds = 1
+    connected_before = False
+
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(**config)
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute(f"LISTEN {SESSION_EVENTS_CHANNEL}")
+            cursor.close()
+
+            # Mientras estuvimos desconectados pudimos perder avisos
+            with session_cache_lock:
+                session_cache.clear()
+                active_session_by_user.clear()
+            with user_versions_lock:
+                user_versions.clear()
+            session_listener_ready[shard] = True
+            retry_seconds = 1
+            if connected_before:
+                # Los streams SSE también pudieron perder eventos
+                drop_session_event_subscribers()
+            connected_before = True
+            print(f"[DEBUG] 👂 Escuchando eventos de sesión del shard {shard}")
+
+            while True:
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    try:
+                        handle_session_event(json.loads(notify.payload))
+                    except Exception as e:
+                        print(f"[ERROR] ❌ Evento de sesión inválido: {e}")
+
+        except Exception as e:
+            session_listener_ready[shard] = False
+            print(f"[ERROR] ❌ Listener de sesiones del shard {shard} caído: {e}")
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            time.sleep(retry_seconds)
+            retry_seconds = min(retry_seconds * 2, 30)
+
+
+def ensure_session_listeners():
+    """Arrancar (una vez por proceso) el listener de cada shard"""
+    if not SESSION_CACHE_ENABLED and not SSE_ENABLED:
+        return
+
+    for shard in get_shard_map()['shards']:
+        if shard in session_listeners:
+            continue
+        with session_cache_lock:
+            if shard in session_listeners:
+                continue
+            session_listener_ready[shard] = False
+            thread = threading.Thread(
+                target=_listen_session_events,
+                args=(shard,),
+                name=f'session-listener-{shard}',
+                daemon=True
+            )
+            session_listeners[shard] = thread
+        thread.start()
+
+
+# ============================================================================
+# VERSIONES POR USUARIO (GET CONDICIONAL)
+# ============================================================================
+#
+# Cada escritura de sesión (start / answer / end) sube la versión del
+# usuario en therapy_user_versions dentro de la misma sentencia (ver
+# sql/therapy_user_versions.sql) y la publica en el NOTIFY. resume,
+# quick-stats y active usan esa versión como ETag / Last-Modified: si el
+# cliente ya tiene la última, se responde 304 sin consultar agregados.
+#
+# La versión son los microsegundos del reloj al escribir (o la anterior + 1
+# si el reloj no avanzó): crece siempre, también si shard_tool.py mueve al
+# usuario a otro shard, y sirve directamente como Last-Modified.
+
+USER_VERSION_CLOCK_SQL = "(extract(epoch FROM clock_timestamp()) * 1000000)::bigint"
+# Versiones recordadas por proceso (se vacía al llegar al máximo)
+USER_VERSION_CACHE_MAX = 10000
+
+user_versions = {}
+user_versions_lock = threading.Lock()
+
+
+def user_version_cte(source):
+    """
+    CTE "bumped" que sube la versión de los usuarios de las filas de source
+
+    Devuelve la columna version. Si source no tiene filas (por ejemplo un
+    UPDATE que no encontró la sesión activa) no se toca nada.
+    """
+    return f"""
+                bumped AS (
+                    INSERT INTO therapy_user_versions AS v (usr_index, version)
+                    SELECT usr_index, {USER_VERSION_CLOCK_SQL} FROM {source}
+                    ON CONFLICT (usr_index) DO UPDATE
+                    SET version = GREATEST(v.version + 1, EXCLUDED.version)
+                    RETURNING version
+                )"""
+
+
+def next_user_version(current):
+    """Mismo cálculo que user_version_cte, para el almacenamiento en memoria"""
+    return max(current + 1, time.time_ns() // 1000)
+
+
+def remember_user_version(usr_index, version):
+    """Guardar la versión conocida de un usuario (nunca retrocede)"""
+    if usr_index is None or version is None:
+        return
+    with user_versions_lock:
+        if len(user_versions) >= USER_VERSION_CACHE_MAX and usr_index not in user_versions:
+            user_versions.clear()
+        if version > user_versions.get(usr_index, -1):
+            user_versions[usr_index] = version
+
+
+def get_user_version(usr_index):
+    """
+    Versión vigente de un usuario
+
+    Sale de memoria solo si el listener de su shard está escuchando (si no,
+    podríamos no enterarnos de escrituras de otros procesos).
+    """
+    if session_listener_ready.get(shard_for_user(usr_index)):
+        with user_versions_lock:
+            version = user_versions.get(usr_index)
+        if version is not None:
+            return version
+
+    version = storage.get_user_version(usr_index)
+    remember_user_version(usr_index, version)
+    return version
+
+
+def user_validators(kind, usr_index):
+    """(ETag, Last-Modified) de un recurso derivado de las sesiones del usuario"""
+    version = get_user_version(usr_index)
+    etag = f"{kind}-{usr_index}-{version}"
+    last_modified = datetime.fromtimestamp(version / 1000000, timezone.utc) if version else None
+    return etag, last_modified
+
+
+def add_validators(response, etag, last_modified):
+    """Agregar ETag / Last-Modified a una respuesta"""
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # El cliente puede guardarla pero debe revalidar cada vez
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def not_modified_response(etag, last_modified):
+    """Respuesta 304 si el cliente ya tiene esta versión, o None"""
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return add_validators(Response(status=304), etag, last_modified)
+
+
+# ============================================================================
+# EVENTOS DE SESIÓN EN VIVO (SSE)
+# ============================================================================
+#
+# La web de acompañamiento y la app de cuidadores se suscriben a
+# /therapy/user/<usr_index>/events en lugar de hacer polling. Los eventos
+# son los mismos NOTIFY que invalidan la caché: el listener de cada shard
+# (uno por proceso) los reparte entre los streams abiertos en el proceso.
+
+SSE_ENABLED = os.getenv('SSE_ENABLED', '1') == '1'
+# Streams abiertos a la vez por proceso. Cada uno ocupa un hilo del worker
+# pero no una conexión del pool (solo la toma para el snapshot):
+# gunicorn.conf.py le suma estos hilos a los que atienden requests
+SSE_MAX_STREAMS = int(os.getenv('SSE_MAX_STREAMS', 32))
+SSE_HEARTBEAT_SECONDS = float(os.getenv('SSE_HEARTBEAT_SECONDS', 15))
+# Duración máxima de un stream; el navegador reconecta solo
+SSE_MAX_SECONDS = float(os.getenv('SSE_MAX_SECONDS', 300))
+# Eventos pendientes por stream antes de darlo por perdido
+SSE_QUEUE_MAX = 100
+
+# usr_index -> suscripciones abiertas en este proceso
+session_event_subscribers = {}
+session_event_subscribers_lock = threading.Lock()
+
+
+def session_event_payload(event, session, **extra):
+    """Payload de un evento de sesión, igual al que arma session_notify_sql"""
+    payload = {'origin': PROCESS_ID, 'event': event}
+    for field in SESSION_STATE_FIELDS:
+        if field != 'started_at':
+            payload[field] = session[field]
+    payload.update(extra)
+    return payload
+
+
+def subscribe_session_events(usr_index):
+    """Abrir una suscripción o devolver None si no quedan streams libres"""
+    with session_event_subscribers_lock:
+        open_streams = sum(len(subscriptions) for subscriptions in session_event_subscribers.values())
+        if open_streams >= SSE_MAX_STREAMS:
+            return None
+        subscription = {'queue': queue.Queue(SSE_QUEUE_MAX), 'dropped': False}
+        session_event_subscribers.setdefault(usr_index, []).append(subscription)
+        return subscription
+
+
+def unsubscribe_session_events(usr_index, subscription):
+    """Cerrar una suscripción"""
+    with session_event_subscribers_lock:
+        subscriptions = session_event_subscribers.get(usr_index, [])
+        if subscription in subscriptions:
+            subscriptions.remove(subscription)
+        if not subscriptions:
+            session_event_subscribers.pop(usr_index, None)
+
+
+def publish_session_event(payload):
+    """Entregar un evento a los streams del usuario"""
+    with session_event_subscribers_lock:
+        subscriptions = list(session_event_subscribers.get(payload.get('usr_index'), []))
+    for subscription in subscriptions:
+        try:
+            subscription['queue'].put_nowait(payload)
+        except queue.Full:
+            # Cliente que no lee: se corta y al reconectar recibe un snapshot
+            subscription['dropped'] = True
+
+
+def drop_session_event_subscribers():
+    """Cortar todos los streams (pueden haber perdido eventos)"""
+    with session_event_subscribers_lock:
+        for subscriptions in session_event_subscribers.values():
+            for subscription in subscriptions:
+                subscription['dropped'] = True
+
+
+def format_sse(event, data):
+    """Un mensaje en formato text/event-stream (mismo JSON que las respuestas REST)"""
+    return f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
+
+
+def session_event_data(payload):
+    """Datos de un evento tal como los recibe el cliente"""
+    data = {key: value for key, value in payload.items() if key not in ('origin', 'event')}
+    total_questions = data.get('total_questions') or 0
+    correct_answers = data.get('correct_answers') or 0
+    data['accuracy'] = round(correct_answers / total_questions * 100, 2) if total_questions > 0 else 0
+    return data
+
+
+# ============================================================================
+# CAPA DE ALMACENAMIENTO
+# ============================================================================
+#
+# Los handlers no escriben SQL: piden los datos a `storage`. PostgresStorage
+# es el comportamiento de siempre (pool, shards, NOTIFY); MemoryStorage
+# guarda todo en diccionarios con la misma semántica y sirve para medir
+# cuánto cuesta la aplicación sin la base (ver benchmark_app.py).
+
+
+class StorageUnavailableError(Exception):
+    """No se pudo obtener una conexión al almacenamiento"""
+
+
+class DuplicateEmailError(Exception):
+    """El email ya estaba registrado al momento de insertar"""
+
+
+def pg_round(value, places):
+    """ROUND de Postgres (mitad hacia afuera) sobre un número de Python"""
+    if value is None:
+        return None
+    quantum = Decimal(1).scaleb(-places)
+    return Decimal(str(value)).quantize(quantum, rounding=ROUND_HALF_UP)
+
+
+def session_accuracy(session):
+    """Precisión de una sesión como la calcula el SQL de estadísticas"""
+    if session['total_questions'] > 0:
+        return Decimal(session['correct_answers']) / Decimal(session['total_questions']) * 100
+    return Decimal(0)
+
+
+def json_contains(container, contained):
+    """Semántica del operador @> de JSONB"""
+    if isinstance(contained, dict):
+        return isinstance(container, dict) and all(
+            key in container and json_contains(container[key], value)
+            for key, value in contained.items()
+        )
+    if isinstance(contained, list):
+        return isinstance(container, list) and all(
+            any(json_contains(item, value) for item in container)
+            for value in contained
+        )
+    return container == contained
+
+
+class PostgresStorage:
+    """Almacenamiento en Postgres, con el mismo SQL que usaban los handlers"""
+
+    name = 'postgres'
+
+    @contextmanager
+    def connection(self, shard=None):
+        """Conexión del pool (principal o de un shard) que siempre se libera"""
+        conn = get_db_connection(shard)
+        if not conn:
+            raise StorageUnavailableError('Error de conexión a la base de datos')
+        try:
+            yield conn
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            release_db_connection(conn)
+
+    def start_event_listeners(self):
+        """Escuchar NOTIFY de sesiones para invalidar la caché"""
+        ensure_session_listeners()
+
+    # ------------------------------------------------------------------ usuarios
+
+    def find_user_by_email(self, email):
+        """(usr_index, usr_name, usr_email, usr_password, usr_password_changed_at) o None"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT usr_index, usr_name, usr_email, usr_password, usr_password_changed_at
+                FROM usr_mstr 
+                WHERE usr_email = %s
+                """,
+                (email,)
+            )
+            user = cursor.fetchone()
+            cursor.close()
+            return user
+
+    def find_user_by_index(self, usr_index):
+        """(usr_index, usr_name, usr_email, usr_password, usr_password_changed_at) o None"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT usr_index, usr_name, usr_email, usr_password, usr_password_changed_at
+                FROM usr_mstr 
+                WHERE usr_index = %s
+                """,
+                (usr_index,)
+            )
+            user = cursor.fetchone()
+            cursor.close()
+            return user
+
+    def create_user(self, name, email, hashed_password):
+        """
+        Registrar un usuario y devolver su usr_index
+
+        Devuelve None si el email ya existía; si otro request lo insertó
+        en paralelo se lanza DuplicateEmailError.
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT usr_email FROM usr_mstr WHERE usr_email = %s",
+                (email,)
+            )
+            if cursor.fetchone():
+                cursor.close()
+                return None
+
+            try:
+                cursor.execute(
+                    """
+                    INSERT INTO usr_mstr (usr_name, usr_email, usr_password)
+                    VALUES (%s, %s, %s)
+                    RETURNING usr_index
+                    """,
+                    (name, email, hashed_password)
+                )
+            except psycopg2.IntegrityError as e:
+                conn.rollback()
+                raise DuplicateEmailError(str(e)) from e
+
+            usr_index = cursor.fetchone()[0]
+            conn.commit()
+            cursor.close()
+            return usr_index
+
+    def update_password_hash(self, usr_index, new_hash, old_hash):
+        """
+        Reemplazar el hash solo si nadie lo cambió mientras tanto (True si se reemplazó)
+
+        Es un rehash de la misma contraseña: se marca la transacción para que
+        el trigger no toque usr_password_changed_at (ver
+        sql/usr_password_changed_at.sql) y los tokens sigan valiendo.
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT set_config('app.password_rehash', 'on', true)")
+            cursor.execute(
+                """
+                UPDATE usr_mstr SET usr_password = %s
+                WHERE usr_index = %s AND usr_password = %s
+                """,
+                (new_hash, usr_index, old_hash)
+            )
+            updated = cursor.rowcount == 1
+            conn.commit()
+            cursor.close()
+            return updated
+
+    def get_user_names(self, usr_indexes):
+        """usr_index -> usr_name"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT usr_index, usr_name FROM usr_mstr WHERE usr_index = ANY(%s)",
+                (list(usr_indexes),)
+            )
+            names = dict(cursor.fetchall())
+            cursor.close()
+            return names
+
+    # ------------------------------------------------------------------ sesiones
+
+    def get_resume_state(self, usr_index):
+        """(sesión activa, estadísticas por tipo, categorías practicadas)"""
+        with self.connection(shard_for_user(usr_index)) as conn:
+            cursor = conn.cursor()
+            
+            # 1. Buscar sesión activa
+            cursor.execute(
+                """
+                SELECT 
+                    s.session_id,
+                    s.therapy_type,
+                    s.therapy_category,
+                    s.started_at,
+                    s.total_questions,
+                    s.correct_answers,
+                    ta.question_text as last_question,
+                    ta.answered_at as last_activity
+                FROM therapy_sessions s
+                LEFT JOIN LATERAL (
+                    SELECT question_text, answered_at
+                    FROM therapy_answers
+                    WHERE session_id = s.session_id
+                    ORDER BY answered_at DESC
+                    LIMIT 1
+                ) ta ON true
+                WHERE s.usr_index = %s 
+                AND s.session_status = 'active'
+                ORDER BY s.started_at DESC
+                LIMIT 1
+                """,
+                (usr_index,)
+            )
+            
+            active_session = cursor.fetchone()
+            
+            # 2. Obtener estadísticas generales del usuario
+            cursor.execute(
+                """
+                SELECT 
+                    therapy_type,
+                    COUNT(*) as completed_sessions,
+                    SUM(total_questions) as total_questions,
+                    SUM(correct_answers) as total_correct,
+                    ROUND(AVG(CASE 
+                        WHEN total_questions > 0 
+                        THEN (correct_answers::DECIMAL / total_questions) * 100 
+                        ELSE 0 
+                    END), 2) as avg_accuracy
+                FROM therapy_sessions
+                WHERE usr_index = %s 
+                AND session_status = 'completed'
+                GROUP BY therapy_type
+                """,
+                (usr_index,)
+            )
+            
+            user_stats = cursor.fetchall()
+            
+            # 3. Obtener categorías disponibles para cada tipo
+            cursor.execute(
+                """
+                SELECT DISTINCT therapy_type, therapy_category
+                FROM therapy_sessions
+                WHERE usr_index = %s
+                AND therapy_category IS NOT NULL
+                ORDER BY therapy_type, therapy_category
+                """,
+                (usr_index,)
+            )
+            
+            practiced_categories = cursor.fetchall()
+            cursor.close()
+            return active_session, user_stats, practiced_categories
+
+    def create_session(self, usr_index, therapy_type, therapy_category, started_at):
+        """
+        Crear una sesión activa
+
+        Devuelve (sesión, None), o (None, session_id) si el usuario ya tiene
+        una sesión activa de ese tipo.
+        """
+        with self.connection(shard_for_user(usr_index)) as conn:
+            cursor = conn.cursor()
+            
+            # Verificar si hay sesiones activas del MISMO tipo
+            cursor.execute(
+                """
+                SELECT session_id FROM therapy_sessions 
+                WHERE usr_index = %s 
+                AND therapy_type = %s 
+                AND session_status = 'active'
+                """,
+                (usr_index, therapy_type)
+            )
+            
+            active_session = cursor.fetchone()
+            if active_session:
+                cursor.close()
+                return None, active_session[0]
+            
+            # Crear nueva sesión (y avisar a los demás procesos)
+            cursor.execute(
+                f"""
+                WITH inserted AS (
+                    INSERT INTO therapy_sessions 
+                    (usr_index, therapy_type, therapy_category, started_at, session_status)
+                    VALUES (%s, %s, %s, %s, 'active')
+                    RETURNING session_id, usr_index, session_status, therapy_type, therapy_category,
+                              started_at, total_questions, correct_answers, current_question_index
+                ),
+                {user_version_cte('inserted')}
+                SELECT session_id, usr_index, session_status, therapy_type, therapy_category,
+                       started_at, total_questions, correct_answers, current_question_index,
+                       version, {session_notify_sql('started')}
+                FROM inserted, bumped
+                """,
+                (usr_index, therapy_type, therapy_category, started_at, PROCESS_ID)
+            )
+            
+            row = cursor.fetchone()
+            conn.commit()
+            cursor.close()
+            remember_user_version(usr_index, row[len(SESSION_STATE_FIELDS)])
+            return dict(zip(SESSION_STATE_FIELDS, row)), None
+
+    def _fetch_session_state(self, cursor, session_id):
+        """Estado de una sesión en el formato de la caché"""
         cursor.execute(
             """
-            SELECT 
-                s.session_id,
-                s.therapy_type,
-                s.therapy_category,
-                s.started_at,
-                s.total_questions,
-                s.correct_answers,
-                ta.question_text as last_question,
-                ta.answered_at as last_activity
-            FROM therapy_sessions s
-            LEFT JOIN LATERAL (
-                SELECT question_text, answered_at
-                FROM therapy_answers
-                WHERE session_id = s.session_id
-                ORDER BY answered_at DESC
-                LIMIT 1
-            ) ta ON true
-            WHERE s.usr_index = %s 
-            AND s.session_status = 'active'
-            ORDER BY s.started_at DESC
-            LIMIT 1
+            SELECT session_id, usr_index, session_status, therapy_type, therapy_category,
+                   started_at, total_questions, correct_answers, current_question_index
+            FROM therapy_sessions 
+            WHERE session_id = %s
             """,
-            (usr_index,)
+            (session_id,)
+        )
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return dict(zip(SESSION_STATE_FIELDS, row))
+
+    def get_session_state(self, session_id):
+        """Estado de una sesión o None si no existe"""
+        with self.connection(shard_for_session(session_id)) as conn:
+            cursor = conn.cursor()
+            session = self._fetch_session_state(cursor, session_id)
+            cursor.close()
+            return session
+
+    def record_answer(self, session_id, answer, category=None, next_question_index=None, validate=True):
+        """
+        Guardar una respuesta y actualizar los contadores de la sesión
+
+        Devuelve (sesión, progreso). `sesión` es el estado leído al validar
+        (None si validate=False o si no existe). `progreso` es None cuando
+        la sesión no existe o no está activa.
+        """
+        with self.connection(shard_for_session(session_id)) as conn:
+            cursor = conn.cursor()
+            
+            session = None
+            if validate:
+                # Verificar que la sesión existe y está activa
+                session = self._fetch_session_state(cursor, session_id)
+                if not session or session['session_status'] != 'active':
+                    cursor.close()
+                    return session, None
+            
+            # Insertar respuesta
+            cursor.execute(
+                """
+                INSERT INTO therapy_answers 
+                (session_id, question_text, expected_answer, user_answer, 
+                 pronunciation_score, is_correct, error_type, error_details, answered_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING answer_id, answered_at
+                """,
+                (
+                    session_id,
+                    answer['question_text'],
+                    answer['expected_answer'],
+                    answer['user_answer'],
+                    answer['pronunciation_score'],
+                    answer['is_correct'],
+                    answer['error_type'],
+                    Json(answer['error_details']),
+                    answer['answered_at']
+                )
+            )
+            
+            answer_id, answered_at = cursor.fetchone()
+            
+            # 🔥 CONSTRUIR UPDATE DINÁMICO PARA therapy_sessions
+            # Contadores siempre; categoría e índice solo si vienen
+            update_parts = [
+                "total_questions = total_questions + 1",
+                "correct_answers = correct_answers + CASE WHEN %s THEN 1 ELSE 0 END"
+            ]
+            update_values = [answer['is_correct']]
+            
+            if category:
+                update_parts.append("therapy_category = %s")
+                update_values.append(category)
+            
+            if next_question_index is not None:
+                update_parts.append("current_question_index = %s")
+                update_values.append(next_question_index)
+            
+            # La condición sobre session_status protege de sesiones que otro
+            # proceso terminó mientras la teníamos en caché
+            update_query = f"""
+                WITH updated AS (
+                    UPDATE therapy_sessions 
+                    SET {', '.join(update_parts)}
+                    WHERE session_id = %s AND session_status = 'active'
+                    RETURNING session_id, usr_index, session_status, therapy_type, therapy_category,
+                              total_questions, correct_answers, current_question_index
+                ),
+                {user_version_cte('updated')}
+                SELECT total_questions, correct_answers, therapy_category, current_question_index,
+                       usr_index, version,
+                       {session_notify_sql('answer', ('answer_id', 'is_correct'))}
+                FROM updated, bumped
+            """
+            update_values.extend([session_id, PROCESS_ID, answer_id, answer['is_correct']])
+            cursor.execute(update_query, tuple(update_values))
+            updated = cursor.fetchone()
+            
+            if not updated:
+                conn.rollback()
+                session = self._fetch_session_state(cursor, session_id)
+                cursor.close()
+                return session, None
+            
+            conn.commit()
+            cursor.close()
+            
+            total_questions, correct_answers, therapy_category, current_question_index, usr_index, version, _ = updated
+            remember_user_version(usr_index, version)
+            return session, {
+                'answer_id': answer_id,
+                'answered_at': answered_at,
+                'total_questions': total_questions,
+                'correct_answers': correct_answers,
+                'therapy_category': therapy_category,
+                'current_question_index': current_question_index
+            }
+
+    def get_latest_active_session(self, usr_index):
+        """Sesión activa más reciente del usuario (cualquier tipo) o None"""
+        with self.connection(shard_for_user(usr_index)) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT 
+                    session_id, 
+                    usr_index,
+                    session_status,
+                    therapy_type,
+                    therapy_category, 
+                    started_at, 
+                    total_questions, 
+                    correct_answers,
+                    current_question_index
+                FROM therapy_sessions
+                WHERE usr_index = %s 
+                  AND session_status = 'active'
+                ORDER BY started_at DESC
+                LIMIT 1
+                """,
+                (usr_index,)
+            )
+            session = cursor.fetchone()
+            cursor.close()
+            if not session:
+                return None
+            return dict(zip(SESSION_STATE_FIELDS, session))
+
+    def end_session(self, session_id, status, ended_at):
+        """
+        Cerrar una sesión activa
+
+        Devuelve (session_id, therapy_type, total_questions, correct_answers,
+        started_at) o None si no existe o ya estaba cerrada.
+        """
+        with self.connection(shard_for_session(session_id)) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""
+                WITH updated AS (
+                    UPDATE therapy_sessions 
+                    SET ended_at = %s, session_status = %s
+                    WHERE session_id = %s AND session_status = 'active'
+                    RETURNING session_id, usr_index, session_status, therapy_type, therapy_category,
+                              total_questions, correct_answers, current_question_index, started_at
+                ),
+                {user_version_cte('updated')}
+                SELECT session_id, therapy_type, total_questions, correct_answers, started_at,
+                       usr_index, version, {session_notify_sql('ended')}
+                FROM updated, bumped
+                """,
+                (ended_at, status, session_id, PROCESS_ID)
+            )
+            result = cursor.fetchone()
+            if not result:
+                cursor.close()
+                return None
+            conn.commit()
+            cursor.close()
+            remember_user_version(result[5], result[6])
+            return result[:5]
+
+    def get_answer_series(self, usr_index):
+        """
+        Respuestas del usuario en forma columnar, ordenadas por answered_at
+
+        Una sola fila con un array por columna: pronunciation_score,
+        is_correct, answered_at (segundos epoch), therapy_type y
+        therapy_category de la sesión. Listas vacías si no hay respuestas.
+        """
+        with self.connection(shard_for_user(usr_index)) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT 
+                    array_agg(a.pronunciation_score::float8 ORDER BY a.answered_at, a.answer_id),
+                    array_agg(a.is_correct ORDER BY a.answered_at, a.answer_id),
+                    array_agg(extract(epoch FROM a.answered_at)::float8 ORDER BY a.answered_at, a.answer_id),
+                    array_agg(s.therapy_type ORDER BY a.answered_at, a.answer_id),
+                    array_agg(COALESCE(s.therapy_category, '') ORDER BY a.answered_at, a.answer_id)
+                FROM therapy_answers a
+                JOIN therapy_sessions s ON s.session_id = a.session_id
+                WHERE s.usr_index = %s
+                """,
+                (usr_index,)
+            )
+            row = cursor.fetchone()
+            cursor.close()
+            scores, correct, answered_at, therapy_types, categories = (column or [] for column in row)
+            return {
+                'pronunciation_score': scores,
+                'is_correct': correct,
+                'answered_at': answered_at,
+                'therapy_type': therapy_types,
+                'therapy_category': categories
+            }
+
+    def get_user_version(self, usr_index):
+        """Versión de los datos de terapia del usuario (0 si nunca escribió)"""
+        with self.connection(shard_for_user(usr_index)) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT version FROM therapy_user_versions WHERE usr_index = %s",
+                (usr_index,)
+            )
+            row = cursor.fetchone()
+            cursor.close()
+            return row[0] if row else 0
+
+    def get_quick_stats(self, usr_index):
+        """(sesiones, preguntas, correctas, precisión promedio) de las completadas"""
+        with self.connection(shard_for_user(usr_index)) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT 
+                    COUNT(*) as total_sessions,
+                    SUM(total_questions) as total_questions,
+                    SUM(correct_answers) as total_correct,
+                    ROUND(AVG(CASE 
+                        WHEN total_questions > 0 
+                        THEN (correct_answers::DECIMAL / total_questions) * 100 
+                        ELSE 0 
+                    END), 0) as avg_accuracy
+                FROM therapy_sessions
+                WHERE usr_index = %s 
+                AND session_status = 'completed'
+                """,
+                (usr_index,)
+            )
+            stats = cursor.fetchone()
+            cursor.close()
+            return stats
+
+    def get_launch_state(self, usr_index=None, email=None):
+        """
+        (usuario, estado de resume, quick stats) para el arranque de Alexa
+
+        Se busca por usr_index (token) o por email (login); el usuario es
+        (usr_index, usr_name, usr_email, usr_password, usr_password_changed_at)
+        leído de usr_mstr.
+        Cuando las sesiones del usuario están en la base principal, usuario,
+        sesión activa, estadísticas por tipo, categorías y quick stats salen
+        de una sola sentencia en una sola conexión. Con DB_SHARD_MAP usr_mstr
+        y las sesiones pueden estar en bases distintas: primero se lee el
+        usuario en la principal y después el resto en su shard. Devuelve
+        None si el usuario no existe.
+        """
+        shard = 0 if email is not None else shard_for_user(usr_index)
+        if DB_SHARD_MAP and (email is not None or get_shard_map()['shards'][shard] != DB_CONFIG):
+            user = self.find_user_by_email(email) if email is not None else self.find_user_by_index(usr_index)
+            if not user:
+                return None
+            shard = shard_for_user(user[0])
+            user_sql = """
+                SELECT %(usr_index)s AS usr_index, %(usr_name)s::text AS usr_name,
+                       %(usr_email)s::text AS usr_email, %(usr_password)s::text AS usr_password,
+                       %(usr_password_changed_at)s::timestamptz AS usr_password_changed_at
+            """
+            params = dict(zip(
+                ('usr_index', 'usr_name', 'usr_email', 'usr_password', 'usr_password_changed_at'), user
+            ))
+        elif email is not None:
+            user_sql = """
+                SELECT usr_index, usr_name, usr_email, usr_password, usr_password_changed_at
+                FROM usr_mstr
+                WHERE usr_email = %(email)s
+            """
+            params = {'email': email}
+        else:
+            user_sql = """
+                SELECT usr_index, usr_name, usr_email, usr_password, usr_password_changed_at
+                FROM usr_mstr
+                WHERE usr_index = %(usr_index)s
+            """
+            params = {'usr_index': usr_index}
+
+        with self.connection(shard) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""
+                WITH u AS ({user_sql}),
+                completed AS (
+                    SELECT 
+                        s.therapy_type,
+                        s.total_questions,
+                        s.correct_answers,
+                        CASE 
+                            WHEN s.total_questions > 0 
+                            THEN (s.correct_answers::DECIMAL / s.total_questions) * 100 
+                            ELSE 0 
+                        END AS accuracy
+                    FROM therapy_sessions s
+                    JOIN u ON u.usr_index = s.usr_index
+                    WHERE s.session_status = 'completed'
+                ),
+                by_type AS (
+                    SELECT 
+                        therapy_type,
+                        COUNT(*) AS completed_sessions,
+                        SUM(total_questions) AS total_questions,
+                        SUM(correct_answers) AS total_correct,
+                        ROUND(AVG(accuracy), 2) AS avg_accuracy
+                    FROM completed
+                    GROUP BY therapy_type
+                ),
+                categories AS (
+                    SELECT DISTINCT s.therapy_type, s.therapy_category
+                    FROM therapy_sessions s
+                    JOIN u ON u.usr_index = s.usr_index
+                    WHERE s.therapy_category IS NOT NULL
+                )
+                SELECT 
+                    u.usr_index, u.usr_name, u.usr_email, u.usr_password, u.usr_password_changed_at,
+                    a.session_id, a.therapy_type, a.therapy_category, a.started_at,
+                    a.total_questions, a.correct_answers, a.last_question, a.last_activity,
+                    bt.therapy_types, bt.completed_sessions, bt.total_questions,
+                    bt.total_correct, bt.avg_accuracy,
+                    pc.therapy_types, pc.therapy_categories,
+                    q.total_sessions, q.total_questions, q.total_correct, q.avg_accuracy
+                FROM u
+                LEFT JOIN LATERAL (
+                    SELECT 
+                        s.session_id,
+                        s.therapy_type,
+                        s.therapy_category,
+                        s.started_at,
+                        s.total_questions,
+                        s.correct_answers,
+                        ta.question_text AS last_question,
+                        ta.answered_at AS last_activity
+                    FROM therapy_sessions s
+                    LEFT JOIN LATERAL (
+                        SELECT question_text, answered_at
+                        FROM therapy_answers
+                        WHERE session_id = s.session_id
+                        ORDER BY answered_at DESC
+                        LIMIT 1
+                    ) ta ON true
+                    WHERE s.usr_index = u.usr_index 
+                    AND s.session_status = 'active'
+                    ORDER BY s.started_at DESC
+                    LIMIT 1
+                ) a ON true
+                CROSS JOIN (
+                    SELECT 
+                        array_agg(therapy_type) AS therapy_types,
+                        array_agg(completed_sessions) AS completed_sessions,
+                        array_agg(total_questions) AS total_questions,
+                        array_agg(total_correct) AS total_correct,
+                        array_agg(avg_accuracy) AS avg_accuracy
+                    FROM by_type
+                ) bt
+                CROSS JOIN (
+                    SELECT 
+                        array_agg(therapy_type ORDER BY therapy_type, therapy_category) AS therapy_types,
+                        array_agg(therapy_category ORDER BY therapy_type, therapy_category) AS therapy_categories
+                    FROM categories
+                ) pc
+                CROSS JOIN (
+                    SELECT 
+                        COUNT(*) AS total_sessions,
+                        SUM(total_questions) AS total_questions,
+                        SUM(correct_answers) AS total_correct,
+                        ROUND(AVG(accuracy), 0) AS avg_accuracy
+                    FROM completed
+                ) q
+                """,
+                params
+            )
+            row = cursor.fetchone()
+            cursor.close()
+
+        if row is None:
+            return None
+
+        # Las mismas tuplas que get_resume_state y get_quick_stats
+        active_session = row[5:13] if row[5] is not None else None
+        user_stats = list(zip(*(column or [] for column in row[13:18])))
+        practiced_categories = list(zip(row[18] or [], row[19] or []))
+        return row[0:5], (active_session, user_stats, practiced_categories), row[20:24]
+
+    # ------------------------------------------------------------------ reportes
+
+    def get_error_patterns(self, group_by, filters, min_occurrences, limit):
+        """
+        Errores agrupados por tipo (o por paciente y tipo)
+
+        filters: error_type_prefix, detail, has_keys, usr_index, date_from,
+        date_to (todos opcionales). Devuelve una lista de grupos con
+        occurrences, patients, score_sum, score_count, first_seen, last_seen.
+        """
+        conditions = ["a.error_type IS NOT NULL"]
+        values = []
+        if filters.get('error_type_prefix'):
+            conditions.append("lower(a.error_type) LIKE %s")
+            values.append(escape_like(filters['error_type_prefix'].lower()) + '%')
+        if filters.get('detail'):
+            conditions.append("a.error_details @> %s")
+            values.append(Json(filters['detail']))
+        if filters.get('has_keys'):
+            conditions.append("a.error_details ?& %s")
+            values.append(list(filters['has_keys']))
+        if filters.get('usr_index') is not None:
+            conditions.append("s.usr_index = %s")
+            values.append(filters['usr_index'])
+        if filters.get('date_from'):
+            conditions.append("a.answered_at >= %s")
+            values.append(filters['date_from'])
+        if filters.get('date_to'):
+            conditions.append("a.answered_at < %s")
+            values.append(filters['date_to'])
+
+        group_columns = "a.error_type" if group_by == 'error_type' else "s.usr_index, a.error_type"
+        query = f"""
+            SELECT 
+                {group_columns},
+                COUNT(*) as occurrences,
+                COUNT(DISTINCT s.usr_index) as patients,
+                SUM(a.pronunciation_score) as score_sum,
+                COUNT(a.pronunciation_score) as score_count,
+                MIN(a.answered_at) as first_seen,
+                MAX(a.answered_at) as last_seen
+            FROM therapy_answers a
+            JOIN therapy_sessions s ON s.session_id = a.session_id
+            WHERE {' AND '.join(conditions)}
+            GROUP BY {group_columns}
+        """
+
+        if filters.get('usr_index') is not None:
+            shards = [shard_for_user(filters['usr_index'])]
+        else:
+            shards = list(get_shard_map()['shards'])
+
+        # Por usuario cada grupo vive en un solo shard: Postgres puede
+        # filtrar y limitar. Por tipo de error se suman los parciales.
+        if group_by == 'user' or len(shards) == 1:
+            query += " HAVING COUNT(*) >= %s ORDER BY occurrences DESC LIMIT %s"
+            values.extend([min_occurrences, limit])
+
+        groups = {}
+        for shard in shards:
+            with self.connection(shard) as conn:
+                cursor = conn.cursor()
+                cursor.execute(query, tuple(values))
+                rows = cursor.fetchall()
+                cursor.close()
+
+            for row in rows:
+                key = row[:-6]
+                occurrences, patients, score_sum, score_count, first_seen, last_seen = row[-6:]
+                group = groups.get(key)
+                if group is None:
+                    groups[key] = {
+                        'usr_index': key[0] if group_by == 'user' else None,
+                        'error_type': key[-1],
+                        'occurrences': occurrences,
+                        'patients': patients,
+                        'score_sum': score_sum or 0,
+                        'score_count': score_count,
+                        'first_seen': first_seen,
+                        'last_seen': last_seen
+                    }
+                else:
+                    group['occurrences'] += occurrences
+                    group['patients'] += patients
+                    group['score_sum'] += score_sum or 0
+                    group['score_count'] += score_count
+                    group['first_seen'] = min(group['first_seen'], first_seen)
+                    group['last_seen'] = max(group['last_seen'], last_seen)
+
+        results = [group for group in groups.values() if group['occurrences'] >= min_occurrences]
+        results.sort(key=lambda group: group['occurrences'], reverse=True)
+        return results[:limit]
+
+    def list_patient_progress(self, sort_column, order, limit, filters, after=None):
+        """
+        Página del dashboard clínico desde clinic_patient_progress
+
+        filters: active, min_accuracy, max_accuracy, min_sessions,
+        active_since (opcionales). after: (valor de orden, usr_index) de la
+        última fila de la página anterior. Devuelve hasta `limit` filas
+        (tuplas en el orden de CLINIC_PROGRESS_FIELDS).
+        """
+        conditions = []
+        values = []
+        if filters.get('active') is not None:
+            conditions.append("has_active_session = %s")
+            values.append(filters['active'])
+        if filters.get('min_accuracy') is not None:
+            conditions.append("avg_accuracy >= %s")
+            values.append(filters['min_accuracy'])
+        if filters.get('max_accuracy') is not None:
+            conditions.append("avg_accuracy <= %s")
+            values.append(filters['max_accuracy'])
+        if filters.get('min_sessions') is not None:
+            conditions.append("completed_sessions >= %s")
+            values.append(filters['min_sessions'])
+        if filters.get('active_since') is not None:
+            conditions.append("last_activity >= %s")
+            values.append(filters['active_since'])
+        if after is not None:
+            comparison = '<' if order == 'desc' else '>'
+            conditions.append(f"({sort_column}, usr_index) {comparison} (%s, %s)")
+            values.extend(after)
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        direction = order.upper()
+        query = f"""
+            SELECT {', '.join(CLINIC_PROGRESS_FIELDS)}
+            FROM clinic_patient_progress
+            {where}
+            ORDER BY {sort_column} {direction}, usr_index {direction}
+            LIMIT %s
+        """
+
+        # Cada shard devuelve su página ya ordenada; se mezclan en Python
+        shard_pages = []
+        for shard in get_shard_map()['shards']:
+            with self.connection(shard) as conn:
+                cursor = conn.cursor()
+                cursor.execute(query, tuple(values) + (limit,))
+                shard_pages.append(cursor.fetchall())
+                cursor.close()
+
+        sort_position = CLINIC_PROGRESS_FIELDS.index(sort_column)
+        rows = heapq.merge(
+            *shard_pages,
+            key=lambda row: (row[sort_position], row[0]),
+            reverse=(order == 'desc')
         )
+        return list(rows)[:limit]
+
+    def refresh_clinic_views(self):
+        """
+        Refrescar la vista del dashboard en todos los shards
+
+        Usa una conexión directa (no del pool) porque el refresh puede tardar
+        más que DB_CONN_LEAK_SECONDS. Cada worker de cada instancia tiene su
+        hilo de refresco: bajo el advisory lock se consulta
+        clinic_view_refresh_log y si otro proceso ya refrescó en este
+        intervalo no se hace nada, así la vista se refresca una vez por
+        intervalo y no una por proceso.
+        """
+        for shard, config in get_shard_map()['shards'].items():
+            conn = None
+            try:
+                conn = psycopg2.connect(**config)
+                cursor = conn.cursor()
+                cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (CLINIC_REFRESH_LOCK_KEY,))
+                if not cursor.fetchone()[0]:
+                    print(f"[DEBUG] Refresh del shard {shard} en curso en otro proceso")
+                    conn.rollback()
+                    continue
+
+                # Margen del 10% para que el proceso que refrescó no se salte su turno
+                cursor.execute(
+                    """
+                    SELECT refreshed_at > now() - make_interval(secs => %s)
+                    FROM clinic_view_refresh_log
+                    WHERE view_name = 'clinic_patient_progress'
+                    """,
+                    (CLINIC_REFRESH_SECONDS * 0.9,)
+                )
+                row = cursor.fetchone()
+                if row and row[0]:
+                    print(f"[DEBUG] Vista clínica del shard {shard} ya refrescada por otro proceso")
+                    conn.rollback()
+                    continue
+
+                start = time.perf_counter()
+                cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY clinic_patient_progress")
+                cursor.execute(
+                    """
+                    INSERT INTO clinic_view_refresh_log (view_name, refreshed_at)
+                    VALUES ('clinic_patient_progress', now())
+                    ON CONFLICT (view_name) DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at
+                    """
+                )
+                conn.commit()
+                print(f"[DEBUG] ✅ Vista clínica del shard {shard} refrescada en {time.perf_counter() - start:.2f}s")
+
+            except Exception as e:
+                print(f"[ERROR] ❌ Error al refrescar vista clínica del shard {shard}: {e}")
+                if conn:
+                    conn.rollback()
+            finally:
+                if conn:
+                    conn.close()
+
+
+class MemoryStorage:
+    """
+    Almacenamiento en memoria con la misma semántica que PostgresStorage
+
+    Un solo proceso, sin persistencia. Un RLock serializa cada operación,
+    como lo haría una transacción.
+    """
+
+    name = 'memory'
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users = {}
+        self.users_by_email = {}
+        self.sessions = {}
+        self.answers_by_session = {}
+        self.user_versions = {}
+        self.next_usr_index = 1
+        self.next_session_id = 1
+        self.next_answer_id = 1
+
+    def start_event_listeners(self):
+        """No hay otros procesos: la caché de sesiones siempre es válida"""
+        for shard in get_shard_map()['shards']:
+            session_listener_ready[shard] = True
+
+    def _bump_user_version(self, usr_index):
+        version = next_user_version(self.user_versions.get(usr_index, 0))
+        self.user_versions[usr_index] = version
+        remember_user_version(usr_index, version)
+        return version
+
+    def get_user_version(self, usr_index):
+        with self.lock:
+            return self.user_versions.get(usr_index, 0)
+
+    # ------------------------------------------------------------------ usuarios
+
+    def find_user_by_email(self, email):
+        with self.lock:
+            user = self.users_by_email.get(email)
+            if not user:
+                return None
+            return (
+                user['usr_index'], user['usr_name'], user['usr_email'],
+                user['usr_password'], user['usr_password_changed_at']
+            )
+
+    def find_user_by_index(self, usr_index):
+        with self.lock:
+            user = self.users.get(usr_index)
+            if not user:
+                return None
+            return (
+                user['usr_index'], user['usr_name'], user['usr_email'],
+                user['usr_password'], user['usr_password_changed_at']
+            )
+
+    def create_user(self, name, email, hashed_password):
+        with self.lock:
+            if email in self.users_by_email:
+                return None
+            user = {
+                'usr_index': self.next_usr_index,
+                'usr_name': name,
+                'usr_email': email,
+                'usr_password': hashed_password,
+                'usr_password_changed_at': datetime.now(timezone.utc)
+            }
+            self.next_usr_index += 1
+            self.users[user['usr_index']] = user
+            self.users_by_email[email] = user
+            return user['usr_index']
+
+    def update_password_hash(self, usr_index, new_hash, old_hash):
+        with self.lock:
+            user = self.users.get(usr_index)
+            if user and user['usr_password'] == old_hash:
+                # Misma contraseña: usr_password_changed_at no cambia
+                user['usr_password'] = new_hash
+                return True
+            return False
+
+    def get_user_names(self, usr_indexes):
+        with self.lock:
+            return {
+                usr_index: self.users[usr_index]['usr_name']
+                for usr_index in usr_indexes if usr_index in self.users
+            }
+
+    # ------------------------------------------------------------------ sesiones
+
+    def _user_sessions(self, usr_index):
+        return [session for session in self.sessions.values() if session['usr_index'] == usr_index]
+
+    def _latest_active(self, usr_index, therapy_type=None):
+        active = [
+            session for session in self._user_sessions(usr_index)
+            if session['session_status'] == 'active'
+            and (therapy_type is None or session['therapy_type'] == therapy_type)
+        ]
+        if not active:
+            return None
+        return max(active, key=lambda session: session['started_at'])
+
+    def _state(self, session):
+        return {field: session[field] for field in SESSION_STATE_FIELDS}
+
+    def get_resume_state(self, usr_index):
+        with self.lock:
+            sessions = self._user_sessions(usr_index)
+
+            active_session = None
+            active = self._latest_active(usr_index)
+            if active:
+                answers = self.answers_by_session.get(active['session_id'], [])
+                last_answer = max(answers, key=lambda answer: answer['answered_at']) if answers else None
+                active_session = (
+                    active['session_id'],
+                    active['therapy_type'],
+                    active['therapy_category'],
+                    active['started_at'],
+                    active['total_questions'],
+                    active['correct_answers'],
+                    last_answer['question_text'] if last_answer else None,
+                    last_answer['answered_at'] if last_answer else None
+                )
+
+            by_type = {}
+            for session in sessions:
+                if session['session_status'] == 'completed':
+                    by_type.setdefault(session['therapy_type'], []).append(session)
+            user_stats = [
+                (
+                    therapy_type,
+                    len(completed),
+                    sum(session['total_questions'] for session in completed),
+                    sum(session['correct_answers'] for session in completed),
+                    pg_round(sum(session_accuracy(session) for session in completed) / len(completed), 2)
+                )
+                for therapy_type, completed in by_type.items()
+            ]
+
+            practiced_categories = sorted({
+                (session['therapy_type'], session['therapy_category'])
+                for session in sessions if session['therapy_category'] is not None
+            })
+
+            return active_session, user_stats, practiced_categories
+
+    def create_session(self, usr_index, therapy_type, therapy_category, started_at):
+        with self.lock:
+            existing = self._latest_active(usr_index, therapy_type)
+            if existing:
+                return None, existing['session_id']
+
+            session = {
+                'session_id': self.next_session_id,
+                'usr_index': usr_index,
+                'session_status': 'active',
+                'therapy_type': therapy_type,
+                'therapy_category': therapy_category,
+                'started_at': started_at,
+                'ended_at': None,
+                'total_questions': 0,
+                'correct_answers': 0,
+                'current_question_index': 0
+            }
+            self.next_session_id += 1
+            self.sessions[session['session_id']] = session
+            self.answers_by_session[session['session_id']] = []
+            version = self._bump_user_version(usr_index)
+            publish_session_event(session_event_payload('started', session, user_version=version))
+            return self._state(session), None
+
+    def get_session_state(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            return self._state(session) if session else None
+
+    def record_answer(self, session_id, answer, category=None, next_question_index=None, validate=True):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            state = self._state(session) if session else None
+            if not session or session['session_status'] != 'active':
+                return state, None
+
+            stored = dict(answer, answer_id=self.next_answer_id, session_id=session_id)
+            self.next_answer_id += 1
+            self.answers_by_session[session_id].append(stored)
+
+            session['total_questions'] += 1
+            if answer['is_correct']:
+                session['correct_answers'] += 1
+            if category:
+                session['therapy_category'] = category
+            if next_question_index is not None:
+                session['current_question_index'] = next_question_index
+
+            version = self._bump_user_version(session['usr_index'])
+            publish_session_event(session_event_payload(
+                'answer', session, user_version=version,
+                answer_id=stored['answer_id'], is_correct=answer['is_correct']
+            ))
+            return (state if validate else None), {
+                'answer_id': stored['answer_id'],
+                'answered_at': stored['answered_at'],
+                'total_questions': session['total_questions'],
+                'correct_answers': session['correct_answers'],
+                'therapy_category': session['therapy_category'],
+                'current_question_index': session['current_question_index']
+            }
+
+    def get_latest_active_session(self, usr_index):
+        with self.lock:
+            session = self._latest_active(usr_index)
+            return self._state(session) if session else None
+
+    def end_session(self, session_id, status, ended_at):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if not session or session['session_status'] != 'active':
+                return None
+            session['session_status'] = status
+            session['ended_at'] = ended_at
+            version = self._bump_user_version(session['usr_index'])
+            publish_session_event(session_event_payload('ended', session, user_version=version))
+            return (
+                session['session_id'],
+                session['therapy_type'],
+                session['total_questions'],
+                session['correct_answers'],
+                session['started_at']
+            )
+
+    def get_answer_series(self, usr_index):
+        with self.lock:
+            rows = []
+            for session in self._user_sessions(usr_index):
+                for answer in self.answers_by_session.get(session['session_id'], []):
+                    rows.append((answer, session))
+            rows.sort(key=lambda row: (row[0]['answered_at'], row[0]['answer_id']))
+            return {
+                'pronunciation_score': [
+                    None if answer['pronunciation_score'] is None else float(answer['pronunciation_score'])
+                    for answer, _ in rows
+                ],
+                'is_correct': [answer['is_correct'] for answer, _ in rows],
+                # extract(epoch FROM timestamp) de Postgres: la hora local como si fuera UTC
+                'answered_at': [(answer['answered_at'] - EPOCH).total_seconds() for answer, _ in rows],
+                'therapy_type': [session['therapy_type'] for _, session in rows],
+                'therapy_category': [session['therapy_category'] or '' for _, session in rows]
+            }
+
+    def get_quick_stats(self, usr_index):
+        with self.lock:
+            completed = [
+                session for session in self._user_sessions(usr_index)
+                if session['session_status'] == 'completed'
+            ]
+            if not completed:
+                # Igual que COUNT/SUM/AVG de Postgres sin filas
+                return (0, None, None, None)
+            return (
+                len(completed),
+                sum(session['total_questions'] for session in completed),
+                sum(session['correct_answers'] for session in completed),
+                pg_round(sum(session_accuracy(session) for session in completed) / len(completed), 0)
+            )
+
+    def get_launch_state(self, usr_index=None, email=None):
+        with self.lock:
+            if email is not None:
+                user = self.find_user_by_email(email)
+            else:
+                user = self.find_user_by_index(usr_index)
+            if not user:
+                return None
+            return user, self.get_resume_state(user[0]), self.get_quick_stats(user[0])
+
+    # ------------------------------------------------------------------ reportes
+
+    def get_error_patterns(self, group_by, filters, min_occurrences, limit):
+        with self.lock:
+            prefix = (filters.get('error_type_prefix') or '').lower()
+            groups = {}
+            for session_id, answers in self.answers_by_session.items():
+                usr_index = self.sessions[session_id]['usr_index']
+                if filters.get('usr_index') is not None and usr_index != filters['usr_index']:
+                    continue
+                for answer in answers:
+                    error_type = answer['error_type']
+                    details = answer['error_details']
+                    if error_type is None or not error_type.lower().startswith(prefix):
+                        continue
+                    if filters.get('detail') and not json_contains(details, filters['detail']):
+                        continue
+                    if filters.get('has_keys') and not (
+                        isinstance(details, dict) and all(key in details for key in filters['has_keys'])
+                    ):
+                        continue
+                    if filters.get('date_from') and answer['answered_at'] < filters['date_from']:
+                        continue
+                    if filters.get('date_to') and answer['answered_at'] >= filters['date_to']:
+                        continue
+
+                    key = (error_type,) if group_by == 'error_type' else (usr_index, error_type)
+                    group = groups.setdefault(key, {
+                        'usr_index': usr_index if group_by == 'user' else None,
+                        'error_type': error_type,
+                        'occurrences': 0,
+                        'patients': set(),
+                        'score_sum': 0,
+                        'score_count': 0,
+                        'first_seen': answer['answered_at'],
+                        'last_seen': answer['answered_at']
+                    })
+                    group['occurrences'] += 1
+                    group['patients'].add(usr_index)
+                    if answer['pronunciation_score'] is not None:
+                        group['score_sum'] += answer['pronunciation_score']
+                        group['score_count'] += 1
+                    group['first_seen'] = min(group['first_seen'], answer['answered_at'])
+                    group['last_seen'] = max(group['last_seen'], answer['answered_at'])
+
+            results = []
+            for group in groups.values():
+                if group['occurrences'] >= min_occurrences:
+                    results.append(dict(group, patients=len(group['patients'])))
+            results.sort(key=lambda group: group['occurrences'], reverse=True)
+            return results[:limit]
+
+    def list_patient_progress(self, sort_column, order, limit, filters, after=None):
+        with self.lock:
+            by_user = {}
+            for session in self.sessions.values():
+                by_user.setdefault(session['usr_index'], []).append(session)
+
+            rows = []
+            for usr_index, sessions in by_user.items():
+                completed = [session for session in sessions if session['session_status'] == 'completed']
+                avg_accuracy = Decimal(0)
+                if completed:
+                    avg_accuracy = pg_round(sum(session_accuracy(session) for session in completed) / len(completed), 2)
+                rows.append((
+                    usr_index,
+                    len(completed),
+                    sum(session['total_questions'] for session in completed),
+                    sum(session['correct_answers'] for session in completed),
+                    avg_accuracy,
+                    max(session['ended_at'] or session['started_at'] for session in sessions),
+                    any(session['session_status'] == 'active' for session in sessions)
+                ))
+
+            position = CLINIC_PROGRESS_FIELDS.index(sort_column)
+            descending = order == 'desc'
+
+            def matches(row):
+                if filters.get('active') is not None and row[6] != filters['active']:
+                    return False
+                if filters.get('min_accuracy') is not None and row[4] < Decimal(str(filters['min_accuracy'])):
+                    return False
+                if filters.get('max_accuracy') is not None and row[4] > Decimal(str(filters['max_accuracy'])):
+                    return False
+                if filters.get('min_sessions') is not None and row[1] < filters['min_sessions']:
+                    return False
+                if filters.get('active_since') is not None and row[5] < filters['active_since']:
+                    return False
+                if after is not None:
+                    key = (row[position], row[0])
+                    after_key = (type(row[position])(after[0]) if position == 4 else after[0], after[1])
+                    if (descending and key >= after_key) or (not descending and key <= after_key):
+                        return False
+                return True
+
+            rows = [row for row in rows if matches(row)]
+            rows.sort(key=lambda row: (row[position], row[0]), reverse=descending)
+            return rows[:limit]
+
+    def refresh_clinic_views(self):
+        """En memoria el listado se calcula al vuelo"""
+        return None
+
+
+STORAGE_BACKENDS = {
+    'postgres': PostgresStorage,
+    'memory': MemoryStorage
+}
+if STORAGE_BACKEND not in STORAGE_BACKENDS:
+    raise ValueError(f"STORAGE_BACKEND desconocido: {STORAGE_BACKEND}")
+storage = STORAGE_BACKENDS[STORAGE_BACKEND]()
+
+
+@app.before_request
+def start_session_listeners():
+    """Los listeners arrancan con el primer request de cada proceso"""
+    storage.start_event_listeners()
+
+# ============================================================================
+# ENDPOINTS PARA GESTIÓN DE SESIONES DE TERAPIA
+# ============================================================================
+
+def resume_payload(active_session, user_stats, practiced_categories):
+    """Documento de /resume a partir de storage.get_resume_state"""
+    response_data = {
+        'has_active_session': False,
+        'user_statistics': {},
+        'practiced_categories': {},
+        'recommendation': None
+    }
+
+    # Si hay sesión activa
+    if active_session:
+        session_id, therapy_type, therapy_category, started_at, total_questions, correct_answers, last_question, last_activity = active_session
+        
+        accuracy = (correct_answers / total_questions * 100) if total_questions > 0 else 0
+        
+        response_data['has_active_session'] = True
+        response_data['active_session'] = {
+            'session_id': session_id,
+            'therapy_type': therapy_type,
+            'therapy_category': therapy_category,
+            'started_at': started_at,
+            'last_question': last_question,
+            'last_activity': last_activity,
+            'total_questions': total_questions,
+            'correct_answers': correct_answers,
+            'accuracy': round(accuracy, 2)
+        }
+        
+        print(f"[DEBUG] ✅ Sesión activa encontrada: {session_id}")
+        print(f"[DEBUG] Última actividad: {last_activity}")
+
+    # Estadísticas por tipo de terapia
+    stats_dict = {}
+    for stat in user_stats:
+        stats_dict[stat[0]] = {
+            'completed_sessions': stat[1],
+            'total_questions': stat[2],
+            'total_correct': stat[3],
+            'avg_accuracy': stat[4]
+        }
+
+    response_data['user_statistics'] = stats_dict
+
+    # Categorías practicadas
+    categories_dict = {'palabras': [], 'números': []}
+    for category in practiced_categories:
+        if category[0] in categories_dict:
+            categories_dict[category[0]].append(category[1])
+
+    response_data['practiced_categories'] = categories_dict
+
+    # Generar recomendación si no hay sesión activa
+    if not active_session:
+        if not stats_dict:
+            response_data['recommendation'] = {
+                'therapy_type': 'palabras',
+                'therapy_category': 'adjetivos',
+                'reason': 'first_time'
+            }
+        else:
+            # Recomendar el tipo con menor precisión
+            lowest_type = min(stats_dict.items(), key=lambda x: x[1]['avg_accuracy'])
+            response_data['recommendation'] = {
+                'therapy_type': lowest_type[0],
+                'reason': 'needs_practice',
+                'current_accuracy': lowest_type[1]['avg_accuracy']
+            }
+
+    return response_data
+
+
+@app.route('/therapy/user/<int:usr_index>/resume', methods=['GET'])
+def get_user_therapy_resume(usr_index):
+    """
+    Obtiene el estado actual de las terapias del usuario para reanudar
+    
+    Retorna:
+    - Sesión activa si existe
+    - Última palabra/pregunta que estaba practicando
+    - Progreso general del usuario
+    - Siguiente ejercicio recomendado
+    
+    Este endpoint se llama cuando el usuario inicia la skill
+    """
+    print("\n" + "="*50)
+    print(f"[DEBUG] 🔄 Consultando estado de terapias para usuario {usr_index}")
+    print(f"[DEBUG] Timestamp: {datetime.now()}")
+    
+    try:
+        # Si el cliente ya tiene la versión vigente no hace falta consultar nada más
+        etag, last_modified = user_validators('resume', usr_index)
+        not_modified = not_modified_response(etag, last_modified)
+        if not_modified:
+            print("[DEBUG] ⚡ Sin cambios desde la última consulta (304)")
+            return not_modified
+        
+        active_session, user_stats, practiced_categories = storage.get_resume_state(usr_index)
+        response_data = resume_payload(active_session, user_stats, practiced_categories)
+        
+        print(f"[DEBUG] ✅ Estado consultado exitosamente")
+        print("="*50 + "\n")
+        
+        return add_validators(jsonify({
+            'success': True,
+            'data': response_data
+        }), etag, last_modified), 200
+        
+    except StorageUnavailableError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+        
+    except Exception as e:
+        print(f"[ERROR] ❌ Error: {e}")
+        return jsonify({
+            'success': False,
+            'message': f'Error al consultar estado: {str(e)}'
+        }), 500
+
+@app.route('/therapy/session/start', methods=['POST'])
+def start_therapy_session():
+    """
+    Inicia una nueva sesión de terapia
+    
+    Body esperado:
+    {
+        "usr_index": 1,
+        "therapy_type": "palabras",  // o "números"
+        "therapy_category": "adjetivos"  // opcional
+    }
+    
+    LLAMAR desde Alexa cuando:
+    - Usuario dice "empezar terapia de palabras/números"
+    - Usuario selecciona una categoría específica
+    """
+    print("\n" + "="*50)
+    print("[DEBUG] 🎯 Iniciando nueva sesión de terapia")
+    print(f"[DEBUG] Timestamp: {datetime.now()}")
+    
+    try:
+        data = request.get_json()
+        print(f"[DEBUG] Datos recibidos: {data}")
+        
+        usr_index = data.get('usr_index')
+        therapy_type = data.get('therapy_type')
+        therapy_category = data.get('therapy_category')
+        
+        # Validaciones
+        if not usr_index or not therapy_type:
+            print("[ERROR] ❌ Campos requeridos faltantes")
+            return jsonify({
+                'success': False,
+                'message': 'usr_index y therapy_type son requeridos'
+            }), 400
+        
+        if therapy_type not in ['palabras', 'números']:
+            print("[ERROR] ❌ Tipo de terapia inválido")
+            return jsonify({
+                'success': False,
+                'message': 'therapy_type debe ser "palabras" o "números"'
+            }), 400
+        
+        if user_writes_blocked(usr_index):
+            print(f"[ERROR] ⚠️ Usuario {usr_index} en migración de shard, sesión rechazada")
+            return jsonify({
+                'success': False,
+                'message': 'Tus datos se están moviendo, intenta de nuevo en unos segundos'
+            }), 503, {'Retry-After': str(int(SHARD_MAP_RELOAD_SECONDS) * 2 + 2)}
+        
+        session, existing_session_id = storage.create_session(
+            usr_index, therapy_type, therapy_category, datetime.now()
+        )
+        
+        if existing_session_id is not None:
+            print(f"[DEBUG] ⚠️ Ya existe sesión activa: {existing_session_id}")
+            return jsonify({
+                'success': False,
+                'message': 'Ya tienes una sesión activa de este tipo',
+                'active_session_id': existing_session_id,
+                'should_resume': True
+            }), 409
+        
+        cache_session(session, is_latest_active=True)
+        session_id = session['session_id']
+        started_at = session['started_at']
+        
+        print(f"[DEBUG] ✅ Sesión creada exitosamente: {session_id}")
+        print("="*50 + "\n")
+        
+        return jsonify({
+            'success': True,
+            'message': 'Sesión de terapia iniciada',
+            'data': {
+                'session_id': session_id,
+                'therapy_type': therapy_type,
+                'therapy_category': therapy_category,
+                'started_at': started_at
+            }
+        }), 201
+        
+    except StorageUnavailableError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+        
+    except Exception as e:
+        print(f"[ERROR] ❌ Error: {e}")
+        return jsonify({
+            'success': False,
+            'message': f'Error al crear sesión: {str(e)}'
+        }), 500
+
+@app.route('/therapy/session/<int:session_id>/answer', methods=['POST'])
+def record_therapy_answer(session_id):
+    """
+    Registra una respuesta individual durante la sesión
+    
+    Body esperado:
+    {
+        "question_text": "perro",
+        "expected_answer": "perro",
+        "user_answer": "pero",
+        "pronunciation_score": 75,
+        "is_correct": false,
+        "error_type": "substitution_r_to_",
+        "error_details": {...},
+        "current_question_index": 5,        # Índice actual (i o j-2)
+        "next_question_index": 6,           # Siguiente índice
+        "category": "animales"              # Opcional
+    }
+    """
+    print("\n" + "="*50)
+    print(f"[DEBUG] 📝 Registrando respuesta para sesión {session_id}")
+    print(f"[DEBUG] Timestamp: {datetime.now()}")
+    
+    try:
+        data = request.get_json()
+        print(f"[DEBUG] Respuesta: {data.get('user_answer')} (esperado: {data.get('expected_answer')})")
+        print(f"[DEBUG] Score: {data.get('pronunciation_score')}")
+        
+        # Mostrar índices y categoría si vienen
+        if 'current_question_index' in data:
+            print(f"[DEBUG] Índice actual: {data.get('current_question_index')}")
+        if 'next_question_index' in data:
+            print(f"[DEBUG] Siguiente índice: {data.get('next_question_index')}")
+        if 'category' in data:
+            print(f"[DEBUG] Categoría: {data.get('category')}")
+        
+        # Validaciones
+        required_fields = ['question_text', 'expected_answer', 'user_answer', 
+                          'pronunciation_score', 'is_correct']
+        
+        for field in required_fields:
+            if field not in data:
+                return jsonify({
+                    'success': False,
+                    'message': f'Campo requerido faltante: {field}'
+                }), 400
+        
+        # El índice se usa tal cual para elegir la pregunta del catálogo
+        next_question_index = data.get('next_question_index')
+        if next_question_index is not None and (
+            not isinstance(next_question_index, int)
+            or isinstance(next_question_index, bool)
+            or next_question_index < 0
+        ):
+            return jsonify({
+                'success': False,
+                'message': 'next_question_index debe ser un entero mayor o igual a 0'
+            }), 400
+        
+        # Si la sesión está activa en caché nos ahorramos la validación
+        cached_session = get_cached_session(session_id)
+        validate = cached_session is None or cached_session['session_status'] != 'active'
+        if not validate:
+            print("[DEBUG] ⚡ Sesión activa en caché, se omite la validación")
         
-        active_session = cursor.fetchone()
+        if data.get('category'):
+            print(f"[DEBUG] Actualizando categoría a: {data['category']}")
+        if next_question_index is not None:
+            print(f"[DEBUG] Actualizando índice a: {next_question_index}")
         
-        # 2. Obtener estadísticas generales del usuario
-        cursor.execute(
-            """
-            SELECT 
-                therapy_type,
-                COUNT(*) as completed_sessions,
-                SUM(total_questions) as total_questions,
-                SUM(correct_answers) as total_correct,
-                ROUND(AVG(CASE 
-                    WHEN total_questions > 0 
-                    THEN (correct_answers::DECIMAL / total_questions) * 100 
-                    ELSE 0 
-                END), 2) as avg_accuracy
-            FROM therapy_sessions
-            WHERE usr_index = %s 
-            AND session_status = 'completed'
-            GROUP BY therapy_type
-            """,
-            (usr_index,)
+        session, progress = storage.record_answer(
+            session_id,
+            {
+                'question_text': data['question_text'],
+                'expected_answer': data['expected_answer'],
+                'user_answer': data['user_answer'],
+                'pronunciation_score': data['pronunciation_score'],
+                'is_correct': data['is_correct'],
+                'error_type': data.get('error_type'),
+                'error_details': data.get('error_details', {}),
+                'answered_at': datetime.now()
+            },
+            category=data.get('category'),
+            next_question_index=next_question_index,
+            validate=validate
         )
         
-        user_stats = cursor.fetchall()
+        if progress is None:
+            evict_session(session_id)
+            return inactive_session_response(session) or (jsonify({
+                'success': False,
+                'message': 'La sesión cambió mientras se registraba la respuesta, intenta de nuevo'
+            }), 409)
         
-        # 3. Obtener categorías disponibles para cada tipo
-        cursor.execute(
-            """
-            SELECT DISTINCT therapy_type, therapy_category
-            FROM therapy_sessions
-            WHERE usr_index = %s
-            AND therapy_category IS NOT NULL
-            ORDER BY therapy_type, therapy_category
-            """,
-            (usr_index,)
-        )
+        print(f"[DEBUG] ✅ Sesión actualizada")
         
-        practiced_categories = cursor.fetchall()
+        if session is not None:
+            cache_session(session)
+        answer_id = progress['answer_id']
+        answered_at = progress['answered_at']
+        total_questions = progress['total_questions']
+        correct_answers = progress['correct_answers']
+        update_cached_session(
+            session_id,
+            total_questions=total_questions,
+            correct_answers=correct_answers,
+            therapy_category=progress['therapy_category'],
+            current_question_index=progress['current_question_index']
+        )
         
-        cursor.close()
-        release_db_connection(conn)
+        accuracy = (correct_answers / total_questions * 100) if total_questions > 0 else 0
         
-        # Formatear respuesta
-        response_data = {
-            'has_active_session': False,
-            'user_statistics': {},
-            'practiced_categories': {},
-            'recommendation': None
-        }
+        print(f"[DEBUG] ✅ Respuesta registrada: {answer_id}")
+        print(f"[DEBUG] Progreso: {correct_answers}/{total_questions} ({accuracy:.1f}%)")
+        print("="*50 + "\n")
         
-        # Si hay sesión activa
-        if active_session:
-            session_id, therapy_type, therapy_category, started_at, total_questions, correct_answers, last_question, last_activity = active_session
-            
-            accuracy = (correct_answers / total_questions * 100) if total_questions > 0 else 0
-            
-            response_data['has_active_session'] = True
-            response_data['active_session'] = {
+        return jsonify({
+            'success': True,
+            'message': 'Respuesta registrada exitosamente',
+            'data': {
+                'answer_id': answer_id,
                 'session_id': session_id,
-                'therapy_type': therapy_type,
-                'therapy_category': therapy_category,
-                'started_at': started_at.isoformat(),
-                'last_question': last_question,
-                'last_activity': last_activity.isoformat() if last_activity else None,
-                'total_questions': total_questions,
-                'correct_answers': correct_answers,
-                'accuracy': round(accuracy, 2)
-            }
-            
-            print(f"[DEBUG] ✅ Sesión activa encontrada: {session_id}")
-            print(f"[DEBUG] Última actividad: {last_activity}")
-        
-        # Estadísticas por tipo de terapia
-        stats_dict = {}
-        for stat in user_stats:
-            stats_dict[stat[0]] = {
-                'completed_sessions': stat[1],
-                'total_questions': stat[2],
-                'total_correct': stat[3],
-                'avg_accuracy': float(stat[4])
+                'answered_at': answered_at,
+                'session_progress': {
+                    'total_questions': total_questions,
+                    'correct_answers': correct_answers,
+                    'accuracy': round(accuracy, 2)
+                }
             }
+        }), 201
         
-        response_data['user_statistics'] = stats_dict
-        
-        # Categorías practicadas
-        categories_dict = {'palabras': [], 'números': []}
-        for category in practiced_categories:
-            if category[0] in categories_dict:
-                categories_dict[category[0]].append(category[1])
-        
-        response_data['practiced_categories'] = categories_dict
+    except StorageUnavailableError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
         
-        # Generar recomendación si no hay sesión activa
-        if not active_session:
-            if not stats_dict:
-                response_data['recommendation'] = {
-                    'therapy_type': 'palabras',
-                    'therapy_category': 'adjetivos',
-                    'reason': 'first_time'
-                }
-            else:
-                # Recomendar el tipo con menor precisión
-                lowest_type = min(stats_dict.items(), key=lambda x: x[1]['avg_accuracy'])
-                response_data['recommendation'] = {
-                    'therapy_type': lowest_type[0],
-                    'reason': 'needs_practice',
-                    'current_accuracy': lowest_type[1]['avg_accuracy']
-                }
+    except Exception as e:
+        print(f"[ERROR] ❌ Error: {e}")
+        print(f"[ERROR] Traceback: {traceback.format_exc()}")
+        return jsonify({
+            'success': False,
+            'message': f'Error al registrar respuesta: {str(e)}'
+        }), 500
+
+
+def active_session_payload(session):
+    """Datos de una sesión activa tal como los devuelve la API"""
+    return {
+        'session_id': session['session_id'],
+        'therapy_type': session['therapy_type'],  # palabras o números
+        'therapy_category': session['therapy_category'],
+        'started_at': session['started_at'],
+        'total_questions': session['total_questions'],
+        'correct_answers': session['correct_answers'],
+        'current_question_index': session['current_question_index']
+    }
+
+
+@app.route('/therapy/session/active/<int:usr_index>', methods=['GET'])
+def get_active_session(usr_index):
+    """
+    Obtiene cualquier sesión activa del usuario (palabras o números)
+    """
+    try:
+        etag, last_modified = user_validators('active', usr_index)
+        not_modified = not_modified_response(etag, last_modified)
+        if not_modified:
+            return not_modified
         
-        print(f"[DEBUG] ✅ Estado consultado exitosamente")
-        print("="*50 + "\n")
+        # Servir desde la caché si sabemos cuál es su sesión activa
+        session = get_cached_active_session(usr_index)
+        if session:
+            print(f"[DEBUG] ⚡ Sesión activa {session['session_id']} servida desde caché")
+        else:
+            session = storage.get_latest_active_session(usr_index)
+            if session:
+                cache_session(session, is_latest_active=True)
         
+        if session:
+            return add_validators(jsonify({
+                'success': True,
+                'data': active_session_payload(session)
+            }), etag, last_modified), 200
+        else:
+            return jsonify({
+                'success': False,
+                'message': 'No hay sesión activa'
+            }), 404
+            
+    except StorageUnavailableError as e:
         return jsonify({
-            'success': True,
-            'data': response_data
-        }), 200
+            'success': False,
+            'message': str(e)
+        }), 500
         
     except Exception as e:
+        print(f"[ERROR] {e}")
+        return jsonify({
+            'success': False,
+            'message': f'Error: {str(e)}'
+        }), 500
+
+@app.route('/therapy/user/<int:usr_index>/events', methods=['GET'])
+def stream_session_events(usr_index):
+    """
+    Stream SSE con el progreso de las sesiones del usuario
+
+    Reemplaza el polling a /therapy/session/active/<usr_index>. Al conectar
+    se envía un "snapshot" con la sesión activa (o null) y después:
+    - started: se inició una sesión
+    - answer: se registró una respuesta (contadores, categoría, índice)
+    - ended: la sesión terminó (session_status completed/abandoned)
+
+    Cada SSE_HEARTBEAT_SECONDS llega un comentario para mantener viva la
+    conexión. El stream se corta a los SSE_MAX_SECONDS o si se pudieron
+    perder eventos; EventSource reconecta solo y recibe un snapshot nuevo.
+    """
+    if not SSE_ENABLED:
+        return jsonify({
+            'success': False,
+            'message': 'Eventos en vivo deshabilitados'
+        }), 404
+
+    # Suscribirse antes del snapshot para no perder eventos intermedios
+    subscription = subscribe_session_events(usr_index)
+    if subscription is None:
+        print(f"[ERROR] ⚠️ Sin streams SSE libres ({SSE_MAX_STREAMS})")
+        response = jsonify({
+            'success': False,
+            'message': 'Demasiadas conexiones en vivo, intenta de nuevo'
+        })
+        response.headers['Retry-After'] = str(int(SSE_HEARTBEAT_SECONDS))
+        return response, 503
+
+    try:
+        session = get_cached_active_session(usr_index)
+        if session is None:
+            session = storage.get_latest_active_session(usr_index)
+            if session:
+                cache_session(session, is_latest_active=True)
+    except StorageUnavailableError as e:
+        unsubscribe_session_events(usr_index, subscription)
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+    except Exception as e:
+        unsubscribe_session_events(usr_index, subscription)
         print(f"[ERROR] ❌ Error: {e}")
-        if 'conn' in locals() and conn:
-            release_db_connection(conn)
         return jsonify({
             'success': False,
-            'message': f'Error al consultar estado: {str(e)}'
+            'message': f'Error: {str(e)}'
         }), 500
 
-@app.route('/therapy/session/start', methods=['POST'])
-def start_therapy_session():
+    snapshot = active_session_payload(session) if session else None
+    print(f"[DEBUG] 📡 Stream de eventos abierto para usuario {usr_index}")
+
+    def generate():
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        try:
+            yield "retry: 3000\n\n"
+            yield format_sse('snapshot', {'active_session': snapshot})
+
+            while time.monotonic() < deadline and not subscription['dropped']:
+                try:
+                    payload = subscription['queue'].get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(payload['event'], session_event_data(payload))
+
+            if subscription['dropped']:
+                yield format_sse('reset', {'reason': 'eventos perdidos, reconectar'})
+        finally:
+            unsubscribe_session_events(usr_index, subscription)
+            print(f"[DEBUG] 📡 Stream de eventos cerrado para usuario {usr_index}")
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Que nginx no acumule el stream
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/therapy/session/<int:session_id>/end', methods=['PUT'])
+def end_therapy_session(session_id):
     """
-    Inicia una nueva sesión de terapia
+    Finaliza una sesión de terapia
     
-    Body esperado:
+    Body opcional:
     {
-        "usr_index": 1,
-        "therapy_type": "palabras",  // o "números"
-        "therapy_category": "adjetivos"  // opcional
+        "status": "completed"  // o "abandoned"
     }
     
     LLAMAR desde Alexa cuando:
-    - Usuario dice "empezar terapia de palabras/números"
-    - Usuario selecciona una categoría específica
+    - Usuario dice "terminar", "salir", "cancelar"
+    - Usuario completa todas las preguntas
+    - Usuario cambia a otro tipo de terapia
+    - Sesión de timeout (usar "abandoned")
     """
     print("\n" + "="*50)
-    print("[DEBUG] 🎯 Iniciando nueva sesión de terapia")
+    print(f"[DEBUG] 🏁 Finalizando sesión {session_id}")
     print(f"[DEBUG] Timestamp: {datetime.now()}")
     
     try:
-        data = request.get_json()
-        print(f"[DEBUG] Datos recibidos: {data}")
-        
-        usr_index = data.get('usr_index')
-        therapy_type = data.get('therapy_type')
-        therapy_category = data.get('therapy_category')
-        
-        # Validaciones
-        if not usr_index or not therapy_type:
-            print("[ERROR] ❌ Campos requeridos faltantes")
-            return jsonify({
-                'success': False,
-                'message': 'usr_index y therapy_type son requeridos'
-            }), 400
+        data = request.get_json() or {}
+        status = data.get('status', 'completed')
         
-        if therapy_type not in ['palabras', 'números']:
-            print("[ERROR] ❌ Tipo de terapia inválido")
+        if status not in ['completed', 'abandoned']:
             return jsonify({
                 'success': False,
-                'message': 'therapy_type debe ser "palabras" o "números"'
+                'message': 'status debe ser "completed" o "abandoned"'
             }), 400
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({
-                'success': False,
-                'message': 'Error de conexión a la base de datos'
-            }), 500
-        
-        cursor = conn.cursor()
-        
-        # Verificar si hay sesiones activas del MISMO tipo
-        cursor.execute(
-            """
-            SELECT session_id FROM therapy_sessions 
-            WHERE usr_index = %s 
-            AND therapy_type = %s 
-            AND session_status = 'active'
-            """,
-            (usr_index, therapy_type)
-        )
+        result = storage.end_session(session_id, status, datetime.now())
         
-        active_session = cursor.fetchone()
-        
-        if active_session:
-            print(f"[DEBUG] ⚠️ Ya existe sesión activa: {active_session[0]}")
-            cursor.close()
-            release_db_connection(conn)
+        if not result:
+            evict_session(session_id)
             return jsonify({
                 'success': False,
-                'message': 'Ya tienes una sesión activa de este tipo',
-                'active_session_id': active_session[0],
-                'should_resume': True
-            }), 409
+                'message': 'Sesión no encontrada o ya finalizada'
+            }), 404
         
-        # Crear nueva sesión
-        cursor.execute(
-            """
-            INSERT INTO therapy_sessions 
-            (usr_index, therapy_type, therapy_category, started_at, session_status)
-            VALUES (%s, %s, %s, %s, 'active')
-            RETURNING session_id, started_at
-            """,
-            (usr_index, therapy_type, therapy_category, datetime.now())
-        )
+        session_id, therapy_type, total_questions, correct_answers, started_at = result
         
-        session_id, started_at = cursor.fetchone()
-        conn.commit()
+        # La sesión ya no está activa: el próximo poll debe ir a la base
+        evict_session(session_id)
         
-        cursor.close()
-        release_db_connection(conn)
+        accuracy = (correct_answers / total_questions * 100) if total_questions > 0 else 0
+        duration_minutes = (datetime.now() - started_at).total_seconds() / 60
         
-        print(f"[DEBUG] ✅ Sesión creada exitosamente: {session_id}")
+        print(f"[DEBUG] ✅ Sesión finalizada: {session_id}")
+        print(f"[DEBUG] Resultado: {correct_answers}/{total_questions} ({accuracy:.1f}%)")
+        print(f"[DEBUG] Duración: {duration_minutes:.1f} minutos")
         print("="*50 + "\n")
         
         return jsonify({
             'success': True,
-            'message': 'Sesión de terapia iniciada',
+            'message': 'Sesión finalizada exitosamente',
             'data': {
                 'session_id': session_id,
                 'therapy_type': therapy_type,
-                'therapy_category': therapy_category,
-                'started_at': started_at.isoformat()
+                'status': status,
+                'total_questions': total_questions,
+                'correct_answers': correct_answers,
+                'accuracy': round(accuracy, 2),
+                'duration_minutes': round(duration_minutes, 2)
             }
-        }), 201
+        }), 200
+        
+    except StorageUnavailableError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
         
     except Exception as e:
         print(f"[ERROR] ❌ Error: {e}")
-        if 'conn' in locals() and conn:
-            conn.rollback()
-            release_db_connection(conn)
         return jsonify({
             'success': False,
-            'message': f'Error al crear sesión: {str(e)}'
+            'message': f'Error al finalizar sesión: {str(e)}'
         }), 500
 
-@app.route('/therapy/session/<int:session_id>/answer', methods=['POST'])
-def record_therapy_answer(session_id):
-    """
-    Registra una respuesta individual durante la sesión
+# ============================================================================
+# ENDPOINT DE ESTADÍSTICAS RÁPIDAS (PARA ALEXA)
+# ============================================================================
+
+def quick_stats_payload(stats):
+    """Documento de /quick-stats a partir de storage.get_quick_stats"""
+    if not stats or stats[0] == 0:
+        return {
+            'is_new_user': True,
+            'total_sessions': 0,
+            'total_questions': 0,
+            'total_correct': 0,
+            'avg_accuracy': 0
+        }
     
-    Body esperado:
-    {
-        "question_text": "perro",
-        "expected_answer": "perro",
-        "user_answer": "pero",
-        "pronunciation_score": 75,
-        "is_correct": false,
-        "error_type": "substitution_r_to_",
-        "error_details": {...},
-        "current_question_index": 5,        # Índice actual (i o j-2)
-        "next_question_index": 6,           # Siguiente índice
-        "category": "animales"              # Opcional
+    return {
+        'is_new_user': False,
+        'total_sessions': stats[0],
+        'total_questions': stats[1],
+        'total_correct': stats[2],
+        'avg_accuracy': int(stats[3])
     }
+
+
+@app.route('/therapy/user/<int:usr_index>/quick-stats', methods=['GET'])
+def get_quick_stats(usr_index):
+    """
+    Retorna estadísticas rápidas para que Alexa las mencione
+    
+    Ejemplo de uso en Alexa:
+    "Llevas 15 sesiones completadas con un 85% de precisión"
+    """
+    print("\n" + "="*50)
+    print(f"[DEBUG] ⚡ Estadísticas rápidas para usuario {usr_index}")
+    
+    try:
+        etag, last_modified = user_validators('quick-stats', usr_index)
+        not_modified = not_modified_response(etag, last_modified)
+        if not_modified:
+            return not_modified
+        
+        stats = storage.get_quick_stats(usr_index)
+        
+        return add_validators(jsonify({
+            'success': True,
+            'data': quick_stats_payload(stats)
+        }), etag, last_modified), 200
+        
+    except StorageUnavailableError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+        
+    except Exception as e:
+        print(f"[ERROR] ❌ Error: {e}")
+        return jsonify({
+            'success': False,
+            'message': f'Error: {str(e)}'
+        }), 500
+
+# ============================================================================
+# ARRANQUE DE LA SKILL DE ALEXA
+# ============================================================================
+#
+# Al abrir la skill Alexa necesitaba /login_user, /resume y /quick-stats:
+# tres requests, tres conexiones del pool y cinco consultas dentro de la
+# ventana de respuesta de Alexa. POST /alexa/launch hace todo en un request
+# y una sentencia SQL (ver storage.get_launch_state). Devuelve un token
+# firmado con SECRET_KEY para que los siguientes arranques no necesiten la
+# contraseña ni bcrypt.
+#
+# El token lleva solo usr_index, una huella de usr_password_changed_at y el
+# momento del último login con contraseña; nombre y email se leen siempre
+# de usr_mstr. Cambiar la contraseña cambia esa fecha y revoca los tokens;
+# el rehash que sube el costo de bcrypt no la toca (ver
+# sql/usr_password_changed_at.sql).
+# Un token vale ALEXA_TOKEN_MAX_AGE_SECONDS desde que se firmó y solo se
+# renueva cuando le quedan menos de ALEXA_TOKEN_REFRESH_SECONDS; las
+# renovaciones no pasan de ALEXA_TOKEN_MAX_LIFETIME_SECONDS desde el login,
+# después hay que volver a dar la contraseña.
+
+SECRET_KEY = os.getenv('SECRET_KEY')
+ALEXA_TOKEN_MAX_AGE_SECONDS = int(os.getenv('ALEXA_TOKEN_MAX_AGE_SECONDS', 30 * 24 * 3600))
+ALEXA_TOKEN_REFRESH_SECONDS = int(os.getenv('ALEXA_TOKEN_REFRESH_SECONDS', 7 * 24 * 3600))
+ALEXA_TOKEN_MAX_LIFETIME_SECONDS = int(os.getenv('ALEXA_TOKEN_MAX_LIFETIME_SECONDS', 90 * 24 * 3600))
+
+if SECRET_KEY:
+    launch_token_serializer = URLSafeTimedSerializer(SECRET_KEY, salt='alexa-launch')
+else:
+    # Una clave aleatoria no serviría con varios workers: sin SECRET_KEY no hay tokens
+    launch_token_serializer = None
+    print("[DEBUG] ⚠️ SECRET_KEY no definido: /alexa/launch solo acepta email y contraseña")
+
+
+def password_stamp(usr_index, password_changed_at):
+    """Huella del último cambio de contraseña para el token (no expone la fecha)"""
+    changed_at = password_changed_at.astimezone(timezone.utc).isoformat()
+    return hashlib.sha256(f'{SECRET_KEY}:{usr_index}:{changed_at}'.encode('utf-8')).hexdigest()[:16]
+
+
+def issue_launch_token(usr_index, password_changed_at, auth_at):
+    """Firmar un token de arranque; devuelve (token, expira en epoch)"""
+    token = launch_token_serializer.dumps({
+        'usr_index': usr_index,
+        'pw': password_stamp(usr_index, password_changed_at),
+        'auth_at': auth_at
+    })
+    return token, int(time.time()) + ALEXA_TOKEN_MAX_AGE_SECONDS
+
+
+@app.route('/alexa/launch', methods=['POST'])
+def alexa_launch():
+    """
+    Autentica y devuelve todo lo que Alexa necesita al abrir la skill
+
+    Body JSON, uno de:
+    - {"token": "..."}: token devuelto por un arranque anterior
+    - {"email": "...", "password": "..."}
+
+    Retorna el usuario, el token a usar en el próximo arranque (si hay
+    SECRET_KEY; es el mismo que llegó mientras no esté por expirar) con
+    su vencimiento, el documento de /therapy/user/<id>/resume y el de
+    /therapy/user/<id>/quick-stats.
     """
     print("\n" + "="*50)
-    print(f"[DEBUG] 📝 Registrando respuesta para sesión {session_id}")
+    print("[DEBUG] 🚀 Arranque de la skill")
     print(f"[DEBUG] Timestamp: {datetime.now()}")
     
     try:
-        data = request.get_json()
-        print(f"[DEBUG] Respuesta: {data.get('user_answer')} (esperado: {data.get('expected_answer')})")
-        print(f"[DEBUG] Score: {data.get('pronunciation_score')}")
-        
-        # Mostrar índices y categoría si vienen
-        if 'current_question_index' in data:
-            print(f"[DEBUG] Índice actual: {data.get('current_question_index')}")
-        if 'next_question_index' in data:
-            print(f"[DEBUG] Siguiente índice: {data.get('next_question_index')}")
-        if 'category' in data:
-            print(f"[DEBUG] Categoría: {data.get('category')}")
-        
-        # Validaciones
-        required_fields = ['question_text', 'expected_answer', 'user_answer', 
-                          'pronunciation_score', 'is_correct']
+        data = request.get_json(silent=True) or {}
+        token = data.get('token')
+        usr_email = data.get('email')
+        usr_password = data.get('password')
         
-        for field in required_fields:
-            if field not in data:
+        if token:
+            if launch_token_serializer is None:
+                print("[ERROR] ❌ Token recibido pero SECRET_KEY no está definido")
                 return jsonify({
                     'success': False,
-                    'message': f'Campo requerido faltante: {field}'
+                    'message': 'Los tokens no están habilitados, usar email y contraseña'
                 }), 400
+            
+            try:
+                claims, signed_at = launch_token_serializer.loads(
+                    token, max_age=ALEXA_TOKEN_MAX_AGE_SECONDS, return_timestamp=True
+                )
+                usr_index = int(claims['usr_index'])
+                stamp = claims['pw']
+                auth_at = int(claims['auth_at'])
+            except (BadSignature, KeyError, TypeError, ValueError):
+                print("[ERROR] ❌ Token inválido o expirado")
+                return jsonify({
+                    'success': False,
+                    'message': 'Token inválido o expirado'
+                }), 401
+            
+            launch_state = storage.get_launch_state(usr_index=usr_index)
+            if (not launch_state or launch_state[0][3] is None
+                    or stamp != password_stamp(usr_index, launch_state[0][4])):
+                print("[ERROR] ❌ Token revocado (usuario borrado o contraseña cambiada)")
+                return jsonify({
+                    'success': False,
+                    'message': 'Token inválido o expirado'
+                }), 401
+            
+            now = int(time.time())
+            if now - auth_at > ALEXA_TOKEN_MAX_LIFETIME_SECONDS:
+                print("[ERROR] ❌ Token fuera de su vida máxima, se requiere contraseña")
+                return jsonify({
+                    'success': False,
+                    'message': 'Token inválido o expirado'
+                }), 401
+            
+            user, resume_state, stats = launch_state
+            usr_index, usr_name, usr_email_db, _, password_changed_at = user
+            print(f"[DEBUG] ✅ Token válido para usuario ID: {usr_index}")
+            
+            token_expires_at = int(signed_at.timestamp()) + ALEXA_TOKEN_MAX_AGE_SECONDS
+            if token_expires_at - now < ALEXA_TOKEN_REFRESH_SECONDS:
+                print("[DEBUG] 🔁 Token por expirar, se renueva")
+                token, token_expires_at = issue_launch_token(usr_index, password_changed_at, auth_at)
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({
-                'success': False,
-                'message': 'Error de conexión a la base de datos'
-            }), 500
-        
-        cursor = conn.cursor()
-        
-        # Verificar que la sesión existe y está activa
-        cursor.execute(
-            """
-            SELECT session_status FROM therapy_sessions 
-            WHERE session_id = %s
-            """,
-            (session_id,)
-        )
-        
-        session = cursor.fetchone()
-        
-        if not session:
-            cursor.close()
-            release_db_connection(conn)
-            return jsonify({
-                'success': False,
-                'message': 'Sesión no encontrada'
-            }), 404
+        elif usr_email and usr_password:
+            print(f"[DEBUG] Email: {usr_email}")
+            launch_state = storage.get_launch_state(email=usr_email)
+            
+            if not launch_state:
+                print("[ERROR] ❌ Usuario no encontrado")
+                return jsonify({
+                    'success': False,
+                    'message': 'Credenciales incorrectas'
+                }), 401
+            
+            user, resume_state, stats = launch_state
+            usr_index, usr_name, usr_email_db, hashed_password, password_changed_at = user
+            
+            if not verify_password(usr_password, hashed_password):
+                print("[ERROR] ❌ Contraseña incorrecta")
+                return jsonify({
+                    'success': False,
+                    'message': 'Credenciales incorrectas'
+                }), 401
+            
+            print("[DEBUG] ✅ Contraseña correcta")
+            rehash_password_if_needed(usr_index, usr_password, hashed_password)
+            token = token_expires_at = None
+            if launch_token_serializer is not None:
+                token, token_expires_at = issue_launch_token(usr_index, password_changed_at, int(time.time()))
         
-        if session[0] != 'active':
-            cursor.close()
-            release_db_connection(conn)
+        else:
+            print("[ERROR] ❌ Campos incompletos")
             return jsonify({
                 'success': False,
-                'message': f'La sesión está {session[0]}, no se pueden agregar respuestas'
+                'message': 'Se requiere un token o email y contraseña'
             }), 400
         
-        # 🔥 CONSTRUIR UPDATE DINÁMICO PARA therapy_sessions
-        update_parts = []
-        update_values = []
-        
-        # Actualizar categoría si viene
-        if 'category' in data and data['category']:
-            update_parts.append("therapy_category = %s")
-            update_values.append(data['category'])
-            print(f"[DEBUG] Actualizando categoría a: {data['category']}")
-        
-        # Actualizar índice si viene
-        if 'next_question_index' in data and data['next_question_index'] is not None:
-            update_parts.append("current_question_index = %s")
-            update_values.append(data['next_question_index'])
-            print(f"[DEBUG] Actualizando índice a: {data['next_question_index']}")
-        
-        # Ejecutar UPDATE si hay algo que actualizar
-        if update_parts:
-            update_query = f"""
-                UPDATE therapy_sessions 
-                SET {', '.join(update_parts)}
-                WHERE session_id = %s
-            """
-            update_values.append(session_id)
-            cursor.execute(update_query, tuple(update_values))
-            print(f"[DEBUG] ✅ Sesión actualizada")
-        
-        # Insertar respuesta
-        cursor.execute(
-            """
-            INSERT INTO therapy_answers 
-            (session_id, question_text, expected_answer, user_answer, 
-             pronunciation_score, is_correct, error_type, error_details, answered_at)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING answer_id, answered_at
-            """,
-            (
-                session_id,
-                data['question_text'],
-                data['expected_answer'],
-                data['user_answer'],
-                data['pronunciation_score'],
-                data['is_correct'],
-                data.get('error_type'),
-                json.dumps(data.get('error_details', {})),
-                datetime.now()
-            )
-        )
-        
-        answer_id, answered_at = cursor.fetchone()
-        
-        # Actualizar contadores de la sesión
-        cursor.execute(
-            """
-            UPDATE therapy_sessions 
-            SET total_questions = total_questions + 1,
-                correct_answers = correct_answers + CASE WHEN %s THEN 1 ELSE 0 END
-            WHERE session_id = %s
-            RETURNING total_questions, correct_answers
-            """,
-            (data['is_correct'], session_id)
-        )
-        
-        total_questions, correct_answers = cursor.fetchone()
-        
-        conn.commit()
-        cursor.close()
-        release_db_connection(conn)
-        
-        accuracy = (correct_answers / total_questions * 100) if total_questions > 0 else 0
-        
-        print(f"[DEBUG] ✅ Respuesta registrada: {answer_id}")
-        print(f"[DEBUG] Progreso: {correct_answers}/{total_questions} ({accuracy:.1f}%)")
+        print(f"[DEBUG] 🎉 Arranque listo para usuario ID: {usr_index}")
         print("="*50 + "\n")
         
         return jsonify({
             'success': True,
-            'message': 'Respuesta registrada exitosamente',
+            'message': f'¡Bienvenido, {usr_name}!',
             'data': {
-                'answer_id': answer_id,
-                'session_id': session_id,
-                'answered_at': answered_at.isoformat(),
-                'session_progress': {
-                    'total_questions': total_questions,
-                    'correct_answers': correct_answers,
-                    'accuracy': round(accuracy, 2)
-                }
+                'usr_index': usr_index,
+                'usr_name': usr_name,
+                'usr_email': usr_email_db,
+                'token': token,
+                'token_expires_at': token_expires_at,
+                'resume': resume_payload(*resume_state),
+                'quick_stats': quick_stats_payload(stats)
             }
-        }), 201
+        }), 200
         
+    except StorageUnavailableError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+        
+    except Exception as e:
+        print(f"[ERROR] ❌ Error inesperado: {e}")
+        print(f"[ERROR] Traceback: {traceback.format_exc()}")
+        return jsonify({
+            'success': False,
+            'message': f'Error interno del servidor: {str(e)}'
+        }), 500
+
+# ============================================================================
+# TENDENCIAS DE PRONUNCIACIÓN (PARA TERAPEUTAS)
+# ============================================================================
+#
+# Las respuestas del usuario llegan en una sola fila columnar (ver
+# get_answer_series) y todo el cálculo es vectorizado con NumPy: medias
+# móviles con sumas acumuladas, EWMA por bloques y pendientes de regresión
+# lineal por categoría con bincount. El resultado se cachea por usuario
+# hasta que cambia su versión (ver VERSIONES POR USUARIO).
+
+TRENDS_WINDOW = 10
+TRENDS_ALPHA = 0.3
+TRENDS_POINTS = 100
+TRENDS_MAX_POINTS = 1000
+TRENDS_CACHE_MAX = 256
+SECONDS_PER_DAY = 86400.0
+EPOCH = datetime(1970, 1, 1)
+
+# usr_index -> (versión, parámetros, payload)
+trends_cache = OrderedDict()
+trends_cache_lock = threading.Lock()
+
+
+def grouped_rolling_mean(values, group_starts, window):
+    """
+    Media móvil de `window` elementos que no cruza el inicio de su grupo
+
+    values debe venir ordenado por grupo; group_starts[i] es el índice
+    donde empieza el grupo del elemento i.
+    """
+    positions = np.arange(len(values))
+    low = np.maximum(group_starts, positions - window + 1)
+    sums = np.concatenate(([0.0], np.cumsum(values, dtype=float)))
+    return (sums[positions + 1] - sums[low]) / (positions + 1 - low)
+
+
+def ewma(values, alpha):
+    """
+    Media móvil exponencial (ajustada, como pandas adjust=True)
+
+    N_t = d·N_{t-1} + x_t, D_t = d·D_{t-1} + 1, y_t = N_t / D_t con
+    d = 1 - alpha. Dentro de cada bloque se resuelve con potencias de d y
+    una suma acumulada; el bloque se achica para que d^-k no desborde.
+    """
+    decay = 1.0 - alpha
+    block = int(np.clip(300.0 / -np.log(decay), 1, 1024)) if decay > 0 else 1
+    result = np.empty(len(values))
+    numerator = denominator = 0.0
+    for start in range(0, len(values), block):
+        chunk = values[start:start + block]
+        steps = np.arange(len(chunk))
+        growth = decay ** -steps
+        shrink = decay ** steps
+        numerators = shrink * (decay * numerator + np.cumsum(chunk * growth))
+        denominators = shrink * (decay * denominator + np.cumsum(growth))
+        result[start:start + len(chunk)] = numerators / denominators
+        numerator, denominator = numerators[-1], denominators[-1]
+    return result
+
+
+def grouped_slopes(x, y, codes, groups):
+    """Pendiente de la recta de mínimos cuadrados de y sobre x por grupo"""
+    counts = np.bincount(codes, minlength=groups)
+    safe_counts = np.maximum(counts, 1)
+    dx = x - (np.bincount(codes, x, minlength=groups) / safe_counts)[codes]
+    dy = y - (np.bincount(codes, y, minlength=groups) / safe_counts)[codes]
+    sxx = np.bincount(codes, dx * dx, minlength=groups)
+    sxy = np.bincount(codes, dx * dy, minlength=groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = sxy / sxx
+    # Con menos de dos puntos (o todos en el mismo instante) no hay tendencia
+    slopes[(counts < 2) | (sxx == 0)] = np.nan
+    return slopes
+
+
+def sample_indices(length, points):
+    """Hasta `points` índices repartidos en [0, length), siempre con el último"""
+    if length <= points:
+        return np.arange(length)
+    return np.unique(np.linspace(0, length - 1, points).round().astype(int))
+
+
+def as_iso(epoch_seconds):
+    """Segundos epoch -> lista de fechas ISO 8601"""
+    return np.datetime_as_string((epoch_seconds * 1e6).astype('datetime64[us]'), unit='s').tolist()
+
+
+def as_list(values):
+    """Array de floats -> lista redondeada con None en lugar de NaN"""
+    rounded = np.round(values, 2)
+    return [None if np.isnan(value) else value for value in rounded.tolist()]
+
+
+def compute_trends(series, window, alpha, points):
+    """Tendencias de un usuario a partir de sus respuestas en forma columnar"""
+    scores = np.array(series['pronunciation_score'], dtype=float)
+    correct = np.array(series['is_correct'], dtype=bool)
+    answered_at = np.array(series['answered_at'], dtype=float)
+    total = len(scores)
+
+    if total == 0:
+        return {
+            'total_answers': 0,
+            'scored_answers': 0,
+            'overall': None,
+            'score_trend': None,
+            'categories': []
+        }
+
+    # Serie global de puntajes (las respuestas sin puntaje no cuentan)
+    scored = ~np.isnan(scores)
+    score_values = scores[scored]
+    score_times = answered_at[scored]
+    days = (answered_at - answered_at[0]) / SECONDS_PER_DAY
+
+    score_trend = None
+    overall_slope = np.nan
+    if len(score_values):
+        sampled = sample_indices(len(score_values), points)
+        rolling = grouped_rolling_mean(score_values, np.zeros(len(score_values), dtype=int), window)
+        smoothed = ewma(score_values, alpha)
+        overall_slope = grouped_slopes(days[scored], score_values, np.zeros(len(score_values), dtype=int), 1)[0]
+        score_trend = {
+            'answered_at': as_iso(score_times[sampled]),
+            'score': as_list(score_values[sampled]),
+            'rolling_mean': as_list(rolling[sampled]),
+            'ewma': as_list(smoothed[sampled])
+        }
+
+    # Por categoría: (tipo, categoría) -> código, y arrays ordenados por grupo
+    keys = np.array([
+        f"{therapy_type}\x1f{category}"
+        for therapy_type, category in zip(series['therapy_type'], series['therapy_category'])
+    ])
+    group_keys, codes = np.unique(keys, return_inverse=True)
+    groups = len(group_keys)
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    counts = np.bincount(codes, minlength=groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    rolling_accuracy = grouped_rolling_mean(correct[order].astype(float), starts[sorted_codes], window)
+
+    correct_counts = np.bincount(codes, correct.astype(float), minlength=groups)
+    scored_counts = np.bincount(codes, scored.astype(float), minlength=groups)
+    score_sums = np.bincount(codes, np.where(scored, scores, 0.0), minlength=groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_scores = score_sums / scored_counts
+    slopes = np.full(groups, np.nan)
+    if scored.any():
+        slopes = grouped_slopes(days[scored], score_values, codes[scored], groups)
+
+    categories = []
+    sorted_times = answered_at[order]
+    for code, key in enumerate(group_keys.tolist()):
+        therapy_type, category = key.split('\x1f', 1)
+        group = slice(starts[code], starts[code] + counts[code])
+        sampled = sample_indices(counts[code], points)
+        categories.append({
+            'therapy_type': therapy_type,
+            'therapy_category': category or None,
+            'answers': int(counts[code]),
+            'accuracy': round(float(correct_counts[code] / counts[code] * 100), 2),
+            'mean_score': as_list(mean_scores[code:code + 1])[0],
+            'slope_per_day': as_list(slopes[code:code + 1])[0],
+            'accuracy_curve': {
+                'answered_at': as_iso(sorted_times[group][sampled]),
+                'rolling_accuracy': as_list(rolling_accuracy[group][sampled] * 100)
+            }
+        })
+
+    return {
+        'total_answers': total,
+        'scored_answers': int(scored.sum()),
+        'overall': {
+            'first_answer': as_iso(answered_at[:1])[0],
+            'last_answer': as_iso(answered_at[-1:])[0],
+            'accuracy': round(float(correct.mean() * 100), 2),
+            'mean_score': as_list(np.array([score_values.mean() if len(score_values) else np.nan]))[0],
+            'slope_per_day': as_list(np.array([overall_slope]))[0]
+        },
+        'score_trend': score_trend,
+        'categories': categories
+    }
+
+
+@app.route('/therapy/user/<int:usr_index>/trends', methods=['GET'])
+def get_user_trends(usr_index):
+    """
+    Tendencias de pronunciación del usuario
+
+    Query params (opcionales):
+    - window: respuestas por media móvil (default 10)
+    - alpha: factor de la EWMA, entre 0 y 1 (default 0.3)
+    - points: máximo de puntos por curva (default 100)
+
+    Devuelve la serie de puntajes (con media móvil y EWMA), la precisión
+    móvil por categoría y las pendientes en puntos de puntaje por día.
+    """
+    print("\n" + "="*50)
+    print(f"[DEBUG] 📈 Tendencias para usuario {usr_index}")
+
+    try:
+        try:
+            window = int(request.args.get('window', TRENDS_WINDOW))
+            alpha = float(request.args.get('alpha', TRENDS_ALPHA))
+            points = min(int(request.args.get('points', TRENDS_POINTS)), TRENDS_MAX_POINTS)
+            if window < 1 or points < 1 or not 0 < alpha < 1:
+                raise ValueError('window y points deben ser >= 1 y alpha estar entre 0 y 1')
+        except (ValueError, TypeError) as e:
+            return jsonify({
+                'success': False,
+                'message': f'Parámetros inválidos: {str(e)}'
+            }), 400
+
+        params = (window, alpha, points)
+        etag, last_modified = user_validators(f"trends-{window}-{alpha}-{points}", usr_index)
+        not_modified = not_modified_response(etag, last_modified)
+        if not_modified:
+            return not_modified
+
+        version = get_user_version(usr_index)
+        with trends_cache_lock:
+            cached = trends_cache.get(usr_index)
+            if cached is not None and cached[0] == version and cached[1] == params:
+                trends_cache.move_to_end(usr_index)
+                payload = cached[2]
+            else:
+                payload = None
+
+        if payload is None:
+            series = storage.get_answer_series(usr_index)
+            start = time.perf_counter()
+            payload = compute_trends(series, window, alpha, points)
+            record_span('numpy', 'trends', (time.perf_counter() - start) * 1000)
+            payload['usr_index'] = usr_index
+            payload['window'] = window
+            payload['alpha'] = alpha
+            with trends_cache_lock:
+                trends_cache[usr_index] = (version, params, payload)
+                trends_cache.move_to_end(usr_index)
+                while len(trends_cache) > TRENDS_CACHE_MAX:
+                    trends_cache.popitem(last=False)
+        else:
+            print("[DEBUG] ⚡ Tendencias servidas desde caché")
+
+        print(f"[DEBUG] ✅ {payload['total_answers']} respuestas analizadas")
+        print("="*50 + "\n")
+
+        return add_validators(jsonify({
+            'success': True,
+            'data': payload
+        }), etag, last_modified), 200
+
+    except StorageUnavailableError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
     except Exception as e:
         print(f"[ERROR] ❌ Error: {e}")
         print(f"[ERROR] Traceback: {traceback.format_exc()}")
-        if 'conn' in locals() and conn:
-            conn.rollback()
-            release_db_connection(conn)
         return jsonify({
             'success': False,
-            'message': f'Error al registrar respuesta: {str(e)}'
+            'message': f'Error al calcular tendencias: {str(e)}'
         }), 500
 
 
-@app.route('/therapy/session/active/<int:usr_index>', methods=['GET'])
-def get_active_session(usr_index):
+# ============================================================================
+# CATÁLOGO DE EJERCICIOS
+# ============================================================================
+#
+# Palabras y números por tipo de terapia y categoría (ver
+# catalog/exercises.json). Cada ítem es un string (se pronuncia tal cual)
+# o un par [question_text, expected_answer], por ejemplo ["15", "quince"].
+#
+# El archivo se carga una vez en un índice inmutable (mapeos de solo lectura
+# con tuplas) y se vuelve a leer cuando cambia su mtime, sin reiniciar.
+# Con gunicorn --preload el índice se carga en el maestro y los workers lo
+# comparten.
+
+EXERCISE_CATALOG_PATH = os.getenv(
+    'EXERCISE_CATALOG_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog', 'exercises.json')
+)
+CATALOG_RELOAD_SECONDS = float(os.getenv('CATALOG_RELOAD_SECONDS', 5))
+
+exercise_catalog = None
+exercise_catalog_mtime = None
+exercise_catalog_checked_at = None
+exercise_catalog_lock = threading.Lock()
+
+
+def read_exercise_catalog(path):
     """
-    Obtiene cualquier sesión activa del usuario (palabras o números)
+    Leer y validar el catálogo
+
+    Devuelve un dict con version (hash del contenido, se usa como ETag),
+    index (therapy_type -> categoría -> tupla de (question_text,
+    expected_answer)) y body (JSON ya serializado para /therapy/catalog).
+    """
+    with open(path, 'rb') as f:
+        raw_bytes = f.read()
+    raw = json.loads(raw_bytes)
+
+    index = {}
+    for therapy_type, categories in raw.items():
+        if not isinstance(categories, dict) or not categories:
+            raise ValueError(f'{therapy_type}: se esperaba un objeto de categorías')
+        type_index = {}
+        for category, items in categories.items():
+            if not isinstance(items, list) or not items:
+                raise ValueError(f'{therapy_type}/{category}: lista vacía o inválida')
+            entries = []
+            for item in items:
+                if isinstance(item, str):
+                    entries.append((item, item))
+                elif isinstance(item, list) and len(item) == 2 and all(isinstance(part, str) for part in item):
+                    entries.append((item[0], item[1]))
+                else:
+                    raise ValueError(f'{therapy_type}/{category}: ítem inválido {item!r}')
+            type_index[category] = tuple(entries)
+        index[therapy_type] = MappingProxyType(type_index)
+
+    version = hashlib.sha256(raw_bytes).hexdigest()[:16]
+    body = json.dumps({
+        'success': True,
+        'data': {
+            'version': version,
+            'therapy_types': {
+                therapy_type: {category: [list(entry) for entry in entries] for category, entries in categories.items()}
+                for therapy_type, categories in index.items()
+            }
+        }
+    }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    return MappingProxyType({
+        'version': version,
+        'index': MappingProxyType(index),
+        'body': body
+    })
+
+
+def get_exercise_catalog():
+    """
+    Obtener el catálogo vigente
+
+    Igual que el mapa de shards: se revisa el mtime como mucho cada
+    CATALOG_RELOAD_SECONDS y, si el archivo nuevo es inválido, se sigue
+    sirviendo el anterior.
+    """
+    global exercise_catalog, exercise_catalog_mtime, exercise_catalog_checked_at
+
+    now = time.monotonic()
+    if exercise_catalog is not None and now - exercise_catalog_checked_at < CATALOG_RELOAD_SECONDS:
+        return exercise_catalog
+
+    with exercise_catalog_lock:
+        if exercise_catalog is not None and now - exercise_catalog_checked_at < CATALOG_RELOAD_SECONDS:
+            return exercise_catalog
+        exercise_catalog_checked_at = now
+        try:
+            mtime = os.path.getmtime(EXERCISE_CATALOG_PATH)
+            if mtime != exercise_catalog_mtime:
+                exercise_catalog = read_exercise_catalog(EXERCISE_CATALOG_PATH)
+                exercise_catalog_mtime = mtime
+                total = sum(len(entries) for categories in exercise_catalog['index'].values() for entries in categories.values())
+                print(f"[DEBUG] 📚 Catálogo de ejercicios {exercise_catalog['version']} cargado: {total} ítems")
+        except Exception as e:
+            if exercise_catalog is None:
+                raise
+            print(f"[ERROR] ❌ Error al recargar catálogo, se mantiene el anterior: {e}")
+        return exercise_catalog
+
+
+@app.route('/therapy/catalog', methods=['GET'])
+def get_catalog():
+    """
+    Catálogo completo de ejercicios
+
+    Cada ítem viene como [question_text, expected_answer]. La respuesta
+    lleva ETag: con If-None-Match se responde 304 sin body mientras el
+    catálogo no cambie.
     """
     try:
-        conn = get_db_connection()
-        if not conn:
+        catalog = get_exercise_catalog()
+    except Exception as e:
+        print(f"[ERROR] ❌ Catálogo no disponible: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'Catálogo de ejercicios no disponible'
+        }), 503
+
+    response = Response(catalog['body'], mimetype='application/json')
+    response.set_etag(catalog['version'])
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+@app.route('/therapy/session/<int:session_id>/question', methods=['GET'])
+def get_current_question(session_id):
+    """
+    Pregunta que le toca a la sesión según su current_question_index
+
+    Query param opcional:
+    - category: categoría a usar si la sesión todavía no tiene una
+
+    Cuando el índice llega al final de la categoría (o lo pasa) se responde
+    completed: true y question: null. Un índice negativo responde 404.
+    """
+    try:
+        catalog = get_exercise_catalog()
+    except Exception as e:
+        print(f"[ERROR] ❌ Catálogo no disponible: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'Catálogo de ejercicios no disponible'
+        }), 503
+
+    try:
+        session = get_cached_session(session_id)
+        if session is None:
+            session = storage.get_session_state(session_id)
+            if session:
+                cache_session(session)
+
+        if not session:
             return jsonify({
                 'success': False,
-                'message': 'Error de conexión a la base de datos'
-            }), 500
-        
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            """
-            SELECT 
-                session_id, 
-                therapy_type,
-                therapy_category, 
-                started_at, 
-                total_questions, 
-                correct_answers,
-                current_question_index
-            FROM therapy_sessions
-            WHERE usr_index = %s 
-              AND session_status = 'active'
-            ORDER BY started_at DESC
-            LIMIT 1
-            """,
-            (usr_index,)
-        )
-        
-        session = cursor.fetchone()
-        cursor.close()
-        release_db_connection(conn)
-        
-        if session:
+                'message': 'Sesión no encontrada'
+            }), 404
+
+        if session['session_status'] != 'active':
             return jsonify({
-                'success': True,
-                'data': {
-                    'session_id': session[0],
-                    'therapy_type': session[1],  # palabras o números
-                    'therapy_category': session[2],
-                    'started_at': session[3].isoformat(),
-                    'total_questions': session[4],
-                    'correct_answers': session[5],
-                    'current_question_index': session[6]
-                }
-            }), 200
-        else:
+                'success': False,
+                'message': f"La sesión está {session['session_status']}"
+            }), 400
+
+        category = session['therapy_category'] or request.args.get('category')
+        if not category:
             return jsonify({
                 'success': False,
-                'message': 'No hay sesión activa'
+                'message': 'La sesión no tiene categoría: indicar ?category='
+            }), 400
+
+        entries = catalog['index'].get(session['therapy_type'], {}).get(category)
+        if entries is None:
+            return jsonify({
+                'success': False,
+                'message': f"La categoría {category} no existe para {session['therapy_type']}"
             }), 404
-            
+
+        question_index = session['current_question_index'] or 0
+        if question_index < 0:
+            # Índices guardados antes de validar next_question_index
+            return jsonify({
+                'success': False,
+                'message': f'Índice de pregunta fuera de rango: {question_index}'
+            }), 404
+
+        completed = question_index >= len(entries)
+        question = None
+        if not completed:
+            question_text, expected_answer = entries[question_index]
+            question = {
+                'question_text': question_text,
+                'expected_answer': expected_answer
+            }
+
+        return jsonify({
+            'success': True,
+            'data': {
+                'session_id': session_id,
+                'therapy_type': session['therapy_type'],
+                'therapy_category': category,
+                'question_index': question_index,
+                'total_questions': len(entries),
+                'remaining': max(len(entries) - question_index, 0),
+                'completed': completed,
+                'question': question,
+                'catalog_version': catalog['version']
+            }
+        }), 200
+
+    except StorageUnavailableError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
     except Exception as e:
-        print(f"[ERROR] {e}")
-        if 'conn' in locals() and conn:
-            release_db_connection(conn)
+        print(f"[ERROR] ❌ Error: {e}")
         return jsonify({
             'success': False,
-            'message': f'Error: {str(e)}'
+            'message': f'Error al obtener la pregunta: {str(e)}'
         }), 500
 
-@app.route('/therapy/session/<int:session_id>/end', methods=['PUT'])
-def end_therapy_session(session_id):
+
+# Cargar al importar (antes del fork con gunicorn --preload)
+try:
+    get_exercise_catalog()
+except Exception as e:
+    print(f"[ERROR] ❌ No se pudo cargar el catálogo de ejercicios: {e}")
+
+# ============================================================================
+# PATRONES DE ERROR (error_details JSONB)
+# ============================================================================
+
+ERROR_PATTERNS_LIMIT = 100
+
+
+def escape_like(value):
+    """Escapar comodines de LIKE en un valor del usuario"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+@app.route('/therapy/errors', methods=['GET'])
+def get_error_patterns():
     """
-    Finaliza una sesión de terapia
-    
-    Body opcional:
-    {
-        "status": "completed"  // o "abandoned"
-    }
-    
-    LLAMAR desde Alexa cuando:
-    - Usuario dice "terminar", "salir", "cancelar"
-    - Usuario completa todas las preguntas
-    - Usuario cambia a otro tipo de terapia
-    - Sesión de timeout (usar "abandoned")
+    Conteos de errores de pronunciación agregados en Postgres
+
+    Query params (todos opcionales):
+    - error_type: prefijo del tipo de error (ej. "substitution_r")
+    - detail: objeto JSON que debe estar contenido en error_details
+    - has_key: clave que debe existir en error_details (repetible)
+    - usr_index: solo un paciente
+    - from / to: rango de fechas ISO sobre answered_at
+    - group_by: error_type (default) o user
+    - min_occurrences: mínimo de apariciones por grupo (default 1)
+    - limit: máximo de grupos (default 100)
+
+    Ejemplo: pacientes con sustituciones de r recurrentes
+    /therapy/errors?error_type=substitution_r&group_by=user&min_occurrences=5
     """
     print("\n" + "="*50)
-    print(f"[DEBUG] 🏁 Finalizando sesión {session_id}")
-    print(f"[DEBUG] Timestamp: {datetime.now()}")
-    
+    print(f"[DEBUG] 🔍 Patrones de error: {dict(request.args)}")
+
     try:
-        data = request.get_json() or {}
-        status = data.get('status', 'completed')
-        
-        if status not in ['completed', 'abandoned']:
+        group_by = request.args.get('group_by', 'error_type')
+        if group_by not in ('error_type', 'user'):
             return jsonify({
                 'success': False,
-                'message': 'status debe ser "completed" o "abandoned"'
+                'message': 'group_by debe ser "error_type" o "user"'
             }), 400
-        
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({
-                'success': False,
-                'message': 'Error de conexión a la base de datos'
-            }), 500
-        
-        cursor = conn.cursor()
-        
-        # Actualizar sesión
-        cursor.execute(
-            """
-            UPDATE therapy_sessions 
-            SET ended_at = %s, session_status = %s
-            WHERE session_id = %s AND session_status = 'active'
-            RETURNING session_id, therapy_type, total_questions, correct_answers, started_at
-            """,
-            (datetime.now(), status, session_id)
-        )
-        
-        result = cursor.fetchone()
-        
-        if not result:
-            cursor.close()
-            release_db_connection(conn)
+
+        try:
+            filters = {}
+            if request.args.get('error_type'):
+                filters['error_type_prefix'] = request.args['error_type']
+            if request.args.get('detail'):
+                detail = json.loads(request.args['detail'])
+                if not isinstance(detail, dict):
+                    raise ValueError('detail debe ser un objeto JSON')
+                filters['detail'] = detail
+            if request.args.getlist('has_key'):
+                filters['has_keys'] = request.args.getlist('has_key')
+            if request.args.get('usr_index'):
+                filters['usr_index'] = int(request.args['usr_index'])
+            if request.args.get('from'):
+                filters['date_from'] = datetime.fromisoformat(request.args['from'])
+            if request.args.get('to'):
+                filters['date_to'] = datetime.fromisoformat(request.args['to'])
+
+            min_occurrences = int(request.args.get('min_occurrences', 1))
+            limit = int(request.args.get('limit', ERROR_PATTERNS_LIMIT))
+            if limit < 1:
+                raise ValueError('limit debe ser mayor que 0')
+
+        except (ValueError, TypeError) as e:
             return jsonify({
                 'success': False,
-                'message': 'Sesión no encontrada o ya finalizada'
-            }), 404
-        
-        session_id, therapy_type, total_questions, correct_answers, started_at = result
-        
-        conn.commit()
-        cursor.close()
-        release_db_connection(conn)
-        
-        accuracy = (correct_answers / total_questions * 100) if total_questions > 0 else 0
-        duration_minutes = (datetime.now() - started_at).total_seconds() / 60
-        
-        print(f"[DEBUG] ✅ Sesión finalizada: {session_id}")
-        print(f"[DEBUG] Resultado: {correct_answers}/{total_questions} ({accuracy:.1f}%)")
-        print(f"[DEBUG] Duración: {duration_minutes:.1f} minutos")
+                'message': f'Parámetros inválidos: {str(e)}'
+            }), 400
+
+        results = []
+        for group in storage.get_error_patterns(group_by, filters, min_occurrences, limit):
+            result = {
+                'error_type': group['error_type'],
+                'occurrences': group['occurrences'],
+                'patients': group['patients'],
+                'avg_pronunciation_score': (
+                    round(float(group['score_sum']) / group['score_count'], 2) if group['score_count'] else None
+                ),
+                'first_seen': group['first_seen'],
+                'last_seen': group['last_seen']
+            }
+            if group_by == 'user':
+                result['usr_index'] = group['usr_index']
+                del result['patients']
+            results.append(result)
+
+        print(f"[DEBUG] ✅ {len(results)} grupos")
         print("="*50 + "\n")
-        
+
         return jsonify({
             'success': True,
-            'message': 'Sesión finalizada exitosamente',
             'data': {
-                'session_id': session_id,
-                'therapy_type': therapy_type,
-                'status': status,
-                'total_questions': total_questions,
-                'correct_answers': correct_answers,
-                'accuracy': round(accuracy, 2),
-                'duration_minutes': round(duration_minutes, 2)
+                'group_by': group_by,
+                'results': results
             }
         }), 200
-        
+
+    except StorageUnavailableError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
     except Exception as e:
         print(f"[ERROR] ❌ Error: {e}")
-        if 'conn' in locals() and conn:
-            conn.rollback()
-            release_db_connection(conn)
         return jsonify({
             'success': False,
-            'message': f'Error al finalizar sesión: {str(e)}'
+            'message': f'Error al consultar patrones de error: {str(e)}'
         }), 500
 
+
 # ============================================================================
-# ENDPOINT DE ESTADÍSTICAS RÁPIDAS (PARA ALEXA)
+# DASHBOARD CLÍNICO (LISTADO DE PACIENTES)
 # ============================================================================
+#
+# Se sirve desde la vista materializada clinic_patient_progress (ver
+# sql/clinic_views.sql), refrescada en segundo plano. Nunca se agrega
+# therapy_answers en vivo. La vista sale de therapy_sessions en cada shard
+# (usr_mstr vive en la base principal): los pacientes registrados que
+# todavía no empezaron ninguna sesión no aparecen en el listado.
 
-@app.route('/therapy/user/<int:usr_index>/quick-stats', methods=['GET'])
-def get_quick_stats(usr_index):
+# Cada cuántos segundos se refresca la vista (0 = no refrescar desde la app)
+CLINIC_REFRESH_SECONDS = float(os.getenv('CLINIC_REFRESH_SECONDS', 300))
+CLINIC_PAGE_SIZE = 50
+CLINIC_MAX_PAGE_SIZE = 200
+# Clave del advisory lock para que un solo proceso refresque a la vez (y
+# consulte clinic_view_refresh_log sin carreras)
+CLINIC_REFRESH_LOCK_KEY = 7_310_331
+
+# parámetro sort -> columna de la vista
+CLINIC_SORT_COLUMNS = {
+    'last_activity': 'last_activity',
+    'accuracy': 'avg_accuracy',
+    'sessions': 'completed_sessions',
+    'usr_index': 'usr_index'
+}
+
+# Columnas de clinic_patient_progress en el orden en que se devuelven
+CLINIC_PROGRESS_FIELDS = (
+    'usr_index', 'completed_sessions', 'total_questions', 'total_correct',
+    'avg_accuracy', 'last_activity', 'has_active_session'
+)
+
+clinic_refresher = None
+clinic_refresher_lock = threading.Lock()
+
+
+def _refresh_clinic_views_forever():
+    """Hilo que refresca la vista cada CLINIC_REFRESH_SECONDS"""
+    while True:
+        time.sleep(CLINIC_REFRESH_SECONDS)
+        storage.refresh_clinic_views()
+
+
+@app.before_request
+def start_clinic_refresher():
+    """El refresco programado arranca con el primer request de cada proceso"""
+    global clinic_refresher
+    if CLINIC_REFRESH_SECONDS <= 0 or clinic_refresher is not None:
+        return
+    with clinic_refresher_lock:
+        if clinic_refresher is None:
+            clinic_refresher = threading.Thread(
+                target=_refresh_clinic_views_forever,
+                name='clinic-refresher',
+                daemon=True
+            )
+            clinic_refresher.start()
+
+
+def encode_cursor(values):
+    """Cursor opaco de paginación (datetime en ISO 8601, Decimal como número)"""
+    return base64.urlsafe_b64encode(app.json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor_value):
+    """Inverso de encode_cursor"""
+    return json.loads(base64.urlsafe_b64decode(cursor_value.encode('ascii')))
+
+
+def parse_bool(value):
+    """Interpretar un query param booleano"""
+    return value.lower() in ('1', 'true', 'yes', 'si', 'sí')
+
+
+@app.route('/clinic/patients', methods=['GET'])
+def list_clinic_patients():
     """
-    Retorna estadísticas rápidas para que Alexa las mencione
-    
-    Ejemplo de uso en Alexa:
-    "Llevas 15 sesiones completadas con un 85% de precisión"
+    Lista de pacientes para el dashboard clínico
+
+    Query params (todos opcionales):
+    - sort: last_activity | accuracy | sessions | usr_index (default last_activity)
+    - order: asc | desc (default desc)
+    - limit: tamaño de página (default 50, máximo 200)
+    - cursor: next_cursor de la página anterior
+    - active: true/false, solo pacientes con/sin sesión activa
+    - min_accuracy / max_accuracy: rango de precisión promedio
+    - min_sessions: mínimo de sesiones completadas
+    - active_since: fecha ISO, última actividad desde
+
+    Paginación por keyset sobre (columna de orden, usr_index): cada página
+    cuesta lo mismo sin importar cuántas haya antes. Solo aparecen pacientes
+    con al menos una sesión.
     """
     print("\n" + "="*50)
-    print(f"[DEBUG] ⚡ Estadísticas rápidas para usuario {usr_index}")
-    
+    print("[DEBUG] 🩺 Listado de pacientes para el dashboard")
+
     try:
-        conn = get_db_connection()
-        if not conn:
+        sort = request.args.get('sort', 'last_activity')
+        order = request.args.get('order', 'desc')
+        if sort not in CLINIC_SORT_COLUMNS or order not in ('asc', 'desc'):
             return jsonify({
                 'success': False,
-                'message': 'Error de conexión a la base de datos'
-            }), 500
-        
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            """
-            SELECT 
-                COUNT(*) as total_sessions,
-                SUM(total_questions) as total_questions,
-                SUM(correct_answers) as total_correct,
-                ROUND(AVG(CASE 
-                    WHEN total_questions > 0 
-                    THEN (correct_answers::DECIMAL / total_questions) * 100 
-                    ELSE 0 
-                END), 0) as avg_accuracy
-            FROM therapy_sessions
-            WHERE usr_index = %s 
-            AND session_status = 'completed'
-            """,
-            (usr_index,)
-        )
-        
-        stats = cursor.fetchone()
-        
-        cursor.close()
-        release_db_connection(conn)
-        
-        if not stats or stats[0] == 0:
+                'message': f"sort debe ser uno de {', '.join(CLINIC_SORT_COLUMNS)} y order asc o desc"
+            }), 400
+
+        try:
+            limit = min(int(request.args.get('limit', CLINIC_PAGE_SIZE)), CLINIC_MAX_PAGE_SIZE)
+            if limit < 1:
+                raise ValueError('limit')
+
+            filters = {}
+            if 'active' in request.args:
+                filters['active'] = parse_bool(request.args['active'])
+            if 'min_accuracy' in request.args:
+                filters['min_accuracy'] = float(request.args['min_accuracy'])
+            if 'max_accuracy' in request.args:
+                filters['max_accuracy'] = float(request.args['max_accuracy'])
+            if 'min_sessions' in request.args:
+                filters['min_sessions'] = int(request.args['min_sessions'])
+            if 'active_since' in request.args:
+                filters['active_since'] = datetime.fromisoformat(request.args['active_since'])
+
+            column = CLINIC_SORT_COLUMNS[sort]
+            after = None
+            if 'cursor' in request.args:
+                cursor_value, cursor_usr_index, cursor_sort, cursor_order = decode_cursor(request.args['cursor'])
+                if cursor_sort != sort or cursor_order != order:
+                    raise ValueError('el cursor corresponde a otro orden')
+                if column == 'last_activity':
+                    cursor_value = datetime.fromisoformat(cursor_value)
+                elif column == 'avg_accuracy':
+                    # Volver al Decimal exacto de la vista para comparar sin error de float
+                    cursor_value = Decimal(str(cursor_value))
+                after = (cursor_value, cursor_usr_index)
+
+        except (ValueError, TypeError) as e:
             return jsonify({
-                'success': True,
-                'data': {
-                    'is_new_user': True,
-                    'total_sessions': 0,
-                    'total_questions': 0,
-                    'total_correct': 0,
-                    'avg_accuracy': 0
-                }
-            }), 200
-        
+                'success': False,
+                'message': f'Parámetros inválidos: {str(e)}'
+            }), 400
+
+        # Una fila de más para saber si hay otra página
+        rows = storage.list_patient_progress(column, order, limit + 1, filters, after)
+        sort_position = CLINIC_PROGRESS_FIELDS.index(column)
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        # Nombres desde usr_mstr (base principal), solo para esta página
+        names = storage.get_user_names([row[0] for row in rows]) if rows else {}
+
+        patients = []
+        for row in rows:
+            usr_index, completed_sessions, total_questions, total_correct, avg_accuracy, last_activity, has_active_session = row
+            patients.append({
+                'usr_index': usr_index,
+                'usr_name': names.get(usr_index),
+                'completed_sessions': completed_sessions,
+                'total_questions': total_questions,
+                'total_correct': total_correct,
+                'avg_accuracy': avg_accuracy,
+                'last_activity': last_activity,
+                'has_active_session': has_active_session
+            })
+
+        next_cursor = None
+        if has_more:
+            last = rows[-1]
+            next_cursor = encode_cursor([last[sort_position], last[0], sort, order])
+
+        print(f"[DEBUG] ✅ {len(patients)} pacientes")
+        print("="*50 + "\n")
+
         return jsonify({
             'success': True,
             'data': {
-                'is_new_user': False,
-                'total_sessions': stats[0],
-                'total_questions': stats[1],
-                'total_correct': stats[2],
-                'avg_accuracy': int(stats[3])
+                'patients': patients,
+                'next_cursor': next_cursor
             }
         }), 200
-        
+
+    except StorageUnavailableError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
     except Exception as e:
         print(f"[ERROR] ❌ Error: {e}")
-        if 'conn' in locals() and conn:
-            release_db_connection(conn)
         return jsonify({
             'success': False,
-            'message': f'Error: {str(e)}'
+            'message': f'Error al listar pacientes: {str(e)}'
         }), 500
 
+
 @app.route('/')
 def home():
     return render_template('index.html')
@@ -1033,5 +4382,365 @@ def home():
 def test():
     return jsonify({"message": "hola mundo"})
 
+# ============================================================================
+# HEALTH CHECKS (LIVENESS / READINESS)
+# ============================================================================
+
+# Segundos que se reutiliza el resultado del probe a la base de datos
+HEALTH_CACHE_SECONDS = float(os.getenv('HEALTH_CACHE_SECONDS', 5))
+# Umbrales a partir de los cuales la instancia se reporta como no lista
+READY_MAX_POOL_SATURATION = float(os.getenv('READY_MAX_POOL_SATURATION', 0.9))
+READY_MAX_DB_LATENCY_MS = float(os.getenv('READY_MAX_DB_LATENCY_MS', 500))
+READY_MAX_BCRYPT_BACKLOG = int(os.getenv('READY_MAX_BCRYPT_BACKLOG', 8))
+# Fugas de conexión (acumuladas desde que arrancó el proceso) a partir de
+# las cuales la instancia deja de estar lista. Las conexiones que se fugan
+# fuera de un request nunca vuelven al pool (ver report_leaked_connections):
+# en lugar de degradarse hasta agotar DB_POOL_MAX, la instancia se reporta
+# como no lista para que el orquestador la recicle.
+READY_MAX_LEAKED_CONNECTIONS = int(os.getenv('READY_MAX_LEAKED_CONNECTIONS', max(1, DB_POOL_MAX // 2)))
+
+db_probe = {
+    'checked_at': None,
+    'ok': False,
+    'latency_ms': None,
+    'error': 'sin probar'
+}
+db_probe_lock = threading.Lock()
+
+
+def get_pool_stats(conn_pool=None):
+    """
+    Conexiones en uso / máximo de un pool (por defecto el principal)
+
+    Nunca crea el pool: si este proceso todavía no tiene uno devuelve None.
+    """
+    if conn_pool is None and connection_pool_pid == os.getpid():
+        conn_pool = connection_pool
+    if conn_pool is None:
+        return None
+
+    in_use = len(conn_pool._used)
+    max_connections = conn_pool.maxconn
+    return {
+        'in_use': in_use,
+        'max': max_connections,
+        'saturation': round(in_use / max_connections, 2),
+        'leaked_total': leaked_connections_total
+    }
+
+
+def probe_db():
+    """
+    Medir el round-trip a la base de datos con un SELECT 1
+
+    El resultado se cachea HEALTH_CACHE_SECONDS para que los health checks
+    del balanceador no agreguen carga. Si otro hilo ya está midiendo se
+    devuelve el último resultado en lugar de esperar. Si el proceso todavía
+    no tiene pool se intenta crearlo aquí, así con la base caída se
+    reintenta como mucho una vez cada HEALTH_CACHE_SECONDS.
+    """
+    checked_at = db_probe['checked_at']
+    if checked_at is not None and time.monotonic() - checked_at < HEALTH_CACHE_SECONDS:
+        return dict(db_probe)
+
+    if not db_probe_lock.acquire(blocking=False):
+        return dict(db_probe)
+
+    try:
+        pool_stats = get_pool_stats(get_connection_pool())
+        if pool_stats is None:
+            db_probe.update(ok=False, error='no se pudo crear el pool')
+        elif pool_stats['in_use'] >= pool_stats['max']:
+            # No tomar la última conexión libre para un health check
+            db_probe.update(ok=False, error='pool agotado')
+        else:
+            conn = get_db_connection()
+            if not conn:
+                db_probe.update(ok=False, error='no se pudo obtener conexión')
+            else:
+                try:
+                    start = time.perf_counter()
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT 1")
+                    cursor.fetchone()
+                    cursor.close()
+                    latency_ms = (time.perf_counter() - start) * 1000
+                    db_probe.update(ok=True, latency_ms=round(latency_ms, 2), error=None)
+                except Exception as e:
+                    db_probe.update(ok=False, error=str(e))
+                finally:
+                    release_db_connection(conn)
+
+        db_probe['checked_at'] = time.monotonic()
+        return dict(db_probe)
+
+    finally:
+        db_probe_lock.release()
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: el proceso está vivo y atiende requests"""
+    return jsonify({'status': 'ok'}), 200
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """
+    Readiness: la instancia puede atender tráfico
+
+    Reporta saturación del pool, latencia del último probe a la base de
+    datos, fugas de conexión y operaciones bcrypt en curso. Responde 503 si
+    alguna supera su umbral para que el balanceador deje de enviar tráfico.
+    """
+    leaked = report_leaked_connections()
+    backlog = bcrypt_in_flight
+
+    failures = []
+    if storage.name == 'postgres':
+        probe = probe_db()
+        pool_stats = get_pool_stats()
+        if pool_stats is None:
+            failures.append('pool no inicializado')
+        elif pool_stats['saturation'] >= READY_MAX_POOL_SATURATION:
+            failures.append('pool saturado')
+        if not probe['ok']:
+            failures.append(f"base de datos: {probe['error']}")
+        elif probe['latency_ms'] > READY_MAX_DB_LATENCY_MS:
+            failures.append('latencia de base de datos alta')
+    else:
+        # Sin base de datos no hay pool ni round-trip que medir
+        pool_stats = None
+        probe = {'ok': True, 'latency_ms': None, 'error': None, 'checked_at': None}
+    if backlog > READY_MAX_BCRYPT_BACKLOG:
+        failures.append('backlog de bcrypt alto')
+    if leaked_connections_total >= READY_MAX_LEAKED_CONNECTIONS:
+        failures.append(f'{leaked_connections_total} conexiones fugadas')
+
+    # Pools de shards ya abiertos en este proceso
+    shard_stats = {}
+    for shard, shard_pool in list(shard_pools.items()):
+        shard_stats[shard] = get_pool_stats(shard_pool)
+        if shard_stats[shard]['saturation'] >= READY_MAX_POOL_SATURATION:
+            failures.append(f'pool del shard {shard} saturado')
+
+    ready = not failures
+    if not ready:
+        print(f"[ERROR] ❌ Instancia no lista: {', '.join(failures)}")
+
+    probe_age = None
+    if probe['checked_at'] is not None:
+        probe_age = round(time.monotonic() - probe['checked_at'], 2)
+
+    return jsonify({
+        'status': 'ready' if ready else 'not_ready',
+        'failures': failures,
+        'checks': {
+            'storage': storage.name,
+            'pool': pool_stats,
+            'shard_pools': shard_stats,
+            'leaked_connections': {
+                'current': leaked,
+                'total': leaked_connections_total,
+                'max_total': READY_MAX_LEAKED_CONNECTIONS
+            },
+            'db': {
+                'ok': probe['ok'],
+                'latency_ms': probe['latency_ms'],
+                'error': probe['error'],
+                'age_seconds': probe_age
+            },
+            'bcrypt': {
+                'in_flight': backlog,
+                'rounds': bcrypt_rounds
+            }
+        }
+    }), 200 if ready else 503
+
+# ============================================================================
+# CAPTURA DE TRÁFICO (PARA PRUEBAS DE CARGA CON replay_traffic.py)
+# ============================================================================
+
+# Archivo JSONL donde se agregan los requests; sin definir no se captura
+TRAFFIC_CAPTURE_PATH = os.getenv('TRAFFIC_CAPTURE_PATH')
+# Campos del body que nunca se escriben en la captura
+REDACTED_FIELDS = ('password', 'token')
+
+
+def redact(value):
+    """Reemplazar contraseñas y tokens en un body JSON (recursivo)"""
+    if isinstance(value, dict):
+        return {
+            key: '[REDACTED]' if any(field in key.lower() for field in REDACTED_FIELDS) else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+class TrafficCaptureMiddleware:
+    """
+    Middleware WSGI que registra cada request en un archivo JSONL
+
+    Por request se guarda ruta, body sin contraseñas, status, duración y la
+    hora de llegada (reloj de pared, segundos epoch), más el session_id que
+    devolvió la respuesta para que el replay pueda mapear sesiones nuevas.
+
+    Con gunicorn el middleware se crea en el maestro y cada worker escribe
+    en el mismo archivo: por eso no se guardan tiempos relativos de cada
+    proceso. replay_traffic.py ordena por hora de llegada y calcula los
+    intervalos sobre el tráfico de todos los workers.
+    """
+
+    def __init__(self, wsgi_app, path):
+        self.wsgi_app = wsgi_app
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', encoding='utf-8')
+        print(f"[DEBUG] 🎥 Capturando tráfico en {path}")
+
+    def __call__(self, environ, start_response):
+        arrival = time.time()
+        started = time.monotonic()
+
+        # Leer el body y devolverlo intacto a la aplicación
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        body = environ['wsgi.input'].read(length) if length else b''
+        environ['wsgi.input'] = io.BytesIO(body)
+
+        captured = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            captured['status'] = int(status.split(' ', 1)[0])
+            captured['content_type'] = dict(headers).get('Content-Type', '')
+            return start_response(status, headers, exc_info)
+
+        result = self.wsgi_app(environ, capture_start_response)
+
+        if captured.get('content_type', '').startswith('text/event-stream'):
+            # Streams largos: registrar sin esperar a que terminen
+            self.write_record(environ, body, captured, arrival, started, b'')
+            return result
+
+        try:
+            response_body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+        self.write_record(environ, body, captured, arrival, started, response_body)
+        return [response_body]
+
+    def write_record(self, environ, body, captured, arrival, started, response_body):
+        """Armar el registro sanitizado y agregarlo al archivo"""
+        try:
+            method = environ.get('REQUEST_METHOD', 'GET')
+            path = environ.get('PATH_INFO', '')
+
+            try:
+                rule, args = app.url_map.bind('localhost').match(path, method, return_rule=True)
+                route = rule.rule
+            except Exception:
+                route, args = None, {}
+
+            try:
+                request_body = redact(json.loads(body)) if body else None
+            except ValueError:
+                request_body = None
+
+            response_session_id = None
+            if response_body and captured.get('content_type', '').startswith('application/json'):
+                try:
+                    response_data = json.loads(response_body).get('data') or {}
+                    response_session_id = response_data.get('session_id')
+                except (ValueError, AttributeError):
+                    pass
+
+            record = {
+                'ts': datetime.fromtimestamp(arrival).isoformat(),
+                'arrival': round(arrival, 6),
+                'pid': os.getpid(),
+                'method': method,
+                'path': path,
+                'query': environ.get('QUERY_STRING', ''),
+                'route': route,
+                'args': args,
+                'body': request_body,
+                'status': captured.get('status'),
+                'duration_ms': round((time.monotonic() - started) * 1000, 3),
+                'response_session_id': response_session_id
+            }
+
+            line = json.dumps(record, ensure_ascii=False)
+            with self.lock:
+                self.file.write(line + '\n')
+                self.file.flush()
+
+        except Exception as e:
+            print(f"[ERROR] ❌ Error al capturar request: {e}")
+
+
+if TRAFFIC_CAPTURE_PATH:
+    app.wsgi_app = TrafficCaptureMiddleware(app.wsgi_app, TRAFFIC_CAPTURE_PATH)
+
+# ============================================================================
+# MULTIPROCESO (FORK)
+# ============================================================================
+#
+# En producción la app corre con varios workers de gunicorn (ver
+# gunicorn.conf.py). Con preload_app el módulo se importa una sola vez en el
+# proceso maestro y cada worker nace de un fork. Del padre solo sobrevive
+# el hilo que hizo el fork: los locks pueden quedar tomados por hilos que ya
+# no existen y los listeners y el refresco programado no existen en el hijo. Todo ese estado se rehace aquí.
+
+
+def reset_after_fork():
+    """Dejar el proceso hijo como recién importado"""
+    global connection_pool_lock, shard_lock, checkouts_lock, bcrypt_lock
+    global session_cache_lock, clinic_refresher_lock, db_probe_lock, session_event_subscribers_lock
+    global exercise_catalog_lock, user_versions_lock, trends_cache_lock
+    global bcrypt_in_flight, clinic_refresher, PROCESS_ID, rehash_lock
+
+    connection_pool_lock = threading.Lock()
+    shard_lock = threading.Lock()
+    checkouts_lock = threading.Lock()
+    bcrypt_lock = threading.Lock()
+    rehash_lock = threading.Lock()
+    session_cache_lock = threading.Lock()
+    clinic_refresher_lock = threading.Lock()
+    db_probe_lock = threading.Lock()
+    session_event_subscribers_lock = threading.Lock()
+    exercise_catalog_lock = threading.Lock()
+    user_versions_lock = threading.Lock()
+    trends_cache_lock = threading.Lock()
+
+    discard_inherited_pools()
+
+    # Otro proceso: otro origen en los NOTIFY y caché vacía hasta que
+    # arranquen sus propios listeners
+    PROCESS_ID = new_process_id()
+    session_cache.clear()
+    active_session_by_user.clear()
+    session_listeners.clear()
+    session_listener_ready.clear()
+    session_event_subscribers.clear()
+    user_versions.clear()
+
+    clinic_refresher = None
+    bcrypt_in_flight = 0
+    rehash_pending.clear()
+    db_probe.update(checked_at=None, ok=False, latency_ms=None, error='sin probar')
+
+    if isinstance(app.wsgi_app, TrafficCaptureMiddleware):
+        app.wsgi_app.lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+# Solo para desarrollo; en producción: gunicorn -c gunicorn.conf.py app:app
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
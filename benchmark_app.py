@@ -0,0 +1,229 @@
+"""
+Micro-benchmark de la aplicación sin base de datos
+
+Uso:
+    python benchmark_app.py                    # 200 iteraciones por endpoint
+    python benchmark_app.py -n 2000            # más iteraciones
+    python benchmark_app.py --profile app.prof # además guardar un perfil cProfile
+
+Corre cada endpoint con el cliente de pruebas de Flask contra el
+almacenamiento en memoria (STORAGE_BACKEND=memory). Lo que se mide es el
+costo propio de la aplicación: routing, validación, caché de sesiones,
+serialización JSON y trazas. Si un cambio empeora estos números, el
+problema está en el código y no en Postgres.
+
+bcrypt se fija en el costo mínimo (4) para que login y registro no tapen
+al resto; en producción el costo se calibra contra BCRYPT_TARGET_MS o lo fija
+BCRYPT_ROUNDS.
+
+El stream SSE de /therapy/user/<id>/events no termina solo: su escenario
+mide la apertura hasta recibir el snapshot y después cierra la conexión.
+Los heartbeats y eventos posteriores dependen del reloj, no de la app.
+
+Quedan fuera "/" (solo renderiza la plantilla estática) y "/test" (devuelve
+un JSON fijo): no tienen lógica propia que medir.
+"""
+import argparse
+import contextlib
+import cProfile
+import io
+import itertools
+import os
+import sys
+import time
+
+# Configurar antes de importar app: el módulo lee el entorno al cargarse
+os.environ['STORAGE_BACKEND'] = 'memory'
+os.environ.setdefault('BCRYPT_ROUNDS', '4')
+os.environ.setdefault('CLINIC_REFRESH_SECONDS', '0')
+
+from replay_traffic import percentile  # noqa: E402
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import app as app_module  # noqa: E402
+
+
+SEED_USERS = 20
+SEED_SESSIONS_PER_USER = 5
+SEED_ANSWERS_PER_SESSION = 10
+PASSWORD = 'benchmark'
+
+
+def answer_body(index):
+    """Respuesta de ejemplo, correcta dos de cada tres veces"""
+    correct = index % 3 != 0
+    return {
+        'question_text': 'perro',
+        'expected_answer': 'perro',
+        'user_answer': 'perro' if correct else 'pero',
+        'pronunciation_score': 90 if correct else 60,
+        'is_correct': correct,
+        'error_type': None if correct else 'substitution_rr_to_r',
+        'error_details': {} if correct else {'position': 2, 'expected': 'rr', 'actual': 'r'},
+        'next_question_index': index + 1,
+        'category': 'animales'
+    }
+
+
+def seed(client):
+    """Usuarios con sesiones completadas y una sesión activa cada uno"""
+    users = []
+    for user_number in range(SEED_USERS):
+        response = client.post('/register_user', json={
+            'name': f'Paciente {user_number}',
+            'email': f'paciente{user_number}@example.com',
+            'password': PASSWORD
+        })
+        usr_index = response.get_json()['data']['usr_index']
+
+        for session_number in range(SEED_SESSIONS_PER_USER):
+            therapy_type = 'palabras' if session_number % 2 == 0 else 'números'
+            response = client.post('/therapy/session/start', json={
+                'usr_index': usr_index,
+                'therapy_type': therapy_type,
+                'therapy_category': 'animales'
+            })
+            session_id = response.get_json()['data']['session_id']
+            for index in range(SEED_ANSWERS_PER_SESSION):
+                client.post(f'/therapy/session/{session_id}/answer', json=answer_body(index))
+            client.put(f'/therapy/session/{session_id}/end', json={'status': 'completed'})
+
+        response = client.post('/therapy/session/start', json={
+            'usr_index': usr_index,
+            'therapy_type': 'palabras'
+        })
+        users.append((usr_index, response.get_json()['data']['session_id']))
+    return users
+
+
+def build_scenarios(users):
+    """
+    Un escenario por endpoint: (nombre, función que hace un request)
+
+    Cada función recibe el número de iteración para repartir la carga
+    entre los usuarios sembrados.
+    """
+    def user(i):
+        return users[i % len(users)]
+
+    def start_and_end(client, i):
+        usr_index = user(i)[0]
+        response = client.post('/therapy/session/start', json={
+            'usr_index': usr_index,
+            'therapy_type': 'números'
+        })
+        session_id = response.get_json()['data']['session_id']
+        return client.put(f'/therapy/session/{session_id}/end', json={'status': 'abandoned'})
+
+    registrations = itertools.count()
+
+    def register(client, i):
+        # Email nuevo en cada llamada, también entre calentamiento y medición
+        return client.post('/register_user', json={
+            'name': 'Paciente nuevo',
+            'email': f'nuevo{next(registrations)}@example.com',
+            'password': PASSWORD
+        })
+
+    def open_events(client, i):
+        response = client.get(f'/therapy/user/{user(i)[0]}/events', buffered=False)
+        chunks = iter(response.response)
+        # "retry" y el snapshot; al cerrar se libera la suscripción
+        next(chunks)
+        next(chunks)
+        response.close()
+        return response
+
+    return [
+        ('POST /register_user', register),
+        ('POST /login_user', lambda client, i: client.post('/login_user', json={
+            'email': f'paciente{i % len(users)}@example.com', 'password': PASSWORD
+        })),
+        ('POST /alexa/launch', lambda client, i: client.post('/alexa/launch', json={
+            'email': f'paciente{i % len(users)}@example.com', 'password': PASSWORD
+        })),
+        ('GET /therapy/user/<id>/resume', lambda client, i: client.get(f'/therapy/user/{user(i)[0]}/resume')),
+        ('POST /therapy/session/<id>/answer', lambda client, i: client.post(
+            f'/therapy/session/{user(i)[1]}/answer', json=answer_body(i)
+        )),
+        ('GET /therapy/session/active/<id>', lambda client, i: client.get(f'/therapy/session/active/{user(i)[0]}')),
+        ('GET /therapy/catalog', lambda client, i: client.get('/therapy/catalog')),
+        ('GET /therapy/session/<id>/question', lambda client, i: client.get(
+            f'/therapy/session/{user(i)[1]}/question?category=animales'
+        )),
+        ('GET /therapy/user/<id>/events', open_events),
+        ('POST start + PUT end', start_and_end),
+        ('GET /therapy/user/<id>/quick-stats', lambda client, i: client.get(f'/therapy/user/{user(i)[0]}/quick-stats')),
+        ('GET /therapy/user/<id>/trends', lambda client, i: client.get(f'/therapy/user/{user(i)[0]}/trends')),
+        ('GET /therapy/errors', lambda client, i: client.get('/therapy/errors?group_by=user&min_occurrences=2')),
+        ('GET /clinic/patients', lambda client, i: client.get('/clinic/patients?sort=accuracy&limit=10')),
+        ('GET /healthz', lambda client, i: client.get('/healthz')),
+        ('GET /readyz', lambda client, i: client.get('/readyz'))
+    ]
+
+
+def run(scenarios, client, iterations):
+    """Medir cada escenario; devuelve {nombre: latencias en ms}"""
+    results = {}
+    for name, scenario in scenarios:
+        # Calentar rutas, cachés y el JIT de las plantillas de Werkzeug
+        for i in range(min(20, iterations)):
+            scenario(client, i)
+
+        latencies = []
+        for i in range(iterations):
+            start = time.perf_counter()
+            response = scenario(client, i)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 500:
+                raise RuntimeError(f"{name} respondió {response.status_code}: {response.get_data(as_text=True)}")
+        results[name] = latencies
+    return results
+
+
+def report(results):
+    """Imprimir media, percentiles y throughput por endpoint"""
+    header = f"{'endpoint':<40} {'mean':>8} {'p50':>8} {'p99':>8} {'req/s':>9}"
+    print(header)
+    print('-' * len(header))
+    for name, latencies in results.items():
+        ordered = sorted(latencies)
+        mean = sum(ordered) / len(ordered)
+        print(
+            f"{name:<40} {mean:>8.3f} {percentile(ordered, 0.50):>8.3f} "
+            f"{percentile(ordered, 0.99):>8.3f} {1000 / mean:>9.0f}"
+        )
+    print("\n(latencias en ms, un solo hilo, sin red ni base de datos)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark de la aplicación con almacenamiento en memoria')
+    parser.add_argument('-n', '--iterations', type=int, default=200, help='Requests por endpoint')
+    parser.add_argument('--profile', help='Guardar un perfil cProfile en este archivo')
+    args = parser.parse_args()
+
+    client = app_module.app.test_client()
+
+    # Los handlers imprimen mucho [DEBUG]; eso también es costo de la app,
+    # pero se descarta para no llenar la terminal
+    with contextlib.redirect_stdout(io.StringIO()):
+        users = seed(client)
+        scenarios = build_scenarios(users)
+        profiler = cProfile.Profile() if args.profile else None
+        if profiler:
+            profiler.enable()
+        results = run(scenarios, client, args.iterations)
+        if profiler:
+            profiler.disable()
+
+    print(f"Almacenamiento: {app_module.storage.name}, bcrypt rounds: {app_module.bcrypt_rounds}, "
+          f"{args.iterations} requests por endpoint\n")
+    report(results)
+
+    if profiler:
+        profiler.dump_stats(args.profile)
+        print(f"\nPerfil guardado en {args.profile} (ver con: python -m pstats {args.profile})")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+"""
+Configuración de gunicorn para producción
+
+Uso:
+    gunicorn -c gunicorn.conf.py app:app
+
+Un worker por core (más uno) con varios hilos cada uno. La app se carga en
+el maestro antes del fork (preload_app) y los workers arrancan sin volver
+a importar. Ningún socket de
+Postgres se abre antes del fork; cada worker crea su pool con el primer
+request y app.reset_after_fork descarta lo que haya heredado. El costo de
+bcrypt se calibra una sola vez, en el maestro, y lo comparten todos los
+workers.
+
+Cada worker abre hasta DB_POOL_MAX conexiones (más DB_POOL_MAX por shard y
+un listener por shard), así que el total por máquina es aproximadamente
+WEB_CONCURRENCY * DB_POOL_MAX: revisar max_connections de Postgres antes de
+subir cualquiera de los dos.
+
+Variables de entorno:
+    PORT              puerto (default 5000)
+    WEB_CONCURRENCY   workers (default núcleos + 1)
+    GUNICORN_THREADS  hilos por worker (default DB_POOL_MAX + SSE_MAX_STREAMS)
+    GUNICORN_TIMEOUT  segundos antes de reiniciar un worker colgado (default 30)
+
+Hilos, pool y streams SSE por worker:
+
+    threads = hilos para requests + SSE_MAX_STREAMS
+
+Los streams SSE (/therapy/user/<usr_index>/events) ocupan un hilo cada uno
+mientras están abiertos, casi siempre esperando un evento, pero no retienen
+conexiones del pool. Los hilos para requests sí necesitan una conexión cada
+uno: más de DB_POOL_MAX solo esperarían en el pool, por eso el default es
+DB_POOL_MAX. Con los defaults (DB_POOL_MAX=10, SSE_MAX_STREAMS=32) son 42
+hilos por worker y WEB_CONCURRENCY * 32 streams por máquina. Si
+GUNICORN_THREADS se fija a mano debe superar SSE_MAX_STREAMS; si no, con
+todos los streams abiertos no queda ningún hilo para el resto de la API.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() + 1))
+worker_class = 'gthread'
+# Mismos defaults que app.py
+db_pool_max = int(os.getenv('DB_POOL_MAX', 10))
+sse_max_streams = int(os.getenv('SSE_MAX_STREAMS', 32)) if os.getenv('SSE_ENABLED', '1') == '1' else 0
+threads = int(os.getenv('GUNICORN_THREADS', db_pool_max + sse_max_streams))
+if threads <= sse_max_streams:
+    print(f"[ERROR] ⚠️ GUNICORN_THREADS={threads} no supera SSE_MAX_STREAMS={sse_max_streams}: "
+          f"los streams SSE pueden ocupar todos los hilos del worker")
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+preload_app = True
+
+# Reciclar workers de a poco para acotar fugas de memoria
+max_requests = 5000
+max_requests_jitter = 500
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    """El estado heredado ya lo limpió app.reset_after_fork (os.register_at_fork)"""
+    server.log.info(f"[DEBUG] Worker {worker.pid} listo, pool y listeners se crean con el primer request")
@@ -0,0 +1,249 @@
+"""
+Reproduce tráfico capturado contra una instancia local
+
+Uso:
+    TRAFFIC_CAPTURE_PATH=traffic.jsonl python app.py      # capturar
+    python replay_traffic.py traffic.jsonl                 # velocidad real (1x)
+    python replay_traffic.py traffic.jsonl --speed 5       # 5x más rápido
+    python replay_traffic.py traffic.jsonl --speed max     # sin esperas
+
+Los requests se disparan respetando los tiempos de la captura (divididos
+por --speed). Los session_id capturados se traducen a los que crea la
+instancia local, y los requests de una misma sesión se envían en el orden
+original. Las contraseñas llegan redactadas en la captura: con --password
+se reemplazan por una conocida (por ejemplo la de una base de prueba).
+
+Al final se imprime la distribución de latencias por ruta.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+# Espera máxima por el request anterior de la misma sesión
+CHAIN_TIMEOUT_SECONDS = 60
+
+
+def load_records(path):
+    """
+    Leer la captura ordenada por tiempo de llegada
+
+    Con varios workers las líneas de cada proceso quedan intercaladas en el
+    archivo: se ordena por la hora de llegada ('arrival', reloj de pared) y
+    recién entonces se calculan offset_ms y gap_ms sobre el tráfico total.
+    Las capturas viejas de un solo proceso traen offset_ms directamente.
+    """
+    records = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+
+    if records and all('arrival' in record for record in records):
+        records.sort(key=lambda record: record['arrival'])
+        first_arrival = records[0]['arrival']
+        previous = first_arrival
+        for record in records:
+            record['offset_ms'] = (record['arrival'] - first_arrival) * 1000
+            record['gap_ms'] = (record['arrival'] - previous) * 1000
+            previous = record['arrival']
+    else:
+        records.sort(key=lambda record: record['offset_ms'])
+    return records
+
+
+def session_key(record):
+    """session_id capturado al que pertenece un request (o None)"""
+    args = record.get('args') or {}
+    if 'session_id' in args:
+        return args['session_id']
+    return record.get('response_session_id')
+
+
+def replace_passwords(value, password):
+    """Reemplazar los campos redactados por una contraseña conocida"""
+    if isinstance(value, dict):
+        return {
+            key: password if item == '[REDACTED]' and 'password' in key.lower() else replace_passwords(item, password)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [replace_passwords(item, password) for item in value]
+    return value
+
+
+def percentile(sorted_values, fraction):
+    """Percentil por rango más cercano sobre valores ya ordenados"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class Replayer:
+    """Dispara los requests capturados y junta las latencias"""
+
+    def __init__(self, target, concurrency, password, timeout):
+        self.target = target.rstrip('/')
+        self.password = password
+        self.timeout = timeout
+        self.send_slots = threading.Semaphore(concurrency)
+        # Limita los hilos vivos; los que esperan a su sesión no envían
+        self.pending_slots = threading.Semaphore(concurrency * 4)
+        # Protege session_map y los resultados, que tocan todos los hilos
+        self.lock = threading.Lock()
+        # session_id capturado -> session_id local
+        self.session_map = {}
+        # session_id capturado -> Event del último request de esa sesión
+        self.last_in_session = {}
+        self.results = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.status_mismatches = defaultdict(int)
+
+    def build_request(self, record):
+        """Traducir path y body a los ids de la instancia local"""
+        path = record['path']
+        key = session_key(record)
+        args = record.get('args') or {}
+        with self.lock:
+            local_session = self.session_map.get(key)
+        if 'session_id' in args and local_session is not None:
+            path = path.replace(f"/{args['session_id']}/", f"/{local_session}/")
+        if record.get('query'):
+            path = f"{path}?{record['query']}"
+
+        data = None
+        body = record.get('body')
+        if body is not None:
+            if self.password:
+                body = replace_passwords(body, self.password)
+            data = json.dumps(body).encode('utf-8')
+
+        request = urllib.request.Request(self.target + path, data=data, method=record['method'])
+        if data is not None:
+            request.add_header('Content-Type', 'application/json')
+        return request
+
+    def send(self, record, previous, done):
+        """Enviar un request (después del anterior de su sesión)"""
+        try:
+            if previous is not None:
+                previous.wait(CHAIN_TIMEOUT_SECONDS)
+
+            with self.send_slots:
+                request = self.build_request(record)
+                start = time.perf_counter()
+                try:
+                    with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                        status = response.status
+                        response_body = response.read()
+                except urllib.error.HTTPError as e:
+                    status = e.code
+                    response_body = e.read()
+                elapsed_ms = (time.perf_counter() - start) * 1000
+
+            route = record.get('route') or record['path']
+            with self.lock:
+                self.results[route].append(elapsed_ms)
+                if status >= 500:
+                    self.errors[route] += 1
+                if record.get('status') and status != record['status']:
+                    self.status_mismatches[route] += 1
+
+            # Registrar el session_id local que creó este request
+            captured_session = record.get('response_session_id')
+            if captured_session is not None:
+                try:
+                    local_session = json.loads(response_body).get('data', {}).get('session_id')
+                except (ValueError, AttributeError):
+                    local_session = None
+                if local_session is not None:
+                    with self.lock:
+                        self.session_map.setdefault(captured_session, local_session)
+
+        except Exception as e:
+            with self.lock:
+                self.errors[record.get('route') or record['path']] += 1
+            print(f"[ERROR] ❌ {record['method']} {record['path']}: {e}", file=sys.stderr)
+        finally:
+            done.set()
+            self.pending_slots.release()
+
+    def run(self, records, speed):
+        """Programar los requests según sus tiempos de llegada"""
+        threads = []
+        started_at = time.monotonic()
+        first_offset = records[0]['offset_ms'] if records else 0
+
+        for record in records:
+            if speed is not None:
+                due = (record['offset_ms'] - first_offset) / 1000 / speed
+                delay = started_at + due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            self.pending_slots.acquire()
+            done = threading.Event()
+            key = session_key(record)
+            previous = None
+            if key is not None:
+                previous = self.last_in_session.get(key)
+                self.last_in_session[key] = done
+
+            thread = threading.Thread(target=self.send, args=(record, previous, done), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - started_at
+
+    def report(self, elapsed_seconds):
+        """Imprimir la distribución de latencias por ruta"""
+        total = sum(len(latencies) for latencies in self.results.values())
+        print(f"\n{total} requests en {elapsed_seconds:.1f}s ({total / max(elapsed_seconds, 1e-9):.1f} req/s)\n")
+        header = f"{'ruta':<50} {'n':>6} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8} {'5xx':>5} {'≠status':>8}"
+        print(header)
+        print('-' * len(header))
+        for route in sorted(self.results):
+            latencies = sorted(self.results[route])
+            print(
+                f"{route:<50} {len(latencies):>6} "
+                f"{percentile(latencies, 0.50):>8.1f} {percentile(latencies, 0.90):>8.1f} "
+                f"{percentile(latencies, 0.99):>8.1f} {latencies[-1]:>8.1f} "
+                f"{self.errors[route]:>5} {self.status_mismatches[route]:>8}"
+            )
+        print("\n(latencias en ms)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reproducir tráfico capturado')
+    parser.add_argument('capture', help='Archivo JSONL generado con TRAFFIC_CAPTURE_PATH')
+    parser.add_argument('--target', default='http://localhost:5000')
+    parser.add_argument('--speed', default='1', help='Multiplicador de velocidad (1, 2, 10...) o "max"')
+    parser.add_argument('--concurrency', type=int, default=16, help='Requests simultáneos como máximo')
+    parser.add_argument('--password', help='Contraseña a usar en lugar de las redactadas')
+    parser.add_argument('--timeout', type=float, default=30)
+    args = parser.parse_args()
+
+    speed = None if args.speed == 'max' else float(args.speed)
+    if speed is not None and speed <= 0:
+        sys.exit('--speed debe ser mayor que 0 o "max"')
+
+    records = load_records(args.capture)
+    if not records:
+        sys.exit('La captura está vacía')
+
+    print(f"Reproduciendo {len(records)} requests contra {args.target} a {args.speed}x...")
+    replayer = Replayer(args.target, args.concurrency, args.password, args.timeout)
+    elapsed = replayer.run(records, speed)
+    replayer.report(elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,522 @@
+"""
+Herramienta de administración de shards de terapia
+
+Uso:
+    python shard_tool.py status
+    python shard_tool.py init-sequences
+    python shard_tool.py add-shard <config.json>
+    python shard_tool.py move <usr_index> <shard>
+    python shard_tool.py rebalance [--batch-size 100] [--dry-run]
+
+Trabaja sobre el mapa indicado en DB_SHARD_MAP (ver shard_map.example.json).
+
+- init-sequences: ajusta la secuencia de session_id de cada shard para que
+  session_id % session_id_stride == número de shard. Correr una vez al crear
+  los shards y cada vez que se agregue uno. La primera vez registra en el
+  mapa legacy_session_id_max (los ids anteriores viven en el shard 0).
+- add-shard: agrega un shard al mapa. En la misma escritura fija a todos los
+  usuarios que ya tienen datos en el directorio "users", así el módulo con
+  un shard más solo ubica a usuarios nuevos. Los que llegaron a escribir
+  mientras los procesos recargaban el mapa se fijan en una segunda pasada.
+- move: mueve todas las sesiones y respuestas de un usuario a otro shard y
+  lo fija ahí en el directorio.
+- rebalance: reparte usuarios entre los shards hasta emparejar la cantidad
+  por shard (por ejemplo, para llenar uno recién agregado), en lotes.
+
+Cada lote de usuarios se mueve así:
+
+1. se bloquean en "frozen_users" (la app rechaza crear sesiones con 503) y
+   se espera a que los procesos recarguen el mapa;
+2. se copian sesiones y respuestas al destino conservando el session_id;
+3. en una sola escritura del mapa se fijan los usuarios en el destino y se
+   desbloquean, y se espera otra recarga;
+4. se borra el origen.
+
+Los usuarios con una sesión activa se omiten: sus respuestas seguirían
+llegando al origen mientras se copia. Por eso las sesiones movidas están
+siempre cerradas y el mapa no las lista una por una (crecería con cada
+movimiento y cada proceso lo relee): se consultan por usuario (resume,
+estadísticas, trends, dashboard) y los endpoints por session_id, que solo
+operan sobre sesiones activas, las tratan como inexistentes. Las sesiones
+nuevas toman su id de la secuencia del shard del usuario.
+
+Para probar en local basta con varias bases en el mismo Postgres. Se
+arranca con shard_map.example.json, que tiene un solo shard (donde ya están
+todos los datos), y el segundo se agrega con add-shard para que los
+usuarios existentes queden fijados en el shard 0:
+
+    createdb alexa_shard0 && createdb alexa_shard1
+    (crear therapy_sessions / therapy_answers en cada una)
+    cp shard_map.example.json shard_map.json
+    DB_SHARD_MAP=shard_map.json python shard_tool.py init-sequences
+    DB_SHARD_MAP=shard_map.json python shard_tool.py add-shard shard.example.json
+    DB_SHARD_MAP=shard_map.json python shard_tool.py init-sequences
+    DB_SHARD_MAP=shard_map.json python shard_tool.py rebalance
+
+Nunca agregar un shard editando "shards" o "placement" a mano: los
+usuarios existentes que no estén en "users" pasarían a resolverse por
+módulo hacia un shard donde no están sus datos.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import Json
+
+from app import (
+    DB_SHARD_MAP, SHARD_MAP_RELOAD_SECONDS, USER_VERSION_CLOCK_SQL,
+    read_shard_map, user_shard
+)
+
+
+def connect_shard(shard_map, shard):
+    """Abrir una conexión directa (sin pool) a un shard"""
+    return psycopg2.connect(**shard_map['shards'][shard])
+
+
+def update_shard_map(path, change):
+    """
+    Aplicar `change(raw)` al JSON del mapa y devolver el mapa validado
+
+    Se reescribe el JSON original en un archivo temporal y se reemplaza de
+    forma atómica; si el resultado no es válido el archivo no se toca.
+    """
+    with open(path, encoding='utf-8') as f:
+        raw = json.load(f)
+
+    change(raw)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(raw, f, indent=2, ensure_ascii=False)
+        f.write('\n')
+    try:
+        read_shard_map(tmp_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+    return read_shard_map(path)
+
+
+def wait_for_reload():
+    """Dar tiempo a que todos los procesos recarguen el mapa"""
+    print(f"[DEBUG] ⏳ Esperando {SHARD_MAP_RELOAD_SECONDS + 1:.0f}s a que los procesos recarguen el mapa")
+    time.sleep(SHARD_MAP_RELOAD_SECONDS + 1)
+
+
+def copy_row(cursor, table, row, skip_column=None, overrides=None):
+    """Insertar una fila copiada de otro shard"""
+    values = {column: value for column, value in row.items() if column != skip_column}
+    values.update(overrides or {})
+    for column, value in values.items():
+        # Las columnas JSON llegan como dict/list y hay que adaptarlas
+        if isinstance(value, (dict, list)):
+            values[column] = Json(value)
+
+    columns = list(values)
+    cursor.execute(
+        sql.SQL("INSERT INTO {} ({}) VALUES ({})").format(
+            sql.Identifier(table),
+            sql.SQL(', ').join(map(sql.Identifier, columns)),
+            sql.SQL(', ').join(sql.Placeholder() * len(columns))
+        ),
+        [values[column] for column in columns]
+    )
+
+
+def fetch_dicts(cursor, query, params):
+    """Ejecutar una consulta y devolver las filas como diccionarios"""
+    cursor.execute(query, params)
+    columns = [column.name for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def copy_sessions(src_cursor, dst_cursor, session_ids):
+    """
+    Copiar sesiones y sus respuestas conservando el session_id
+
+    El stride hace que los session_id no se repitan entre shards. Lo que
+    haya quedado de un intento anterior en el destino se reemplaza, así un
+    lote que falló a mitad de camino se puede repetir.
+    """
+    delete_sessions(dst_cursor, session_ids)
+
+    sessions = fetch_dicts(
+        src_cursor,
+        "SELECT * FROM therapy_sessions WHERE session_id = ANY(%s) ORDER BY session_id",
+        (session_ids,)
+    )
+    for session in sessions:
+        copy_row(dst_cursor, 'therapy_sessions', session)
+
+    answers = fetch_dicts(
+        src_cursor,
+        "SELECT * FROM therapy_answers WHERE session_id = ANY(%s) ORDER BY answer_id",
+        (session_ids,)
+    )
+    for answer in answers:
+        # answer_id sale de la secuencia de cada shard: el destino asigna uno nuevo
+        copy_row(dst_cursor, 'therapy_answers', answer, 'answer_id')
+
+    return len(sessions), len(answers)
+
+
+def delete_sessions(cursor, session_ids):
+    """Borrar sesiones (y sus respuestas) ya copiadas a otro shard"""
+    cursor.execute("DELETE FROM therapy_answers WHERE session_id = ANY(%s)", (session_ids,))
+    cursor.execute("DELETE FROM therapy_sessions WHERE session_id = ANY(%s)", (session_ids,))
+
+
+def find_user_sessions(shard_map, usr_indexes):
+    """usr_index -> [(shard, session_id, session_status)] en todos los shards"""
+    found = {usr_index: [] for usr_index in usr_indexes}
+    for shard in shard_map['shards']:
+        conn = connect_shard(shard_map, shard)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT usr_index, session_id, session_status
+                FROM therapy_sessions
+                WHERE usr_index = ANY(%s)
+                """,
+                (list(usr_indexes),)
+            )
+            for usr_index, session_id, status in cursor.fetchall():
+                found[usr_index].append((shard, session_id, status))
+        finally:
+            conn.close()
+    return found
+
+
+def users_by_shard(shard_map):
+    """shard -> {usr_index} de los usuarios con sesiones en ese shard"""
+    users = {}
+    for shard in shard_map['shards']:
+        conn = connect_shard(shard_map, shard)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT DISTINCT usr_index FROM therapy_sessions")
+            users[shard] = {row[0] for row in cursor.fetchall()}
+        finally:
+            conn.close()
+    return users
+
+
+def with_active_sessions(sessions_by_user):
+    """Usuarios que tienen alguna sesión activa"""
+    return {
+        usr_index for usr_index, sessions in sessions_by_user.items()
+        if any(status == 'active' for _, _, status in sessions)
+    }
+
+
+def move_users(path, shard_map, moves):
+    """
+    Mover un lote de usuarios: {usr_index: shard destino}
+
+    Devuelve el mapa actualizado y los usuarios que se movieron. Los que
+    tienen una sesión activa (antes o después de bloquearlos) se omiten.
+    """
+    skipped = with_active_sessions(find_user_sessions(shard_map, moves))
+    for usr_index in sorted(skipped):
+        print(f"[ERROR] ⚠️ Usuario {usr_index} tiene una sesión activa, se omite")
+    moves = {usr_index: target for usr_index, target in moves.items() if usr_index not in skipped}
+    if not moves:
+        return shard_map, []
+
+    def unfreeze(users):
+        def change(raw):
+            raw['frozen_users'] = sorted(set(raw.get('frozen_users', [])) - set(users))
+        return change
+
+    def freeze(raw):
+        raw['frozen_users'] = sorted(set(raw.get('frozen_users', [])) | set(moves))
+
+    shard_map = update_shard_map(path, freeze)
+    frozen = set(moves)
+    print(f"[DEBUG] 🔒 {len(frozen)} usuarios bloqueados")
+    try:
+        wait_for_reload()
+
+        # Con los usuarios bloqueados nadie crea sesiones: este es el estado final
+        sessions_by_user = find_user_sessions(shard_map, moves)
+        became_active = with_active_sessions(sessions_by_user)
+        for usr_index in sorted(became_active):
+            print(f"[ERROR] ⚠️ Usuario {usr_index} empezó una sesión antes del bloqueo, se omite")
+        moves = {usr_index: target for usr_index, target in moves.items() if usr_index not in became_active}
+
+        # (origen, destino) -> session_ids
+        plan = {}
+        for usr_index, target in moves.items():
+            for shard, session_id, _ in sessions_by_user[usr_index]:
+                if shard != target:
+                    plan.setdefault((shard, target), []).append(session_id)
+
+        for target in sorted({target for _, target in plan}):
+            dst_conn = connect_shard(shard_map, target)
+            try:
+                dst_cursor = dst_conn.cursor()
+                for (shard, batch_target), session_ids in plan.items():
+                    if batch_target != target:
+                        continue
+                    src_conn = connect_shard(shard_map, shard)
+                    try:
+                        copied = copy_sessions(src_conn.cursor(), dst_cursor, session_ids)
+                    finally:
+                        src_conn.close()
+                    print(f"[DEBUG] Shard {shard} -> {target}: {copied[0]} sesiones, {copied[1]} respuestas")
+
+                # Las sesiones cambiaron de lugar: invalidar los ETag que tengan los clientes
+                for usr_index in [usr for usr, usr_target in moves.items() if usr_target == target]:
+                    dst_cursor.execute(
+                        f"""
+                        INSERT INTO therapy_user_versions AS v (usr_index, version)
+                        VALUES (%s, {USER_VERSION_CLOCK_SQL})
+                        ON CONFLICT (usr_index) DO UPDATE
+                        SET version = GREATEST(v.version + 1, EXCLUDED.version)
+                        """,
+                        (usr_index,)
+                    )
+                dst_conn.commit()
+            except Exception:
+                dst_conn.rollback()
+                raise
+            finally:
+                dst_conn.close()
+
+        def assign(raw):
+            users = raw.setdefault('users', {})
+            sessions = raw.get('sessions', {})
+            for usr_index, target in moves.items():
+                users[str(usr_index)] = target
+            # Las sesiones movidas no se listan (y se quitan las que estaban)
+            for session_ids in plan.values():
+                for session_id in session_ids:
+                    sessions.pop(str(session_id), None)
+            unfreeze(frozen)(raw)
+
+        shard_map = update_shard_map(path, assign)
+        frozen = set()
+        print(f"[DEBUG] 🗺️ {len(moves)} usuarios fijados en su nuevo shard y desbloqueados")
+
+    finally:
+        # Si algo falló el mapa sigue apuntando al origen: solo desbloquear.
+        # Las copias que hayan quedado en el destino se reemplazan al reintentar
+        if frozen:
+            update_shard_map(path, unfreeze(frozen))
+
+    if plan:
+        wait_for_reload()
+        for (shard, _), session_ids in plan.items():
+            src_conn = connect_shard(shard_map, shard)
+            try:
+                delete_sessions(src_conn.cursor(), session_ids)
+                src_conn.commit()
+            finally:
+                src_conn.close()
+
+    for usr_index, target in sorted(moves.items()):
+        print(f"[DEBUG] ✅ Usuario {usr_index} en el shard {target}")
+    return shard_map, sorted(moves)
+
+
+def cmd_status(shard_map, args):
+    for shard in shard_map['shards']:
+        conn = connect_shard(shard_map, shard)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT usr_index, array_agg(session_id)
+                FROM therapy_sessions
+                GROUP BY usr_index
+                """
+            )
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+
+        sessions = sum(len(session_ids) for _, session_ids in rows)
+        misplaced = sum(1 for usr_index, _ in rows if user_shard(shard_map, usr_index) != shard)
+        print(f"Shard {shard}: {len(rows)} usuarios, {sessions} sesiones, {misplaced} usuarios fuera de lugar")
+    print(f"Directorio: {len(shard_map['users'])} usuarios, {len(shard_map['sessions'])} sesiones fijadas, "
+          f"{len(shard_map['frozen_users'])} bloqueados")
+
+
+def cmd_init_sequences(shard_map, args):
+    stride = shard_map['session_id_stride']
+    for shard in shard_map['shards']:
+        conn = connect_shard(shard_map, shard)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT pg_get_serial_sequence('therapy_sessions', 'session_id')")
+            sequence = cursor.fetchone()[0]
+            cursor.execute("SELECT COALESCE(MAX(session_id), 0) FROM therapy_sessions")
+            max_id = cursor.fetchone()[0]
+
+            if shard == 0:
+                with open(DB_SHARD_MAP, encoding='utf-8') as f:
+                    legacy_known = 'legacy_session_id_max' in json.load(f)
+                if not legacy_known:
+                    # Primera vez: los ids existentes son de antes del sharding
+                    def set_legacy(raw):
+                        raw['legacy_session_id_max'] = max_id
+                    shard_map = update_shard_map(DB_SHARD_MAP, set_legacy)
+                    print(f"Shard 0: legacy_session_id_max = {max_id}")
+
+            # Siguiente valor > max_id con el residuo del shard
+            next_id = max_id + 1
+            next_id += (shard - next_id) % stride
+            if next_id <= 0:
+                next_id += stride
+
+            cursor.execute(sql.SQL("ALTER SEQUENCE {} INCREMENT BY {}").format(
+                sql.SQL(sequence), sql.Literal(stride)
+            ))
+            cursor.execute("SELECT setval(%s, %s, false)", (sequence, next_id))
+            conn.commit()
+            print(f"Shard {shard}: {sequence} incrementa {stride}, próximo id {next_id}")
+        finally:
+            conn.close()
+
+
+def pin_unlisted_users(shard_map, users_on_shard):
+    """Fijar en el directorio a los usuarios con datos que todavía no están"""
+    def pin(raw):
+        users = raw.setdefault('users', {})
+        for shard, usr_indexes in users_on_shard.items():
+            for usr_index in usr_indexes:
+                users.setdefault(str(usr_index), shard)
+    return pin
+
+
+def cmd_add_shard(shard_map, args):
+    with open(args.config, encoding='utf-8') as f:
+        config = json.load(f)
+
+    new_shard = len(shard_map['shards'])
+    if new_shard >= shard_map['session_id_stride']:
+        sys.exit(f"session_id_stride ({shard_map['session_id_stride']}) no admite un shard {new_shard}: "
+                 "el stride no puede cambiar sin renumerar sesiones")
+
+    # Un usuario con datos en varios shards queda fijado en el primero;
+    # status lo muestra fuera de lugar y move lo junta
+    users_on_shard = users_by_shard(shard_map)
+    pin = pin_unlisted_users(shard_map, users_on_shard)
+
+    def add(raw):
+        pin(raw)
+        raw['shards'][str(new_shard)] = config
+        if 'placement' in raw:
+            raw['placement'].append(new_shard)
+
+    shard_map = update_shard_map(DB_SHARD_MAP, add)
+    print(f"Shard {new_shard} agregado, {len(shard_map['users'])} usuarios en el directorio")
+
+    # Usuarios nuevos que escribieron con el mapa anterior mientras se recargaba
+    wait_for_reload()
+    stragglers = {
+        shard: {usr for usr in usr_indexes if usr not in shard_map['users']}
+        for shard, usr_indexes in users_by_shard(shard_map).items()
+    }
+    stragglers = {
+        shard: {usr for usr in usr_indexes if user_shard(shard_map, usr) != shard}
+        for shard, usr_indexes in stragglers.items()
+    }
+    if any(stragglers.values()):
+        shard_map = update_shard_map(DB_SHARD_MAP, pin_unlisted_users(shard_map, stragglers))
+        print(f"{sum(map(len, stragglers.values()))} usuarios que escribieron durante la recarga fijados")
+    print(f"Correr init-sequences para preparar la secuencia del shard {new_shard}")
+
+
+def cmd_move(shard_map, args):
+    if args.shard not in shard_map['shards']:
+        sys.exit(f"Shard inexistente: {args.shard}")
+    move_users(DB_SHARD_MAP, shard_map, {args.usr_index: args.shard})
+
+
+def plan_rebalance(shard_map, users_on_shard):
+    """
+    {usr_index: destino} para emparejar la cantidad de usuarios por shard
+
+    Se sacan usuarios de los shards con más de la media (los de usr_index
+    más alto primero) hacia los que tienen menos.
+    """
+    counts = {shard: len(users_on_shard.get(shard, ())) for shard in shard_map['shards']}
+    target_count = -(-sum(counts.values()) // len(counts))
+
+    donors = []
+    for shard, usr_indexes in users_on_shard.items():
+        extra = counts[shard] - target_count
+        if extra > 0:
+            donors.extend(sorted(usr_indexes, reverse=True)[:extra])
+
+    moves = {}
+    for shard in sorted(counts, key=counts.get):
+        while counts[shard] < target_count and donors:
+            moves[donors.pop()] = shard
+            counts[shard] += 1
+    return moves
+
+
+def cmd_rebalance(shard_map, args):
+    moves = plan_rebalance(shard_map, users_by_shard(shard_map))
+    print(f"Usuarios a mover: {len(moves)}")
+    if args.dry_run:
+        for usr_index, target in sorted(moves.items()):
+            print(f"  usuario {usr_index} -> shard {target}")
+        return
+
+    # Dos esperas de recarga por lote, no por usuario
+    pending = sorted(moves.items())
+    moved = 0
+    for start in range(0, len(pending), args.batch_size):
+        batch = dict(pending[start:start + args.batch_size])
+        shard_map, batch_moved = move_users(DB_SHARD_MAP, shard_map, batch)
+        moved += len(batch_moved)
+        print(f"[DEBUG] Lote {start // args.batch_size + 1}: {len(batch_moved)}/{len(batch)} usuarios movidos")
+    print(f"✅ {moved} de {len(moves)} usuarios movidos")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Administración de shards de terapia')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('status', help='Usuarios y sesiones por shard')
+    subparsers.add_parser('init-sequences', help='Preparar secuencias de session_id')
+
+    add_parser = subparsers.add_parser('add-shard', help='Agregar un shard fijando a los usuarios existentes')
+    add_parser.add_argument('config', help='JSON con host, port, database, user y password del shard')
+
+    move_parser = subparsers.add_parser('move', help='Mover un usuario a otro shard')
+    move_parser.add_argument('usr_index', type=int)
+    move_parser.add_argument('shard', type=int)
+
+    rebalance_parser = subparsers.add_parser('rebalance', help='Emparejar la cantidad de usuarios por shard')
+    rebalance_parser.add_argument('--dry-run', action='store_true')
+    rebalance_parser.add_argument('--batch-size', type=int, default=100, help='Usuarios por lote')
+
+    args = parser.parse_args()
+
+    if not DB_SHARD_MAP:
+        sys.exit('DB_SHARD_MAP no está definido: no hay shards que administrar')
+    shard_map = read_shard_map(DB_SHARD_MAP)
+
+    commands = {
+        'status': cmd_status,
+        'init-sequences': cmd_init_sequences,
+        'add-shard': cmd_add_shard,
+        'move': cmd_move,
+        'rebalance': cmd_rebalance
+    }
+    commands[args.command](shard_map, args)
+
+
+if __name__ == '__main__':
+    main()
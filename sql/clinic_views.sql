@@ -0,0 +1,49 @@
+-- ============================================================================
+-- VISTAS MATERIALIZADAS DEL DASHBOARD CLÍNICO (/clinic/patients)
+-- ============================================================================
+--
+-- Correr en cada base que tenga therapy_sessions (en cada shard si se usa
+-- DB_SHARD_MAP). La aplicación la refresca con
+-- REFRESH MATERIALIZED VIEW CONCURRENTLY cada CLINIC_REFRESH_SECONDS; el
+-- índice único es obligatorio para poder refrescar sin bloquear lecturas.
+--
+-- Solo se agrega therapy_sessions (sus contadores ya resumen las
+-- respuestas), nunca therapy_answers. Con DB_SHARD_MAP usr_mstr no está en
+-- los shards, así que la vista no puede partir de la tabla de usuarios: los
+-- pacientes registrados sin ninguna sesión quedan fuera del dashboard.
+--
+-- Cada worker de cada instancia corre un hilo de refresco. Antes de
+-- refrescar consultan clinic_view_refresh_log (bajo un advisory lock) y
+-- se saltan el refresh si otro proceso ya lo hizo en este intervalo.
+
+CREATE TABLE IF NOT EXISTS clinic_view_refresh_log (
+    view_name TEXT PRIMARY KEY,
+    refreshed_at TIMESTAMPTZ NOT NULL
+);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS clinic_patient_progress AS
+SELECT
+    usr_index,
+    COUNT(*) FILTER (WHERE session_status = 'completed') AS completed_sessions,
+    COALESCE(SUM(total_questions) FILTER (WHERE session_status = 'completed'), 0) AS total_questions,
+    COALESCE(SUM(correct_answers) FILTER (WHERE session_status = 'completed'), 0) AS total_correct,
+    COALESCE(ROUND(AVG(CASE
+        WHEN total_questions > 0
+        THEN (correct_answers::DECIMAL / total_questions) * 100
+        ELSE 0
+    END) FILTER (WHERE session_status = 'completed'), 2), 0) AS avg_accuracy,
+    MAX(COALESCE(ended_at, started_at)) AS last_activity,
+    BOOL_OR(session_status = 'active') AS has_active_session
+FROM therapy_sessions
+GROUP BY usr_index;
+
+CREATE UNIQUE INDEX IF NOT EXISTS clinic_patient_progress_usr_index_idx
+    ON clinic_patient_progress (usr_index);
+
+-- Un índice por columna de orden, con usr_index como desempate para keyset
+CREATE INDEX IF NOT EXISTS clinic_patient_progress_last_activity_idx
+    ON clinic_patient_progress (last_activity, usr_index);
+CREATE INDEX IF NOT EXISTS clinic_patient_progress_accuracy_idx
+    ON clinic_patient_progress (avg_accuracy, usr_index);
+CREATE INDEX IF NOT EXISTS clinic_patient_progress_sessions_idx
+    ON clinic_patient_progress (completed_sessions, usr_index);
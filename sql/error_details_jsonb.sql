@@ -0,0 +1,82 @@
+-- ============================================================================
+-- error_details COMO JSONB + ÍNDICES PARA /therapy/errors
+-- ============================================================================
+--
+-- Correr en cada base que tenga therapy_answers (en cada shard si se usa
+-- DB_SHARD_MAP), antes de desplegar la versión de la app que consulta
+-- error_details con operadores JSONB.
+--
+-- Un ALTER COLUMN ... TYPE JSONB reescribiría toda la tabla bajo un lock
+-- ACCESS EXCLUSIVE (sin lecturas ni escrituras mientras dure). En su lugar:
+-- columna nueva, trigger que la mantiene al día, backfill por lotes con
+-- COMMIT entre lotes y un cambio de nombre final que solo toma el lock un
+-- instante. Requiere Postgres 11+ (CALL con COMMIT).
+--
+-- Ejecutar con psql sin --single-transaction: ni el CALL ni los CREATE
+-- INDEX CONCURRENTLY pueden ir dentro de una transacción. Si alguna fila
+-- tiene texto que no es JSON válido el backfill se detiene en ese lote:
+-- corregirla y volver a correr el archivo (cada paso es idempotente).
+
+-- 1. Columna nueva (sin reescritura: no tiene default)
+ALTER TABLE therapy_answers ADD COLUMN IF NOT EXISTS error_details_jsonb JSONB;
+
+-- 2. Las filas que se escriban durante el backfill ya llegan convertidas
+CREATE OR REPLACE FUNCTION therapy_answers_sync_error_details() RETURNS trigger AS $$
+BEGIN
+    NEW.error_details_jsonb := NULLIF(NEW.error_details::text, '')::jsonb;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS therapy_answers_sync_error_details ON therapy_answers;
+CREATE TRIGGER therapy_answers_sync_error_details
+    BEFORE INSERT OR UPDATE OF error_details ON therapy_answers
+    FOR EACH ROW EXECUTE FUNCTION therapy_answers_sync_error_details();
+
+-- 3. Backfill por lotes; cada COMMIT libera los locks de fila del lote
+CREATE OR REPLACE PROCEDURE therapy_answers_backfill_error_details(batch_size INT DEFAULT 10000)
+LANGUAGE plpgsql AS $$
+DECLARE
+    updated INT;
+BEGIN
+    LOOP
+        UPDATE therapy_answers
+        SET error_details_jsonb = NULLIF(error_details::text, '')::jsonb
+        WHERE answer_id IN (
+            SELECT answer_id FROM therapy_answers
+            WHERE error_details_jsonb IS NULL
+            AND NULLIF(error_details::text, '') IS NOT NULL
+            LIMIT batch_size
+        );
+        GET DIAGNOSTICS updated = ROW_COUNT;
+        EXIT WHEN updated = 0;
+        COMMIT;
+    END LOOP;
+END;
+$$;
+
+CALL therapy_answers_backfill_error_details();
+
+-- 4. Cambio de columnas: lock breve, sin reescribir la tabla
+BEGIN;
+LOCK TABLE therapy_answers IN ACCESS EXCLUSIVE MODE;
+UPDATE therapy_answers
+SET error_details_jsonb = NULLIF(error_details::text, '')::jsonb
+WHERE error_details_jsonb IS NULL
+AND NULLIF(error_details::text, '') IS NOT NULL;
+DROP TRIGGER therapy_answers_sync_error_details ON therapy_answers;
+ALTER TABLE therapy_answers DROP COLUMN error_details;
+ALTER TABLE therapy_answers RENAME COLUMN error_details_jsonb TO error_details;
+COMMIT;
+
+DROP PROCEDURE IF EXISTS therapy_answers_backfill_error_details(INT);
+DROP FUNCTION IF EXISTS therapy_answers_sync_error_details();
+
+-- Contención (@>) y existencia de claves (?, ?&) sobre error_details
+CREATE INDEX CONCURRENTLY IF NOT EXISTS therapy_answers_error_details_gin_idx
+    ON therapy_answers USING GIN (error_details);
+
+-- Búsqueda por prefijo sin distinguir mayúsculas: lower(error_type) LIKE 'substitution_r%'
+CREATE INDEX CONCURRENTLY IF NOT EXISTS therapy_answers_error_type_idx
+    ON therapy_answers (lower(error_type) text_pattern_ops)
+    WHERE error_type IS NOT NULL;
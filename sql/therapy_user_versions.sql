@@ -0,0 +1,23 @@
+-- ============================================================================
+-- VERSIÓN POR USUARIO PARA GET CONDICIONAL (ETag / Last-Modified)
+-- ============================================================================
+--
+-- Correr en cada base que tenga therapy_sessions (en cada shard si se usa
+-- DB_SHARD_MAP) ANTES de desplegar la versión de la app que la usa: las
+-- escrituras de sesión suben la versión en la misma sentencia.
+--
+-- version son los microsegundos del reloj de la última escritura (o la
+-- anterior + 1), así nunca retrocede aunque el usuario cambie de shard.
+
+CREATE TABLE IF NOT EXISTS therapy_user_versions (
+    usr_index INTEGER PRIMARY KEY,
+    version BIGINT NOT NULL
+);
+
+-- Usuarios que ya tienen sesiones: arrancar con la fecha de su última actividad
+INSERT INTO therapy_user_versions (usr_index, version)
+SELECT usr_index,
+       (extract(epoch FROM MAX(COALESCE(ended_at, started_at))) * 1000000)::bigint
+FROM therapy_sessions
+GROUP BY usr_index
+ON CONFLICT (usr_index) DO NOTHING;
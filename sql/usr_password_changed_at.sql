@@ -0,0 +1,35 @@
+-- ============================================================================
+-- FECHA DEL ÚLTIMO CAMBIO DE CONTRASEÑA (TOKENS DE /alexa/launch)
+-- ============================================================================
+--
+-- Correr en la base principal (la que tiene usr_mstr) ANTES de desplegar la
+-- versión de la app que la usa.
+--
+-- Los tokens de arranque de Alexa llevan una huella de
+-- usr_password_changed_at: cambiar la contraseña la cambia y revoca los
+-- tokens. No alcanza con el hash: la app lo reescribe al subir el costo de
+-- bcrypt (rehash) y eso no debe desloguear a nadie.
+--
+-- El trigger la actualiza con cualquier UPDATE de usr_password, venga de
+-- donde venga, salvo que la transacción marque app.password_rehash = 'on'
+-- (lo hace storage.update_password_hash). Al desplegar, los tokens firmados
+-- por la versión anterior dejan de valer una vez: la huella cambió de
+-- formato y esos usuarios vuelven a dar la contraseña.
+
+-- Sin reescritura de la tabla: now() es el mismo valor para todas las filas
+ALTER TABLE usr_mstr ADD COLUMN IF NOT EXISTS usr_password_changed_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+CREATE OR REPLACE FUNCTION usr_mstr_password_changed() RETURNS trigger AS $$
+BEGIN
+    IF NEW.usr_password IS DISTINCT FROM OLD.usr_password
+       AND current_setting('app.password_rehash', true) IS DISTINCT FROM 'on' THEN
+        NEW.usr_password_changed_at := clock_timestamp();
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS usr_mstr_password_changed ON usr_mstr;
+CREATE TRIGGER usr_mstr_password_changed
+    BEFORE UPDATE OF usr_password ON usr_mstr
+    FOR EACH ROW EXECUTE FUNCTION usr_mstr_password_changed();
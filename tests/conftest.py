@@ -0,0 +1,76 @@
+"""
+Configuración común de los tests
+
+app.py lee el entorno al importarse: se fija antes de importarlo. Por
+defecto se usa el almacenamiento en memoria. Con STORAGE_BACKEND=postgres
+y las variables DB_* apuntando a una base de prueba (con usr_mstr,
+therapy_sessions, therapy_answers y los scripts de sql/) corren además los
+tests que necesitan Postgres.
+"""
+import os
+import uuid
+
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+os.environ.setdefault('BCRYPT_ROUNDS', '4')
+os.environ.setdefault('BCRYPT_TARGET_MS', '0')
+os.environ.setdefault('CLINIC_REFRESH_SECONDS', '0')
+os.environ.setdefault('SECRET_KEY', 'tests')
+
+import pytest  # noqa: E402
+
+import app as app_module  # noqa: E402
+
+PASSWORD = 'secreto'
+
+requires_postgres = pytest.mark.skipif(
+    app_module.storage.name != 'postgres',
+    reason='requiere STORAGE_BACKEND=postgres y una base de prueba'
+)
+
+
+@pytest.fixture
+def client():
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def user(client):
+    """Usuario recién registrado: dict con usr_index, email y password"""
+    email = f'paciente-{uuid.uuid4().hex[:12]}@example.com'
+    response = client.post('/register_user', json={
+        'name': 'Paciente de prueba',
+        'email': email,
+        'password': PASSWORD
+    })
+    assert response.status_code == 201, response.get_json()
+    return {
+        'usr_index': response.get_json()['data']['usr_index'],
+        'email': email,
+        'password': PASSWORD
+    }
+
+
+def start_session(client, usr_index, therapy_type='palabras'):
+    """Abrir una sesión y devolver su session_id"""
+    response = client.post('/therapy/session/start', json={
+        'usr_index': usr_index,
+        'therapy_type': therapy_type,
+        'therapy_category': 'animales'
+    })
+    assert response.status_code == 201, response.get_json()
+    return response.get_json()['data']['session_id']
+
+
+def answer_body(index, correct=True):
+    """Respuesta de ejemplo para /therapy/session/<id>/answer"""
+    return {
+        'question_text': 'perro',
+        'expected_answer': 'perro',
+        'user_answer': 'perro' if correct else 'pero',
+        'pronunciation_score': 90 if correct else 60,
+        'is_correct': correct,
+        'error_type': None if correct else 'substitution_rr_to_r',
+        'error_details': {} if correct else {'position': 2, 'expected': 'rr', 'actual': 'r'},
+        'next_question_index': index + 1,
+        'category': 'animales'
+    }
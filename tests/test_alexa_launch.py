@@ -0,0 +1,152 @@
+"""Tokens de /alexa/launch: vida útil, revocación y rehash de bcrypt"""
+from datetime import datetime, timezone
+import time
+
+import psycopg2
+import pytest
+
+import app as app_module
+from tests.conftest import requires_postgres
+from tests.test_bcrypt import hash_with_rounds, stored_hash, wait_for_rehash
+
+
+def launch(client, **body):
+    return client.post('/alexa/launch', json=body)
+
+
+def login_token(client, user):
+    response = launch(client, email=user['email'], password=user['password'])
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()['data']['token']
+
+
+def change_password(usr_index, new_hash):
+    """Cambio de contraseña real (no un rehash), como lo haría un UPDATE a mano"""
+    if app_module.storage.name == 'postgres':
+        conn = psycopg2.connect(**app_module.DB_CONFIG)
+        try:
+            with conn, conn.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE usr_mstr SET usr_password = %s WHERE usr_index = %s",
+                    (new_hash, usr_index)
+                )
+        finally:
+            conn.close()
+    else:
+        user = app_module.storage.users[usr_index]
+        user['usr_password'] = new_hash
+        user['usr_password_changed_at'] = datetime.now(timezone.utc)
+
+
+def password_changed_at(usr_index):
+    return app_module.storage.find_user_by_index(usr_index)[4]
+
+
+def test_launch_with_password_returns_user_and_token(client, user):
+    response = launch(client, email=user['email'], password=user['password'])
+    assert response.status_code == 200
+    data = response.get_json()['data']
+    assert data['usr_index'] == user['usr_index']
+    assert data['usr_email'] == user['email']
+    assert data['token']
+    assert data['token_expires_at'] == pytest.approx(time.time() + app_module.ALEXA_TOKEN_MAX_AGE_SECONDS, abs=5)
+    assert data['resume']['has_active_session'] is False
+
+
+@pytest.mark.parametrize('body', [
+    {'email': 'nadie@example.com', 'password': 'x'},
+    {'token': 'no-es-un-token'}
+])
+def test_launch_rejects_bad_credentials(client, body):
+    assert launch(client, **body).status_code == 401
+
+
+def test_launch_token_reused_until_near_expiry(client, user, monkeypatch):
+    token = login_token(client, user)
+
+    assert launch(client, token=token).get_json()['data']['token'] == token
+
+    time.sleep(1.1)
+    monkeypatch.setattr(app_module, 'ALEXA_TOKEN_REFRESH_SECONDS', app_module.ALEXA_TOKEN_MAX_AGE_SECONDS)
+    refreshed = launch(client, token=token).get_json()['data']['token']
+    assert refreshed != token
+    assert launch(client, token=refreshed).status_code == 200
+
+
+def test_launch_token_has_max_lifetime(client, user, monkeypatch):
+    token = login_token(client, user)
+    monkeypatch.setattr(app_module, 'ALEXA_TOKEN_MAX_LIFETIME_SECONDS', -1)
+
+    assert launch(client, token=token).status_code == 401
+
+
+def test_launch_token_revoked_by_password_change(client, user):
+    token = login_token(client, user)
+    time.sleep(0.01)
+    change_password(user['usr_index'], hash_with_rounds('nueva', 4))
+
+    assert launch(client, token=token).status_code == 401
+
+
+def test_launch_token_survives_cost_upgrade(client, user, monkeypatch):
+    monkeypatch.setattr(app_module, 'bcrypt_rounds', 5)
+    token = login_token(client, user)
+    wait_for_rehash(user['usr_index'])
+
+    assert app_module.get_hash_rounds(stored_hash(user['usr_index'])) == 5
+    assert launch(client, token=token).status_code == 200
+
+
+def test_launch_token_survives_login_rehash(client, user, monkeypatch):
+    token = login_token(client, user)
+    old_hash = stored_hash(user['usr_index'])
+
+    monkeypatch.setattr(app_module, 'bcrypt_rounds', 5)
+    response = client.post('/login_user', json={'email': user['email'], 'password': user['password']})
+    assert response.status_code == 200
+    wait_for_rehash(user['usr_index'])
+
+    assert stored_hash(user['usr_index']) != old_hash
+    assert launch(client, token=token).status_code == 200
+
+
+def test_launch_rehashes_off_the_request_path(client, user, monkeypatch):
+    monkeypatch.setattr(app_module, 'bcrypt_rounds', 5)
+    hashed = []
+    real_hash_password = app_module.hash_password
+
+    def counting_hash_password(password):
+        hashed.append(app_module.threading.current_thread().name)
+        return real_hash_password(password)
+
+    monkeypatch.setattr(app_module, 'hash_password', counting_hash_password)
+    login_token(client, user)
+    wait_for_rehash(user['usr_index'])
+
+    # Un solo bcrypt extra y fuera del hilo del request
+    assert len(hashed) == 1
+    assert hashed[0] != app_module.threading.current_thread().name
+
+
+def test_launch_reads_name_from_storage(client, user, monkeypatch):
+    token = login_token(client, user)
+    real_get_launch_state = app_module.storage.get_launch_state
+
+    def renamed(*args, **kwargs):
+        user_row, resume_state, stats = real_get_launch_state(*args, **kwargs)
+        return (user_row[0], 'Nombre nuevo', *user_row[2:]), resume_state, stats
+
+    monkeypatch.setattr(app_module.storage, 'get_launch_state', renamed)
+    assert launch(client, token=token).get_json()['data']['usr_name'] == 'Nombre nuevo'
+
+
+@requires_postgres
+def test_trigger_only_tracks_real_password_changes(user):
+    usr_index = user['usr_index']
+    changed_at = password_changed_at(usr_index)
+
+    assert app_module.storage.update_password_hash(usr_index, hash_with_rounds(user['password'], 5), stored_hash(usr_index))
+    assert password_changed_at(usr_index) == changed_at
+
+    change_password(usr_index, hash_with_rounds('nueva', 4))
+    assert password_changed_at(usr_index) > changed_at
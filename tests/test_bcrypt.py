@@ -0,0 +1,90 @@
+"""Calibración del costo de bcrypt y rehash después del login"""
+import time
+
+import bcrypt
+
+import app as app_module
+
+
+def hash_with_rounds(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=rounds)).decode('utf-8')
+
+
+def stored_hash(usr_index):
+    return app_module.storage.find_user_by_index(usr_index)[3]
+
+
+def set_password(usr_index, new_hash):
+    assert app_module.storage.update_password_hash(usr_index, new_hash, stored_hash(usr_index))
+
+
+def wait_for_rehash(usr_index, timeout=5):
+    deadline = time.monotonic() + timeout
+    while usr_index in app_module.rehash_pending:
+        assert time.monotonic() < deadline, 'el rehash no terminó'
+        time.sleep(0.01)
+
+
+def test_rounds_for_target_doubles_per_round():
+    # 8 rounds = 10 ms -> 11 rounds = 80 ms, 12 rounds = 160 ms
+    assert app_module.rounds_for_target(10, 100) == 11
+    assert app_module.rounds_for_target(10, 160) == 12
+    assert app_module.rounds_for_target(10, 159) == 11
+
+
+def test_rounds_for_target_is_clamped():
+    assert app_module.rounds_for_target(10, 1, min_rounds=10, max_rounds=14) == 10
+    assert app_module.rounds_for_target(0.001, 10 ** 9, min_rounds=10, max_rounds=14) == 14
+
+
+def test_rehash_raises_cost_once(user, monkeypatch):
+    usr_index = user['usr_index']
+    monkeypatch.setattr(app_module, 'bcrypt_rounds', 5)
+    old_hash = stored_hash(usr_index)
+
+    assert app_module.rehash_password_if_needed(usr_index, user['password'], old_hash)
+    wait_for_rehash(usr_index)
+
+    new_hash = stored_hash(usr_index)
+    assert app_module.get_hash_rounds(new_hash) == 5
+    assert app_module.verify_password(user['password'], new_hash)
+    assert not app_module.rehash_password_if_needed(usr_index, user['password'], new_hash)
+
+
+def test_login_rehashes_in_background(client, user, monkeypatch):
+    monkeypatch.setattr(app_module, 'bcrypt_rounds', 5)
+
+    response = client.post('/login_user', json={'email': user['email'], 'password': user['password']})
+    assert response.status_code == 200
+    wait_for_rehash(user['usr_index'])
+
+    assert app_module.get_hash_rounds(stored_hash(user['usr_index'])) == 5
+
+
+def test_rehash_never_lowers_cost(user):
+    usr_index = user['usr_index']
+    set_password(usr_index, hash_with_rounds(user['password'], app_module.bcrypt_rounds + 1))
+
+    assert not app_module.rehash_password_if_needed(usr_index, user['password'], stored_hash(usr_index))
+
+
+def test_rehash_at_most_one_in_flight(user, monkeypatch):
+    usr_index = user['usr_index']
+    monkeypatch.setattr(app_module, 'bcrypt_rounds', 5)
+    monkeypatch.setattr(app_module, 'rehash_pending', {usr_index})
+
+    assert not app_module.rehash_password_if_needed(usr_index, user['password'], stored_hash(usr_index))
+
+
+def test_rehash_does_not_overwrite_concurrent_change(user, monkeypatch):
+    usr_index = user['usr_index']
+    monkeypatch.setattr(app_module, 'bcrypt_rounds', 5)
+    old_hash = stored_hash(usr_index)
+    changed_hash = hash_with_rounds('otra', 4)
+    set_password(usr_index, changed_hash)
+
+    app_module.rehash_pending.add(usr_index)
+    app_module._rehash_password(usr_index, user['password'], old_hash)
+
+    assert stored_hash(usr_index) == changed_hash
+    assert usr_index not in app_module.rehash_pending
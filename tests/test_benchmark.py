@@ -0,0 +1,43 @@
+"""Escenarios de benchmark_app.py: uno por endpoint y todos responden"""
+import contextlib
+import io
+
+import pytest
+
+import app as app_module
+
+pytestmark = pytest.mark.skipif(
+    app_module.storage.name != 'memory',
+    reason='el benchmark siembra usuarios fijos en el almacenamiento en memoria'
+)
+
+
+def test_every_route_has_a_scenario(client):
+    import benchmark_app
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        users = benchmark_app.seed(client)
+    scenarios = benchmark_app.build_scenarios(users)
+
+    covered = set()
+    for name, scenario in scenarios:
+        for i in range(3):
+            with contextlib.redirect_stdout(io.StringIO()):
+                response = scenario(client, i)
+            assert response.status_code < 400, (name, response.get_data(as_text=True))
+        covered.update(part for part in name.split() if part.startswith('/'))
+    # Un solo escenario abre y cierra la sesión
+    assert 'POST start + PUT end' in dict(scenarios)
+    covered.update({'/therapy/session/start', '/therapy/session/<id>/end'})
+
+    routes = {
+        rule.rule.replace('<int:usr_index>', '<id>').replace('<int:session_id>', '<id>')
+        for rule in app_module.app.url_map.iter_rules()
+        if rule.endpoint != 'static'
+    }
+    # Excluidas a propósito (ver el docstring de benchmark_app.py)
+    routes -= {'/', '/test'}
+    assert routes <= covered
+
+    # Los streams SSE del escenario se cerraron
+    assert not app_module.session_event_subscribers
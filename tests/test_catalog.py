@@ -0,0 +1,88 @@
+"""Catálogo de ejercicios y pregunta actual de una sesión"""
+import pytest
+
+import app as app_module
+from tests.conftest import answer_body, start_session
+
+
+def question(client, session_id, **params):
+    response = client.get(f'/therapy/session/{session_id}/question', query_string=params)
+    return response.status_code, response.get_json()
+
+
+def test_catalog_revalidates_with_etag(client):
+    response = client.get('/therapy/catalog')
+    assert response.status_code == 200
+    data = response.get_json()['data']
+    assert data['therapy_types']['palabras']['animales'][0] == ['perro', 'perro']
+    assert response.headers['ETag'] == f'"{data["version"]}"'
+
+    response = client.get('/therapy/catalog', headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_question_follows_the_session_index(client, user):
+    session_id = start_session(client, user['usr_index'])
+
+    status, body = question(client, session_id)
+    assert status == 200
+    assert body['data']['question'] == {'question_text': 'perro', 'expected_answer': 'perro'}
+    assert (body['data']['question_index'], body['data']['remaining']) == (0, 20)
+
+    client.post(f'/therapy/session/{session_id}/answer', json=answer_body(0))
+    status, body = question(client, session_id)
+    assert body['data']['question']['question_text'] == 'gato'
+    assert (body['data']['question_index'], body['data']['remaining']) == (1, 19)
+
+
+def test_question_past_the_end_is_completed(client, user):
+    session_id = start_session(client, user['usr_index'])
+    client.post(f'/therapy/session/{session_id}/answer', json=answer_body(24))
+
+    status, body = question(client, session_id)
+    assert status == 200
+    assert body['data']['completed'] is True
+    assert body['data']['question'] is None
+    assert body['data']['remaining'] == 0
+
+
+def test_question_needs_a_known_category(client, user):
+    response = client.post('/therapy/session/start', json={
+        'usr_index': user['usr_index'], 'therapy_type': 'palabras'
+    })
+    session_id = response.get_json()['data']['session_id']
+
+    assert question(client, session_id)[0] == 400
+    assert question(client, session_id, category='planetas')[0] == 404
+    status, body = question(client, session_id, category='colores')
+    assert status == 200
+    assert body['data']['therapy_category'] == 'colores'
+
+
+@pytest.mark.parametrize('next_question_index', [-1, '3', 2.5, True])
+def test_answer_rejects_invalid_next_index(client, user, next_question_index):
+    session_id = start_session(client, user['usr_index'])
+    body = dict(answer_body(0), next_question_index=next_question_index)
+
+    response = client.post(f'/therapy/session/{session_id}/answer', json=body)
+    assert response.status_code == 400
+
+    # No se registró nada
+    status, body = question(client, session_id)
+    assert body['data']['question_index'] == 0
+
+
+def test_negative_stored_index_is_not_found(client, monkeypatch):
+    # Índice guardado antes de que se validara next_question_index
+    session_id = 10 ** 9
+    monkeypatch.setattr(app_module.storage, 'get_session_state', lambda requested_id: {
+        'session_id': requested_id, 'usr_index': 1, 'session_status': 'active',
+        'therapy_type': 'palabras', 'therapy_category': 'animales', 'started_at': None,
+        'total_questions': 3, 'correct_answers': 3, 'current_question_index': -1
+    })
+    monkeypatch.setattr(app_module, 'cache_session', lambda session, is_latest_active=False: None)
+
+    status, body = question(client, session_id)
+    assert status == 404
+    assert body['success'] is False
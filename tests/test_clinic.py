@@ -0,0 +1,108 @@
+"""Dashboard clínico: paginación por keyset y refresco de la vista"""
+from datetime import datetime
+from decimal import Decimal
+
+import psycopg2
+import pytest
+
+import app as app_module
+from tests.conftest import answer_body, requires_postgres, start_session
+
+
+@pytest.fixture
+def patients(client, user):
+    """Algunos pacientes con sesiones completadas de distinta precisión"""
+    usr_indexes = [user['usr_index']]
+    for number in range(4):
+        response = client.post('/register_user', json={
+            'name': f'Paciente {number}', 'email': f"{number}-{user['email']}", 'password': 'x'
+        })
+        usr_indexes.append(response.get_json()['data']['usr_index'])
+
+    for position, usr_index in enumerate(usr_indexes):
+        for _ in range(position % 3 + 1):
+            session_id = start_session(client, usr_index)
+            for index in range(4):
+                client.post(f'/therapy/session/{session_id}/answer', json=answer_body(index, correct=index < position))
+            client.put(f'/therapy/session/{session_id}/end', json={'status': 'completed'})
+    app_module.storage.refresh_clinic_views()
+    return usr_indexes
+
+
+def walk(client, sort, order, limit=2):
+    """Todas las páginas de /clinic/patients"""
+    rows, cursor = [], None
+    while True:
+        url = f'/clinic/patients?sort={sort}&order={order}&limit={limit}'
+        if cursor:
+            url += f'&cursor={cursor}'
+        response = client.get(url)
+        assert response.status_code == 200, response.get_json()
+        data = response.get_json()['data']
+        rows.extend(data['patients'])
+        cursor = data['next_cursor']
+        if not cursor:
+            return rows
+
+
+def test_cursor_round_trip():
+    values = [datetime(2026, 3, 1, 12, 30), Decimal('87.5'), 42]
+    cursor = app_module.encode_cursor(values)
+
+    assert app_module.decode_cursor(cursor) == ['2026-03-01T12:30:00', 87.5, 42]
+
+
+@pytest.mark.parametrize('sort, key', [
+    ('accuracy', 'avg_accuracy'),
+    ('sessions', 'completed_sessions'),
+    ('last_activity', 'last_activity'),
+    ('usr_index', 'usr_index')
+])
+@pytest.mark.parametrize('order', ['asc', 'desc'])
+def test_keyset_pages_cover_every_patient_once(client, patients, sort, key, order):
+    rows = walk(client, sort, order)
+
+    usr_indexes = [row['usr_index'] for row in rows]
+    assert len(usr_indexes) == len(set(usr_indexes))
+    assert set(patients) <= set(usr_indexes)
+    keys = [(row[key], row['usr_index']) for row in rows]
+    assert keys == sorted(keys, reverse=order == 'desc')
+
+
+def test_patients_have_names(client, patients):
+    rows = {row['usr_index']: row for row in walk(client, 'usr_index', 'asc', limit=50)}
+    assert rows[patients[1]]['usr_name'] == 'Paciente 0'
+
+
+@pytest.mark.parametrize('query', ['sort=name', 'order=up', 'limit=0', 'min_sessions=x'])
+def test_invalid_params(client, query):
+    assert client.get(f'/clinic/patients?{query}').status_code == 400
+
+
+def test_cursor_from_other_order_is_rejected(client, patients):
+    cursor = client.get('/clinic/patients?sort=sessions&limit=1').get_json()['data']['next_cursor']
+
+    response = client.get(f'/clinic/patients?sort=accuracy&limit=1&cursor={cursor}')
+    assert response.status_code == 400
+
+
+@requires_postgres
+def test_refresh_runs_once_per_interval(monkeypatch):
+    def refreshed_at():
+        conn = psycopg2.connect(**app_module.DB_CONFIG)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT refreshed_at FROM clinic_view_refresh_log WHERE view_name = 'clinic_patient_progress'"
+            )
+            return cursor.fetchone()[0]
+        finally:
+            conn.close()
+
+    monkeypatch.setattr(app_module, 'CLINIC_REFRESH_SECONDS', 0)
+    app_module.storage.refresh_clinic_views()
+    first = refreshed_at()
+
+    monkeypatch.setattr(app_module, 'CLINIC_REFRESH_SECONDS', 300)
+    app_module.storage.refresh_clinic_views()
+    assert refreshed_at() == first
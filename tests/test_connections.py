@@ -0,0 +1,79 @@
+"""Rastreo de préstamos del pool: fugas y devolución en el teardown"""
+import threading
+import time
+
+import pytest
+
+import app as app_module
+from tests.conftest import requires_postgres
+
+
+class FakeConnection:
+    """Conexión que nunca se devuelve (solo se usa su id)"""
+
+
+@pytest.fixture
+def checkouts(monkeypatch):
+    monkeypatch.setattr(app_module, 'connection_checkouts', {})
+    monkeypatch.setattr(app_module, 'leaked_connections_total', 0)
+    return app_module.connection_checkouts
+
+
+def leak(age_seconds):
+    conn = FakeConnection()
+    app_module._register_checkout(conn, None)
+    app_module.connection_checkouts[id(conn)]['acquired_at'] = time.monotonic() - age_seconds
+    return conn
+
+
+def test_leak_reported_once(checkouts):
+    leak(app_module.DB_CONN_LEAK_SECONDS + 1)
+    leak(0)
+
+    assert app_module.report_leaked_connections() == 1
+    assert app_module.report_leaked_connections() == 1
+    assert app_module.leaked_connections_total == 1
+    # Solo se reporta: el préstamo sigue registrado
+    assert len(checkouts) == 2
+
+
+def test_readyz_fails_after_leak_threshold(client, checkouts, monkeypatch):
+    monkeypatch.setattr(app_module, 'READY_MAX_LEAKED_CONNECTIONS', 2)
+
+    leak(app_module.DB_CONN_LEAK_SECONDS + 1)
+    response = client.get('/readyz')
+    assert response.status_code == 200
+    assert response.get_json()['checks']['leaked_connections'] == {'current': 1, 'total': 1, 'max_total': 2}
+
+    leak(app_module.DB_CONN_LEAK_SECONDS + 1)
+    response = client.get('/readyz')
+    assert response.status_code == 503
+    assert '2 conexiones fugadas' in response.get_json()['failures']
+
+
+@requires_postgres
+def test_teardown_returns_connections_the_handler_kept():
+    with app_module.app.test_request_context('/therapy/catalog'):
+        conn = app_module.get_db_connection()
+        assert id(conn) in app_module.connection_checkouts
+
+    assert id(conn) not in app_module.connection_checkouts
+    assert id(conn) not in app_module.connection_pool._rused
+
+
+@requires_postgres
+def test_teardown_skips_connections_already_released():
+    taken = []
+    with app_module.app.test_request_context('/therapy/catalog'):
+        conn = app_module.get_db_connection()
+        app_module.release_db_connection(conn)
+        # Otro hilo toma la misma conexión antes del teardown de este request
+        thread = threading.Thread(target=lambda: taken.append(app_module.get_db_connection()))
+        thread.start()
+        thread.join()
+        assert taken[0] is conn
+
+    try:
+        assert id(conn) in app_module.connection_checkouts
+    finally:
+        app_module.release_db_connection(conn)
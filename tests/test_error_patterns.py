@@ -0,0 +1,82 @@
+"""/therapy/errors: validación de parámetros y filtros sobre error_details"""
+import json
+from urllib.parse import quote
+
+import pytest
+
+import app as app_module
+from tests.conftest import answer_body, start_session
+
+
+def wrong_answer(index, error_type, details):
+    return dict(answer_body(index, correct=False), error_type=error_type, error_details=details)
+
+
+@pytest.fixture
+def patient_errors(client, user):
+    """Errores de un paciente: 3 sustituciones rr->r, 1 omisión y un tipo con % y _"""
+    session_id = start_session(client, user['usr_index'])
+    answers = [
+        wrong_answer(0, 'substitution_rr_to_r', {'position': 2, 'expected': 'rr', 'actual': 'r'}),
+        wrong_answer(1, 'substitution_rr_to_r', {'position': 2, 'expected': 'rr', 'actual': 'r'}),
+        wrong_answer(2, 'substitution_rr_to_r', {'expected': 'rr', 'actual': 'r'}),
+        wrong_answer(3, 'omission_s', {'position': 4}),
+        wrong_answer(4, 'substitutionXrr', {'position': 1})
+    ]
+    for answer in answers:
+        response = client.post(f'/therapy/session/{session_id}/answer', json=answer)
+        assert response.status_code == 201
+    return user['usr_index']
+
+
+def error_counts(client, usr_index, **params):
+    query = '&'.join(f'{key}={quote(str(value))}' for key, value in params.items())
+    response = client.get(f'/therapy/errors?group_by=user&usr_index={usr_index}&{query}')
+    assert response.status_code == 200, response.get_json()
+    return {group['error_type']: group['occurrences'] for group in response.get_json()['data']['results']}
+
+
+@pytest.mark.parametrize('query', [
+    'usr_index=abc',
+    'group_by=session',
+    'limit=0',
+    'min_occurrences=x',
+    'from=ayer',
+    'detail=[1]',
+    'detail={no-json'
+])
+def test_invalid_params(client, query):
+    response = client.get(f'/therapy/errors?{query}')
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+
+
+def test_escape_like():
+    assert app_module.escape_like('substitution_r') == 'substitution\\_r'
+    assert app_module.escape_like('100%') == '100\\%'
+    assert app_module.escape_like('a\\b') == 'a\\\\b'
+
+
+def test_groups_by_user(client, patient_errors):
+    assert error_counts(client, patient_errors) == {
+        'substitution_rr_to_r': 3, 'omission_s': 1, 'substitutionXrr': 1
+    }
+
+
+def test_prefix_treats_underscore_literally(client, patient_errors):
+    assert error_counts(client, patient_errors, error_type='SUBSTITUTION_') == {'substitution_rr_to_r': 3}
+
+
+def test_detail_containment(client, patient_errors):
+    detail = json.dumps({'expected': 'rr', 'position': 2})
+    assert error_counts(client, patient_errors, detail=detail) == {'substitution_rr_to_r': 2}
+
+
+def test_has_key(client, patient_errors):
+    assert error_counts(client, patient_errors, has_key='position') == {
+        'substitution_rr_to_r': 2, 'omission_s': 1, 'substitutionXrr': 1
+    }
+
+
+def test_min_occurrences(client, patient_errors):
+    assert error_counts(client, patient_errors, min_occurrences=2) == {'substitution_rr_to_r': 3}
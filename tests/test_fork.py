@@ -0,0 +1,127 @@
+"""Estado del proceso hijo después de un fork (gunicorn con preload_app)"""
+from collections import OrderedDict
+import json
+import os
+
+import pytest
+
+import app as app_module
+from tests.conftest import requires_postgres
+from tests.test_session_cache import session_state
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason='requiere os.fork')
+
+
+def run_in_child(check):
+    """Correr check() en un hijo y devolver el dict que reporta"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            result = check()
+        except BaseException as e:
+            result = {'error': repr(e)}
+        with os.fdopen(write_fd, 'w') as pipe:
+            json.dump(result, pipe)
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        output = pipe.read()
+    os.waitpid(pid, 0)
+    result = json.loads(output)
+    assert 'error' not in result, result['error']
+    return result
+
+
+@pytest.fixture
+def inherited_state(monkeypatch):
+    """Caché, versiones y rehash pendientes cargados en el padre"""
+    monkeypatch.setattr(app_module, 'session_cache', OrderedDict())
+    monkeypatch.setattr(app_module, 'active_session_by_user', {})
+    monkeypatch.setattr(app_module, 'user_versions', {})
+    monkeypatch.setattr(app_module, 'rehash_pending', set())
+    monkeypatch.setitem(app_module.session_listener_ready, 0, True)
+
+    app_module.cache_session(session_state(10), is_latest_active=True)
+    app_module.user_versions[1] = 'v1'
+    app_module.rehash_pending.add(1)
+
+
+def test_child_starts_with_empty_caches(inherited_state):
+    parent_process_id = app_module.PROCESS_ID
+
+    def check():
+        return {
+            'process_id': app_module.PROCESS_ID,
+            'session_cache': len(app_module.session_cache),
+            'active_session_by_user': len(app_module.active_session_by_user),
+            'listener_ready': len(app_module.session_listener_ready),
+            'user_versions': len(app_module.user_versions),
+            'rehash_pending': len(app_module.rehash_pending),
+            'probe_error': app_module.db_probe['error']
+        }
+
+    result = run_in_child(check)
+
+    assert result['process_id'] != parent_process_id
+    assert result['session_cache'] == 0
+    assert result['active_session_by_user'] == 0
+    assert result['listener_ready'] == 0
+    assert result['user_versions'] == 0
+    assert result['rehash_pending'] == 0
+    assert result['probe_error'] == 'sin probar'
+    # El padre conserva lo suyo
+    assert app_module.get_cached_session(10) is not None
+
+
+def test_child_gets_fresh_locks():
+    # Un lock tomado por otro hilo al momento del fork quedaría tomado
+    # para siempre en el hijo si no se reemplazara
+    with app_module.connection_pool_lock, app_module.session_cache_lock:
+        result = run_in_child(lambda: {
+            'connection_pool_lock': app_module.connection_pool_lock.acquire(blocking=False),
+            'session_cache_lock': app_module.session_cache_lock.acquire(blocking=False)
+        })
+
+    assert result == {'connection_pool_lock': True, 'session_cache_lock': True}
+
+
+@requires_postgres
+def test_child_opens_its_own_pool():
+    parent_pool = app_module.get_connection_pool()
+    parent_pool_id = id(parent_pool)
+
+    def check():
+        discarded = app_module.connection_pool is None
+        conn_pool = app_module.get_connection_pool()
+        conn = conn_pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT pg_backend_pid()')
+                backend_pid = cursor.fetchone()[0]
+        finally:
+            conn_pool.putconn(conn)
+        return {
+            'discarded': discarded,
+            'same_pool': id(conn_pool) == parent_pool_id,
+            'pool_pid': app_module.connection_pool_pid,
+            'pid': os.getpid(),
+            'backend_pid': backend_pid
+        }
+
+    result = run_in_child(check)
+
+    assert result['discarded']
+    assert not result['same_pool']
+    assert result['pool_pid'] == result['pid']
+
+    # Las conexiones del padre siguen vivas: el hijo no las cerró
+    conn = parent_pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT pg_backend_pid()')
+            assert cursor.fetchone()[0] != result['backend_pid']
+    finally:
+        parent_pool.putconn(conn)
@@ -0,0 +1,80 @@
+"""/healthz y /readyz"""
+import pytest
+
+import app as app_module
+from tests.conftest import requires_postgres
+
+
+@pytest.fixture
+def fresh_probe(monkeypatch):
+    """Probe sin resultado cacheado"""
+    monkeypatch.setattr(app_module, 'db_probe', {
+        'checked_at': None, 'ok': False, 'latency_ms': None, 'error': 'sin probar'
+    })
+
+
+@pytest.fixture
+def database_down(monkeypatch, fresh_probe):
+    """Postgres inalcanzable y ningún pool creado en este proceso"""
+    monkeypatch.setattr(app_module, 'storage', app_module.PostgresStorage())
+    monkeypatch.setattr(app_module, 'DB_CONFIG', dict(app_module.DB_CONFIG, host='127.0.0.1', port=1))
+    monkeypatch.setattr(app_module, 'connection_pool', None)
+    monkeypatch.setattr(app_module, 'connection_pool_pid', None)
+    attempts = []
+    real_init_db_pool = app_module.init_db_pool
+
+    def counting_init_db_pool():
+        attempts.append(1)
+        return real_init_db_pool()
+
+    monkeypatch.setattr(app_module, 'init_db_pool', counting_init_db_pool)
+    return attempts
+
+
+def test_healthz(client):
+    assert client.get('/healthz').get_json() == {'status': 'ok'}
+
+
+def test_readyz_ok(client, fresh_probe):
+    response = client.get('/readyz')
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['status'] == 'ready'
+    assert body['checks']['storage'] == app_module.storage.name
+    assert body['checks']['bcrypt']['rounds'] == app_module.bcrypt_rounds
+
+
+def test_readyz_fails_on_bcrypt_backlog(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'bcrypt_in_flight', app_module.READY_MAX_BCRYPT_BACKLOG + 1)
+
+    response = client.get('/readyz')
+    assert response.status_code == 503
+    assert 'backlog de bcrypt alto' in response.get_json()['failures']
+
+
+def test_pool_stats_never_create_the_pool(database_down):
+    assert app_module.get_pool_stats() is None
+    assert database_down == []
+
+
+def test_readyz_retries_pool_once_per_probe_interval(client, database_down, monkeypatch):
+    monkeypatch.setattr(app_module, 'HEALTH_CACHE_SECONDS', 60)
+
+    for _ in range(3):
+        response = client.get('/readyz')
+        assert response.status_code == 503
+    assert len(database_down) == 1
+
+    failures = response.get_json()['failures']
+    assert 'pool no inicializado' in failures
+    assert 'base de datos: no se pudo crear el pool' in failures
+
+
+@requires_postgres
+def test_readyz_reports_pool_and_latency(client, fresh_probe):
+    response = client.get('/readyz')
+    assert response.status_code == 200
+    checks = response.get_json()['checks']
+    assert checks['db']['ok'] is True
+    assert checks['db']['latency_ms'] >= 0
+    assert checks['pool']['max'] == app_module.DB_POOL_MAX
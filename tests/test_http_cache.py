@@ -0,0 +1,88 @@
+"""ETag / Last-Modified por versión de usuario y serialización JSON"""
+from datetime import datetime
+from decimal import Decimal
+import json
+
+import pytest
+
+import app as app_module
+from tests.conftest import answer_body, start_session
+
+
+@pytest.mark.parametrize('path', ['/therapy/user/{}/resume', '/therapy/user/{}/quick-stats'])
+def test_etag_returns_304_until_user_changes(client, user, path):
+    url = path.format(user['usr_index'])
+
+    first = client.get(url)
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+
+    cached = client.get(url, headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.headers['ETag'] == etag
+    assert cached.get_data() == b''
+
+    session_id = start_session(client, user['usr_index'])
+    client.post(f'/therapy/session/{session_id}/answer', json=answer_body(0))
+
+    changed = client.get(url, headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+
+
+def test_active_session_revalidates_after_each_answer(client, user):
+    usr_index = user['usr_index']
+    session_id = start_session(client, usr_index)
+    url = f'/therapy/session/active/{usr_index}'
+
+    etag = client.get(url).headers['ETag']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    client.post(f'/therapy/session/{session_id}/answer', json=answer_body(0))
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['data']['total_questions'] == 1
+
+
+def test_etag_is_per_user(client, user):
+    other = client.post('/register_user', json={
+        'name': 'Otro', 'email': f"otro-{user['email']}", 'password': 'x'
+    }).get_json()['data']['usr_index']
+    etag = client.get(f"/therapy/user/{user['usr_index']}/resume").headers['ETag']
+
+    response = client.get(f'/therapy/user/{other}/resume', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+
+
+def test_not_modified_skips_aggregates(client, user, monkeypatch):
+    # Con una sesión el usuario ya tiene versión y con ella Last-Modified
+    start_session(client, user['usr_index'])
+    url = f"/therapy/user/{user['usr_index']}/quick-stats"
+    first = client.get(url)
+
+    def fail(usr_index):
+        raise AssertionError('no debía consultar estadísticas')
+
+    monkeypatch.setattr(app_module.storage, 'get_quick_stats', fail)
+    response = client.get(url, headers={'If-Modified-Since': first.headers['Last-Modified']})
+    assert response.status_code == 304
+
+
+@pytest.mark.parametrize('use_orjson', [False, True])
+def test_json_provider_serializes_datetime_and_decimal(monkeypatch, use_orjson):
+    if use_orjson and app_module.orjson is None:
+        pytest.skip('orjson no está instalado')
+    if not use_orjson:
+        monkeypatch.setattr(app_module, 'orjson', None)
+
+    with app_module.app.test_request_context():
+        response = app_module.jsonify({
+            'ended_at': datetime(2026, 3, 1, 12, 30, 5),
+            'accuracy': Decimal('87.50'),
+            'ñandú': 1
+        })
+
+    assert json.loads(response.get_data(as_text=True)) == {
+        'accuracy': 87.5, 'ended_at': '2026-03-01T12:30:05', 'ñandú': 1
+    }
+    assert b' ' not in response.get_data()
@@ -0,0 +1,113 @@
+"""Caché de sesiones activas e invalidación por NOTIFY"""
+from collections import OrderedDict
+import json
+import time
+
+import psycopg2
+import pytest
+
+import app as app_module
+from tests.conftest import answer_body, requires_postgres, start_session
+
+
+def session_state(session_id, usr_index=1, status='active'):
+    return {
+        'session_id': session_id, 'usr_index': usr_index, 'session_status': status,
+        'therapy_type': 'palabras', 'therapy_category': 'animales', 'started_at': None,
+        'total_questions': 0, 'correct_answers': 0, 'current_question_index': 0
+    }
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """Caché vacía con el listener del shard 0 conectado"""
+    monkeypatch.setattr(app_module, 'session_cache', OrderedDict())
+    monkeypatch.setattr(app_module, 'active_session_by_user', {})
+    monkeypatch.setitem(app_module.session_listener_ready, 0, True)
+    return app_module.session_cache
+
+
+def test_cache_hit_and_active_index(cache):
+    app_module.cache_session(session_state(10), is_latest_active=True)
+
+    assert app_module.get_cached_session(10)['session_status'] == 'active'
+    assert app_module.get_cached_active_session(1)['session_id'] == 10
+
+
+def test_cache_disabled_without_listener(cache, monkeypatch):
+    app_module.cache_session(session_state(10))
+    monkeypatch.setitem(app_module.session_listener_ready, 0, False)
+
+    assert app_module.get_cached_session(10) is None
+
+
+def test_cache_entries_expire(cache, monkeypatch):
+    monkeypatch.setattr(app_module, 'SESSION_CACHE_TTL_SECONDS', -1)
+    app_module.cache_session(session_state(10), is_latest_active=True)
+
+    assert app_module.get_cached_session(10) is None
+    assert 10 not in cache
+    assert app_module.active_session_by_user == {}
+
+
+def test_cache_is_lru_bounded(cache, monkeypatch):
+    monkeypatch.setattr(app_module, 'SESSION_CACHE_MAX', 2)
+    app_module.cache_session(session_state(10, usr_index=1), is_latest_active=True)
+    app_module.cache_session(session_state(11, usr_index=2), is_latest_active=True)
+    app_module.get_cached_session(10)
+    app_module.cache_session(session_state(12, usr_index=3), is_latest_active=True)
+
+    assert list(cache) == [10, 12]
+    assert app_module.active_session_by_user == {1: 10, 3: 12}
+
+
+def test_event_from_other_process_evicts(cache):
+    app_module.cache_session(session_state(10), is_latest_active=True)
+
+    app_module.handle_session_event({
+        'origin': 'otra-maquina:1:abc', 'event': 'ended', 'session_id': 10, 'usr_index': 1
+    })
+    assert app_module.get_cached_session(10) is None
+    assert app_module.get_cached_active_session(1) is None
+
+
+def test_own_event_keeps_cache(cache):
+    app_module.cache_session(session_state(10), is_latest_active=True)
+
+    app_module.handle_session_event({
+        'origin': app_module.PROCESS_ID, 'event': 'answer', 'session_id': 10, 'usr_index': 1
+    })
+    assert app_module.get_cached_session(10) is not None
+
+
+@requires_postgres
+def test_write_from_other_process_invalidates_cache(client, user):
+    session_id = start_session(client, user['usr_index'])
+    deadline = time.monotonic() + 10
+    while not app_module.session_listener_ready.get(0):
+        assert time.monotonic() < deadline, 'el listener no se conectó'
+        time.sleep(0.05)
+    client.post(f'/therapy/session/{session_id}/answer', json=answer_body(0))
+    assert app_module.get_cached_session(session_id) is not None
+
+    # Otro proceso cierra la sesión y avisa por el canal
+    conn = psycopg2.connect(**app_module.DB_CONFIG)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE therapy_sessions SET session_status = 'completed' WHERE session_id = %s", (session_id,)
+        )
+        cursor.execute("SELECT pg_notify(%s, %s)", (app_module.SESSION_EVENTS_CHANNEL, json.dumps({
+            'origin': 'otro-proceso', 'event': 'ended', 'session_id': session_id, 'usr_index': user['usr_index']
+        })))
+        conn.commit()
+    finally:
+        conn.close()
+
+    deadline = time.monotonic() + 10
+    while app_module.get_cached_session(session_id) is not None:
+        assert time.monotonic() < deadline, 'el NOTIFY no invalidó la caché'
+        time.sleep(0.05)
+
+    response = client.post(f'/therapy/session/{session_id}/answer', json=answer_body(1))
+    assert response.status_code == 400
@@ -0,0 +1,131 @@
+"""Mapa de shards: lectura, ubicación de usuarios y sesiones, bloqueo de escrituras, shard_tool.py"""
+import json
+import os
+
+import pytest
+
+import app as app_module
+import shard_tool
+
+EXAMPLE_MAP = os.path.join(os.path.dirname(__file__), '..', 'shard_map.example.json')
+
+
+def shard_map(**overrides):
+    current_map = {
+        'session_id_stride': 4,
+        'shards': {0: {}, 1: {}, 2: {}},
+        'users': {},
+        'sessions': {},
+        'placement': [0, 1],
+        'frozen_users': frozenset(),
+        'legacy_session_id_max': 0
+    }
+    current_map.update(overrides)
+    return current_map
+
+
+def write_map(tmp_path, raw):
+    path = tmp_path / 'shard_map.json'
+    path.write_text(json.dumps(raw), encoding='utf-8')
+    return str(path)
+
+
+def test_read_shard_map_defaults(tmp_path):
+    path = write_map(tmp_path, {'shards': {'0': {'host': 'a'}, '1': {'host': 'b'}}})
+    current_map = app_module.read_shard_map(path)
+    assert current_map['session_id_stride'] == 2
+    assert current_map['shards'][0] == {'host': 'a', 'connect_timeout': app_module.DB_CONNECT_TIMEOUT}
+    assert current_map['placement'] == [0, 1]
+    assert current_map['users'] == {}
+    assert current_map['sessions'] == {}
+    assert current_map['frozen_users'] == frozenset()
+    assert current_map['legacy_session_id_max'] == 0
+
+
+def test_read_shard_map_parses_directory(tmp_path):
+    path = write_map(tmp_path, {
+        'shards': {'0': {}, '1': {}},
+        'session_id_stride': 8,
+        'users': {'7': 1},
+        'sessions': {'42': 1},
+        'placement': [1],
+        'frozen_users': [7],
+        'legacy_session_id_max': 100
+    })
+    current_map = app_module.read_shard_map(path)
+    assert current_map['users'] == {7: 1}
+    assert current_map['sessions'] == {42: 1}
+    assert current_map['placement'] == [1]
+    assert current_map['frozen_users'] == frozenset({7})
+    assert current_map['legacy_session_id_max'] == 100
+
+
+@pytest.mark.parametrize('raw', [
+    {'shards': {'0': {}, '2': {}}},
+    {'shards': {'0': {}, '1': {}}, 'session_id_stride': 1},
+    {'shards': {'0': {}}, 'users': {'1': 3}},
+    {'shards': {'0': {}}, 'sessions': {'1': 3}},
+    {'shards': {'0': {}}, 'placement': []},
+    {'shards': {'0': {}}, 'placement': [1]}
+])
+def test_read_shard_map_rejects_invalid(tmp_path, raw):
+    with pytest.raises(ValueError):
+        app_module.read_shard_map(write_map(tmp_path, raw))
+
+
+def test_user_shard_uses_directory_then_placement():
+    current_map = shard_map(users={5: 2})
+    assert app_module.user_shard(current_map, 5) == 2
+    assert app_module.user_shard(current_map, 4) == 0
+    assert app_module.user_shard(current_map, '7') == 1
+
+
+def test_session_shard_override_legacy_and_stride():
+    current_map = shard_map(sessions={13: 2}, legacy_session_id_max=10)
+    assert app_module.session_shard(current_map, 13) == 2
+    assert app_module.session_shard(current_map, 9) == 0
+    assert app_module.session_shard(current_map, 10) == 0
+    assert app_module.session_shard(current_map, 11) == 3
+    assert app_module.session_shard(current_map, '14') == 2
+
+
+def test_frozen_user_cannot_start_session(client, user, monkeypatch):
+    frozen_map = dict(app_module.get_shard_map(), frozen_users=frozenset({user['usr_index']}))
+    monkeypatch.setattr(app_module, 'shard_map', frozen_map)
+
+    response = client.post('/therapy/session/start', json={
+        'usr_index': user['usr_index'],
+        'therapy_type': 'palabras'
+    })
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) > app_module.SHARD_MAP_RELOAD_SECONDS
+
+
+def test_example_map_keeps_everyone_on_shard_zero():
+    current_map = app_module.read_shard_map(EXAMPLE_MAP)
+    assert current_map['placement'] == [0]
+    assert {app_module.user_shard(current_map, usr_index) for usr_index in range(100)} == {0}
+
+
+def test_pin_unlisted_users_keeps_existing_entries():
+    raw = {'users': {'1': 1}}
+    shard_tool.pin_unlisted_users(None, {0: {1, 2}, 1: {3}})(raw)
+    assert raw['users'] == {'1': 1, '2': 0, '3': 1}
+
+
+def test_plan_rebalance_evens_out_users():
+    current_map = shard_map(shards={0: {}, 1: {}})
+    moves = shard_tool.plan_rebalance(current_map, {0: {1, 2, 3, 4, 5, 6}})
+    assert sorted(moves) == [4, 5, 6]
+    assert set(moves.values()) == {1}
+
+
+def test_update_shard_map_rejects_invalid_change(tmp_path):
+    path = write_map(tmp_path, {'shards': {'0': {}}, 'users': {}})
+
+    def bad(raw):
+        raw['users']['7'] = 3
+
+    with pytest.raises(ValueError):
+        shard_tool.update_shard_map(path, bad)
+    assert json.loads(open(path, encoding='utf-8').read())['users'] == {}
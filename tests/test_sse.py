@@ -0,0 +1,89 @@
+"""Stream SSE de eventos de sesión"""
+from datetime import datetime
+from decimal import Decimal
+import json
+import time
+
+import app as app_module
+from tests.conftest import answer_body, start_session
+
+
+def test_format_sse_uses_app_json():
+    message = app_module.format_sse('answer', {
+        'answered_at': datetime(2026, 3, 1, 12, 30),
+        'accuracy': Decimal('66.7')
+    })
+    assert message.startswith('event: answer\ndata: ')
+    assert message.endswith('\n\n')
+    data = json.loads(message.split('data: ', 1)[1])
+    assert data == {'answered_at': '2026-03-01T12:30:00', 'accuracy': 66.7}
+
+
+def open_stream(client, usr_index):
+    response = client.get(f'/therapy/user/{usr_index}/events', buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    return response, iter(response.response)
+
+
+def next_event(chunks):
+    """Siguiente evento del stream, salteando los keepalive"""
+    for _ in range(20):
+        chunk = next(chunks)
+        chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+        if chunk.startswith('event: '):
+            event, data = chunk.split('\n', 1)
+            return event[len('event: '):], json.loads(data[len('data: '):])
+    raise AssertionError('no llegó ningún evento')
+
+
+def wait_for_listener():
+    # En Postgres los eventos llegan por NOTIFY: hay que escuchar antes
+    deadline = time.monotonic() + 5
+    while app_module.storage.name == 'postgres' and not app_module.session_listener_ready.get(0):
+        assert time.monotonic() < deadline, 'el listener no se conectó'
+        time.sleep(0.05)
+
+
+def test_stream_sends_snapshot_and_session_events(client, user, monkeypatch):
+    monkeypatch.setattr(app_module, 'SSE_HEARTBEAT_SECONDS', 0.2)
+    usr_index = user['usr_index']
+    response, chunks = open_stream(client, usr_index)
+    try:
+        assert next(chunks).startswith(b'retry: ')
+        assert next_event(chunks) == ('snapshot', {'active_session': None})
+        wait_for_listener()
+
+        session_id = start_session(client, usr_index)
+        event, data = next_event(chunks)
+        assert event == 'started'
+        assert data['session_id'] == session_id
+
+        client.post(f'/therapy/session/{session_id}/answer', json=answer_body(0))
+        event, data = next_event(chunks)
+        assert event == 'answer'
+        assert (data['total_questions'], data['correct_answers'], data['accuracy']) == (1, 1, 100.0)
+
+        client.put(f'/therapy/session/{session_id}/end', json={'status': 'completed'})
+        event, data = next_event(chunks)
+        assert (event, data['session_status']) == ('ended', 'completed')
+    finally:
+        response.close()
+
+    assert usr_index not in app_module.session_event_subscribers
+
+
+def test_stream_limit_answers_503(client, user, monkeypatch):
+    monkeypatch.setattr(app_module, 'SSE_MAX_STREAMS', 1)
+    response, chunks = open_stream(client, user['usr_index'])
+    try:
+        next(chunks)
+        rejected = client.get(f"/therapy/user/{user['usr_index']}/events")
+        assert rejected.status_code == 503
+        assert rejected.headers['Retry-After']
+    finally:
+        response.close()
+
+    # Al cerrar se libera el lugar
+    response, chunks = open_stream(client, user['usr_index'])
+    response.close()
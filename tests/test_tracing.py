@@ -0,0 +1,92 @@
+"""Trazas por request: Server-Timing, nombres de sentencias e idas a la base"""
+import time
+
+import pytest
+
+import app as app_module
+from tests.conftest import answer_body, requires_postgres, start_session
+
+
+@pytest.mark.parametrize('query, name', [
+    ('SELECT usr_index FROM usr_mstr WHERE usr_email = %s', 'select usr_mstr'),
+    ('INSERT INTO therapy_answers (session_id) VALUES (%s)', 'insert therapy_answers'),
+    ('WITH updated AS (UPDATE therapy_sessions SET x = 1 RETURNING *) SELECT * FROM updated', 'update therapy_sessions'),
+    ('DELETE FROM therapy_sessions WHERE session_id = %s', 'delete therapy_sessions'),
+    ('SELECT 1', 'select')
+])
+def test_statement_name(query, name):
+    assert app_module.statement_name(query) == name
+
+
+def test_server_timing_is_opt_in(client, user):
+    response = client.post('/login_user', json={'email': user['email'], 'password': user['password']})
+    assert 'Server-Timing' not in response.headers
+
+
+def test_server_timing_reports_bcrypt_and_total(client, user, monkeypatch):
+    monkeypatch.setattr(app_module, 'SERVER_TIMING_ENABLED', True)
+
+    response = client.post('/login_user', json={'email': user['email'], 'password': user['password']})
+    metrics = [metric.split(';')[0] for metric in response.headers['Server-Timing'].split(', ')]
+    assert 'bcrypt' in metrics
+    assert 'json' in metrics
+    assert metrics[-1] == 'total'
+
+
+def test_max_round_trips_fails_over_budget():
+    with pytest.raises(AssertionError, match='GET /x: 2'):
+        with app_module.max_round_trips(1) as watcher:
+            watcher['requests'].append(('GET /x', 2))
+
+
+# Presupuestos medidos contra Postgres. Una lectura son dos idas (la consulta
+# y el rollback con que el pool devuelve la conexión); una escritura, sus
+# sentencias más el commit.
+
+@requires_postgres
+def test_login_round_trips(client, user):
+    with app_module.max_round_trips(2):
+        response = client.post('/login_user', json={'email': user['email'], 'password': user['password']})
+    assert response.status_code == 200
+
+
+@requires_postgres
+def test_alexa_launch_round_trips(client, user):
+    with app_module.max_round_trips(2):
+        response = client.post('/alexa/launch', json={'email': user['email'], 'password': user['password']})
+    assert response.status_code == 200
+
+    token = response.get_json()['data']['token']
+    with app_module.max_round_trips(2):
+        assert client.post('/alexa/launch', json={'token': token}).status_code == 200
+
+
+@requires_postgres
+def test_session_round_trips(client, user):
+    with app_module.max_round_trips(3):
+        session_id = start_session(client, user['usr_index'])
+
+    deadline = time.monotonic() + 10
+    while not app_module.session_listener_ready.get(0):
+        assert time.monotonic() < deadline, 'el listener no se conectó'
+        time.sleep(0.05)
+
+    # Con la sesión en caché: INSERT de la respuesta, UPDATE de la sesión y COMMIT
+    with app_module.max_round_trips(3):
+        response = client.post(f'/therapy/session/{session_id}/answer', json=answer_body(0))
+    assert response.status_code == 201
+
+    with app_module.max_round_trips(2):
+        response = client.put(f'/therapy/session/{session_id}/end', json={'status': 'completed'})
+    assert response.status_code == 200
+
+
+@requires_postgres
+def test_answer_round_trips_without_cache(client, user, monkeypatch):
+    monkeypatch.setattr(app_module, 'SESSION_CACHE_ENABLED', False)
+    session_id = start_session(client, user['usr_index'])
+
+    # Sin caché se valida la sesión antes de escribir
+    with app_module.max_round_trips(4):
+        response = client.post(f'/therapy/session/{session_id}/answer', json=answer_body(0))
+    assert response.status_code == 201
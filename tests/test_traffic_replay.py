@@ -0,0 +1,102 @@
+"""Captura de tráfico (TrafficCaptureMiddleware) y replay_traffic.py"""
+import json
+import threading
+
+import pytest
+from werkzeug.serving import make_server
+from werkzeug.test import Client
+
+import app as app_module
+import replay_traffic
+from tests.conftest import answer_body
+
+
+@pytest.fixture
+def capture_path(tmp_path):
+    return str(tmp_path / 'traffic.jsonl')
+
+
+@pytest.fixture
+def server():
+    """La app servida por HTTP en un puerto libre"""
+    http_server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{http_server.server_port}'
+    http_server.shutdown()
+
+
+def capture_session(capture_path, user, answers=5):
+    """Login, una sesión con respuestas y su cierre, capturados"""
+    middleware = app_module.TrafficCaptureMiddleware(app_module.app.wsgi_app, capture_path)
+    client = Client(middleware)
+    try:
+        client.post('/login_user', json={'email': user['email'], 'password': user['password']})
+        response = client.post('/therapy/session/start', json={
+            'usr_index': user['usr_index'], 'therapy_type': 'palabras'
+        })
+        session_id = response.get_json()['data']['session_id']
+        for index in range(answers):
+            client.post(f'/therapy/session/{session_id}/answer', json=answer_body(index))
+        client.put(f'/therapy/session/{session_id}/end', json={'status': 'completed'})
+    finally:
+        middleware.file.close()
+    return session_id
+
+
+def test_redact_nested_secrets():
+    body = {
+        'email': 'a@example.com',
+        'password': 'secreto',
+        'nested': {'new_Password': 'x', 'items': [{'token': 't', 'ok': 1}]}
+    }
+    assert app_module.redact(body) == {
+        'email': 'a@example.com',
+        'password': '[REDACTED]',
+        'nested': {'new_Password': '[REDACTED]', 'items': [{'token': '[REDACTED]', 'ok': 1}]}
+    }
+
+
+def test_capture_records_requests_without_secrets(capture_path, user):
+    session_id = capture_session(capture_path, user, answers=2)
+
+    with open(capture_path, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    assert [record['route'] for record in records] == [
+        '/login_user',
+        '/therapy/session/start',
+        '/therapy/session/<int:session_id>/answer',
+        '/therapy/session/<int:session_id>/answer',
+        '/therapy/session/<int:session_id>/end'
+    ]
+    assert records[0]['body']['password'] == '[REDACTED]'
+    assert records[1]['response_session_id'] == session_id
+    assert records[2]['args'] == {'session_id': session_id}
+    assert all(record['arrival'] > 0 and record['duration_ms'] >= 0 for record in records)
+
+
+def test_load_records_sorts_interleaved_workers(tmp_path):
+    path = tmp_path / 'traffic.jsonl'
+    path.write_text('\n'.join(json.dumps({'arrival': arrival, 'pid': pid}) for arrival, pid in [
+        (100.5, 2), (100.0, 1), (101.0, 1), (100.2, 2)
+    ]), encoding='utf-8')
+
+    records = replay_traffic.load_records(str(path))
+
+    assert [record['arrival'] for record in records] == [100.0, 100.2, 100.5, 101.0]
+    assert [round(record['offset_ms']) for record in records] == [0, 200, 500, 1000]
+    assert [round(record['gap_ms']) for record in records] == [0, 200, 300, 500]
+
+
+def test_replay_maps_new_sessions(capture_path, user, server):
+    capture_session(capture_path, user)
+    records = replay_traffic.load_records(capture_path)
+
+    replayer = replay_traffic.Replayer(server, concurrency=4, password=user['password'], timeout=10)
+    replayer.run(records, speed=None)
+
+    assert sum(replayer.errors.values()) == 0
+    assert sum(replayer.status_mismatches.values()) == 0
+    assert sum(len(latencies) for latencies in replayer.results.values()) == len(records)
+    [(captured_session, local_session)] = replayer.session_map.items()
+    assert local_session != captured_session
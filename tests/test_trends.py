@@ -0,0 +1,94 @@
+"""Tendencias: cálculos vectorizados contra su versión directa y el endpoint"""
+import numpy as np
+import pytest
+
+import app as app_module
+from tests.conftest import answer_body, start_session
+
+
+def naive_ewma(values, alpha):
+    decay = 1.0 - alpha
+    result = []
+    for t in range(len(values)):
+        weights = decay ** np.arange(t, -1, -1)
+        result.append(np.dot(weights, values[:t + 1]) / weights.sum())
+    return np.array(result)
+
+
+@pytest.mark.parametrize('alpha', [0.05, 0.3, 0.9, 1.0])
+def test_ewma_matches_adjusted_definition(alpha):
+    values = np.random.default_rng(0).uniform(0, 100, 2500)
+    np.testing.assert_allclose(app_module.ewma(values, alpha), naive_ewma(values, alpha), rtol=1e-9)
+
+
+def test_ewma_empty():
+    assert len(app_module.ewma(np.array([]), 0.3)) == 0
+
+
+def test_grouped_rolling_mean_does_not_cross_groups():
+    values = np.array([1.0, 2.0, 3.0, 4.0, 10.0, 20.0, 30.0])
+    group_starts = np.array([0, 0, 0, 0, 4, 4, 4])
+    result = app_module.grouped_rolling_mean(values, group_starts, 3)
+    np.testing.assert_allclose(result, [1.0, 1.5, 2.0, 3.0, 10.0, 15.0, 20.0])
+
+
+def test_grouped_slopes_match_polyfit():
+    rng = np.random.default_rng(1)
+    x = rng.uniform(0, 10, 60)
+    codes = np.repeat([0, 1, 2], 20)
+    y = np.array([2.0, -1.0, 0.5])[codes] * x + rng.normal(0, 0.1, 60)
+
+    slopes = app_module.grouped_slopes(x, y, codes, 4)
+
+    for group in range(3):
+        expected = np.polyfit(x[codes == group], y[codes == group], 1)[0]
+        assert slopes[group] == pytest.approx(expected)
+    # Grupo sin puntos: sin tendencia
+    assert np.isnan(slopes[3])
+
+
+def test_grouped_slopes_need_two_distinct_points():
+    slopes = app_module.grouped_slopes(
+        np.array([1.0, 5.0, 5.0]), np.array([1.0, 2.0, 3.0]), np.array([0, 1, 1]), 2
+    )
+    assert np.isnan(slopes).all()
+
+
+def test_trends_endpoint(client, user):
+    usr_index = user['usr_index']
+    session_id = start_session(client, usr_index)
+    for index in range(6):
+        client.post(f'/therapy/session/{session_id}/answer', json=answer_body(index, correct=index != 2))
+
+    response = client.get(f'/therapy/user/{usr_index}/trends?window=3&points=4')
+    assert response.status_code == 200
+    data = response.get_json()['data']
+    assert (data['total_answers'], data['scored_answers']) == (6, 6)
+    assert data['overall']['accuracy'] == 83.33
+    assert data['overall']['mean_score'] == 85.0
+    assert len(data['score_trend']['score']) == 4
+    assert data['score_trend']['score'][-1] == 90.0
+
+    [category] = data['categories']
+    assert (category['therapy_type'], category['therapy_category']) == ('palabras', 'animales')
+    assert category['answers'] == 6
+    # Últimas tres respuestas correctas
+    assert category['accuracy_curve']['rolling_accuracy'][-1] == 100.0
+
+    etag = response.headers['ETag']
+    cached = client.get(f'/therapy/user/{usr_index}/trends?window=3&points=4', headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    # Otros parámetros, otro recurso
+    assert client.get(f'/therapy/user/{usr_index}/trends', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_trends_without_answers(client, user):
+    data = client.get(f"/therapy/user/{user['usr_index']}/trends").get_json()['data']
+    assert data['total_answers'] == 0
+    assert data['score_trend'] is None
+
+
+@pytest.mark.parametrize('query', ['window=0', 'alpha=1', 'alpha=x', 'points=0'])
+def test_trends_rejects_invalid_params(client, user, query):
+    response = client.get(f"/therapy/user/{user['usr_index']}/trends?{query}")
+    assert response.status_code == 400